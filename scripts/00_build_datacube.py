@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import rasterio
+import numpy as np
+from rasterio.warp import reproject, Resampling
+from datacube import (DATACUBE_VARIABLES, MANIFEST_NAME, MASK_VARIABLES, NA_MASK_NAME, calculate_datacube_grid,
+                      export_na_mask)
+from tiling import imap_bounded, iter_tiles
+
+def get_datacube_variables(directory):
+    """
+    Resolves the datasets of the datacube: source path, band used and output file
+
+    Args:
+        directory (str): Root directory of the ABoVE Biomass datasets
+
+    Returns:
+        variables (list of dict): One entry per dataset, in bit order
+    """
+    variables = []
+    for bit, variable in enumerate(DATACUBE_VARIABLES):
+        source = os.path.join(directory, variable['source'])
+        with rasterio.open(source) as src:
+            band = variable['band'] or src.count
+        variables.append({'name': variable['name'], 'source': source, 'band': band, 'bit': bit,
+                          'file': f"{variable['name']}.tif"})
+    return variables
+
+def resample_chunk(variables, crs, transform, window):
+    """
+    Bilinearly resamples every dataset onto one chunk of the datacube grid, the same
+    resampling `read_and_resample` in `01_create_common_mask.py` uses
+
+    Args:
+        variables (list of dict): Datasets from `get_datacube_variables`
+        crs (CRS): CRS of the datacube grid
+        transform (Affine): The affine transformation of the full grid
+        window (Window): The chunk of the grid to compute
+
+    Returns:
+        tuple: A tuple containg:
+            - window (Window): The chunk that was computed
+            - values (numpy.ndarray): float32 array (datasets, height, width), NaN where there is no data
+            - bits (numpy.ndarray): uint8 NA bit layer of the chunk
+    """
+    chunk_transform = rasterio.windows.transform(window, transform)
+    values = np.full((len(variables), window.height, window.width), np.nan, dtype=np.float32)
+    bits = np.zeros((window.height, window.width), dtype=np.uint8)
+    for variable in variables:
+        i = variable['bit']
+        with rasterio.open(variable['source']) as src:
+            reproject(
+                source=rasterio.band(src, variable['band']),
+                destination=values[i],
+                src_transform=src.transform,
+                src_crs=src.crs,
+                dst_transform=chunk_transform,
+                dst_crs=crs,
+                dst_nodata=np.nan,
+                resampling=Resampling.bilinear
+            )
+        bits |= np.isnan(values[i]).astype(np.uint8) << i
+    return window, values, bits
+
+def build_datacube(directory, output_dir, resolution=30, extent='union', chunk_size=1024, compress='deflate', workers=1):
+    """
+    Resamples every dataset once onto a shared ESRI:102001 grid and stores it as a
+    chunked, compressed datacube: one tiled float32
+    GeoTIFF per dataset and an uint8 NA bit layer, all with `chunk_size` tiles.
+    Chunks are computed by a pool of worker processes and written as they finish.
+    The manifest is written last, so a datacube without one is incomplete
+
+    Args:
+        directory (str): Root directory of the ABoVE Biomass datasets
+        output_dir (str): Directory of the datacube
+        resolution (float): Pixel size of the grid in map units (default 30 m)
+        extent (str): "union" covers every dataset, "overlap" only the area they share
+        chunk_size (int): Edge length of a chunk in pixels (a multiple of 16)
+        compress (str): GeoTIFF compression, e.g. "deflate" or "zstd"
+        workers (int): Number of worker processes used to compute chunks
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    variables = get_datacube_variables(directory)
+    transform, width, height = calculate_datacube_grid([v['source'] for v in variables], resolution, extent)
+    with rasterio.open(variables[0]['source']) as src:
+        crs = src.crs
+    print(f"Datacube grid: {width} x {height} pixels of {resolution} m, {len(variables)} datasets")
+
+    profile = {
+        'driver': 'GTiff',
+        'count': 1,
+        'height': height,
+        'width': width,
+        'crs': crs,
+        'transform': transform,
+        'tiled': True,
+        'blockxsize': chunk_size,
+        'blockysize': chunk_size,
+        'compress': compress,
+        'BIGTIFF': 'IF_SAFER'}
+    value_profile = dict(profile, dtype='float32', nodata=np.nan, predictor=3)
+    bits_profile = dict(profile, dtype='uint8', nodata=None, predictor=2)
+
+    dsts = [rasterio.open(os.path.join(output_dir, v['file']), 'w', **value_profile) for v in variables]
+    bits_dst = rasterio.open(os.path.join(output_dir, NA_MASK_NAME), 'w', **bits_profile)
+
+    try:
+        tasks = ((variables, crs, transform, window) for window in iter_tiles(width, height, chunk_size))
+        for window, values, bits in imap_bounded(resample_chunk, tasks, workers):
+            for dst, value in zip(dsts, values):
+                dst.write(value, 1, window=window)
+            bits_dst.write(bits, 1, window=window)
+    finally:
+        for dst in dsts + [bits_dst]:
+            dst.close()
+
+    manifest = {
+        'grid': {'crs': crs.to_wkt(), 'transform': list(transform)[:6], 'width': width, 'height': height,
+                 'resolution': resolution, 'extent': extent, 'chunk_size': chunk_size, 'compress': compress},
+        'variables': variables,
+        'na_mask': NA_MASK_NAME,
+        'mask_variables': MASK_VARIABLES}
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Datacube saved to: {output_dir}")
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Common Grid Datacube Script")
+    parser.add_argument('--output-dir', type=str, default=None, help="Datacube directory, default <directory>/Datacube")
+    parser.add_argument('--resolution', type=float, default=30, help="Pixel size of the common grid in meters")
+    parser.add_argument('--extent', type=str, choices=['union', 'overlap'], default='union', help="Cover every dataset (union) or only their overlap")
+    parser.add_argument('--chunk-size', type=int, default=1024, help="Chunk edge length in pixels (a multiple of 16)")
+    parser.add_argument('--compress', type=str, default='deflate', help="GeoTIFF compression (deflate, zstd, lzw)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Number of worker processes for chunks")
+    parser.add_argument('--export-masks', action='store_true', help="Also write the Canada and ABoVE common NA masks from the bit layer")
+    args = parser.parse_args()
+
+    # Change this variable as necessary
+    directory = "/projects/arctic/share/ABoVE_Biomass"
+    output_dir = args.output_dir or f"{directory}/Datacube"
+
+    # Run script
+    build_datacube(directory, output_dir, args.resolution, args.extent, args.chunk_size, args.compress, args.workers)
+    if args.export_masks:
+        for type, names in MASK_VARIABLES.items():
+            export_na_mask(output_dir, names, os.path.join(output_dir, f"CommonNA_{type}_Mask.tif"))
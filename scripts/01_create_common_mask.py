@@ -1,11 +1,16 @@
+import os
 import rasterio
 from rasterio.transform import from_bounds
 from rasterio.warp import reproject, Resampling
+from rasterio.windows import Window
 import numpy as np
 import geopandas as gpd
 import argparse
+from mask_tools import MaskIndexBuilder
+from tiling import imap_bounded, iter_tiles
+from run_metrics import add_metrics_arguments, setup_metrics, stage, block, window_fields
 
-def read_and_resample(file_path, transform, width, height):
+def read_and_resample(file_path, transform, width, height, scale=None):
     """
     Reads a raster file, resamples it using bilinear resampling
     to a specified resolution, and returns the resampled data
@@ -15,6 +20,8 @@ def read_and_resample(file_path, transform, width, height):
         transform (Affine): The addine transformation matric for the target resolution
         width (int): The width of the target resampled raster in pixels
         height (int): The height of the target resampled raster in pixels
+        scale (dict or None): GDAL `XSCALE`/`YSCALE` warp options, None lets GDAL work
+                              out the resampling factor from the window
 
     Returns:
         tuple: A tuple containg:
@@ -35,7 +42,8 @@ def read_and_resample(file_path, transform, width, height):
                 src_crs=src.crs,
                 dst_transform=transform,
                 dst_crs=src.crs,
-                resampling=Resampling.bilinear
+                resampling=Resampling.bilinear,
+                **(scale or {})
             )
         # Return the resampled data, CRS, and nodata value
         return resampled_data, src.crs, src.nodata
@@ -66,28 +74,18 @@ def calculate_common_bounds_overlap(tif_files):
             )
     return common_bounds
 
-def create_na_mask(type, directory):
+def get_mask_file_paths(type, directory):
     """
-    Creates and saves a common NA mask for a specified region (Canada or ABoVE) based on
-    overlaping extents of specified raster files
+    Returns the raster files that contribute to the common NA mask of a region
 
     Args:
         type (str): The region for which to create the NA mask.
                     Options are "Canada" or "ABoVE"
-    
-    File Paths:
-        - "Canada":
-            - `../Duncanson2025/Duncanson2025_102001.tif`
-            - `../Guindon2023/Guindon2023_102001.tif`
-            - `../Soto-Navarro2020/Soto2020_102001.tif`
-            - `../SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif`
-        - "ABoVE":
-            - `../Duncanson2025/Duncanson2025_102001.tif`
-            - `../Soto-Navarro2020/Soto2020_102001.tif`
-            - `../SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif`
-            - `../Wang2020/Wang102001.tif`
-    """
+        directory (str): Root directory of the ABoVE Biomass datasets
 
+    Returns:
+        file_paths (list of str): File paths of the rasters used for the region
+    """
     if type == "Canada":
         # Paths not included:
             # Kraatz: Way too small
@@ -105,23 +103,45 @@ def create_na_mask(type, directory):
                         f"{directory}/Soto-Navarro2020/Soto2020_102001.tif",
                       f"{directory}/SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif",
                       f"{directory}/Wang2020/Wang102001.tif"]
-    
-    target_shape = calculate_common_bounds_overlap(file_paths)
+    return file_paths
 
-    # Set desired resolution and inirialize common NA array
-    resolution = 30 # Use the best resolution
+def calculate_common_grid(file_paths, resolution=30):
+    """
+    Calculates the common grid that the NA mask is built on, which covers the
+    overlaping extent of all input rasters at the given resolution
+
+    Args:
+        file_paths (list of str): A list of file paths to the input raster files
+        resolution (float): Pixel size of the common grid in map units (default 30 m)
+
+    Returns:
+        tuple: A tuple containg:
+            - transform (Affine): The affine transformation of the common grid
+            - width (int): The width of the common grid in pixels
+            - height (int): The height of the common grid in pixels
+    """
+    target_shape = calculate_common_bounds_overlap(file_paths)
     width = int((target_shape[2] - target_shape[0]) / resolution)
     height = int((target_shape[3] - target_shape[1]) / resolution)
     transform = rasterio.transform.from_bounds(*target_shape, width, height)
-    common_na_mask = np.zeros((height, width), dtype=bool)
+    return transform, width, height
 
-    # Resample each tif file and get the data for NA
-    for path in file_paths:
-        resampled_data, crs, nodata = read_and_resample(path, transform, width, height)
-        # True where there is an NA in the current resampled raster
-        common_na_mask |= np.all((np.isnan(resampled_data) | (resampled_data == nodata)), axis=0)
+def get_mask_profile(file_paths, transform, width, height):
+    """
+    Builds the rasterio profile used to save a common NA mask
 
-    # Save the common NA mask
+    Args:
+        file_paths (list of str): A list of file paths to the input raster files
+        transform (Affine): The affine transformation of the common grid
+        width (int): The width of the common grid in pixels
+        height (int): The height of the common grid in pixels
+
+    Returns:
+        mask_profile (dict): Profile of the output `CommonNA_<type>_Mask.tif`
+    """
+    # The mask takes the CRS of the last input, the same as the full grid mode
+    with rasterio.open(file_paths[-1]) as src:
+        crs = src.crs
     mask_profile = {
         'driver': 'GTiff',
         'dtype': 'uint8',
@@ -130,17 +150,153 @@ def create_na_mask(type, directory):
         'width': width,
         'transform': transform,
         'crs': crs}
-    with rasterio.open(f"{directory}/OtherSpatialDatasets/CommonNA_{type}_Mask.tif", "w", **mask_profile) as mask_dst:
+    return mask_profile
+
+def create_na_mask(type, directory):
+    """
+    Creates and saves a common NA mask for a specified region (Canada or ABoVE) based on
+    overlaping extents of specified raster files
+
+    Args:
+        type (str): The region for which to create the NA mask.
+                    Options are "Canada" or "ABoVE"
+    
+    File Paths:
+        - "Canada":
+            - `../Duncanson2025/Duncanson2025_102001.tif`
+            - `../Guindon2023/Guindon2023_102001.tif`
+            - `../Soto-Navarro2020/Soto2020_102001.tif`
+            - `../SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif`
+        - "ABoVE":
+            - `../Duncanson2025/Duncanson2025_102001.tif`
+            - `../Soto-Navarro2020/Soto2020_102001.tif`
+            - `../SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif`
+            - `../Wang2020/Wang102001.tif`
+    """
+    file_paths = get_mask_file_paths(type, directory)
+
+    # Set desired resolution and inirialize common NA array
+    transform, width, height = calculate_common_grid(file_paths, resolution=30) # Use the best resolution
+    common_na_mask = np.zeros((height, width), dtype=bool)
+
+    # Resample each tif file and get the data for NA
+    for path in file_paths:
+        resampled_data, crs, nodata = read_and_resample(path, transform, width, height)
+        # True where there is an NA in the current resampled raster
+        common_na_mask |= np.all((np.isnan(resampled_data) | (resampled_data == nodata)), axis=0)
+
+    # Save the common NA mask
+    mask_profile = get_mask_profile(file_paths, transform, width, height)
+    output_path = f"{directory}/OtherSpatialDatasets/CommonNA_{type}_Mask.tif"
+    with rasterio.open(output_path, "w", **mask_profile) as mask_dst:
         mask_dst.write(common_na_mask.astype(np.uint8), 1)
 
+    # Save the tile index used to skip fully masked or valid blocks downstream
+    index = MaskIndexBuilder(height, width)
+    index.update(Window(0, 0, width, height), common_na_mask)
+    index.save(output_path)
+
+def kernel_padding(file_path, transform):
+    """
+    Returns the radius of the bilinear kernel of a source and its resampling factor,
+    so tiles of the common grid can be warped the same as the whole grid
+
+    Args:
+        file_path (str): The file path to the input raster file
+        transform (Affine): The affine transformation of the full common grid
+
+    Returns:
+        tuple: A tuple containg:
+            - pad (int): The kernel radius in pixels of the common grid, one source
+              pixel plus a pixel for rounding
+            - scale (dict): GDAL `XSCALE`/`YSCALE` warp options, the destination pixels
+              per source pixel, so a pixel gets the same value whichever window it is
+              warped in
+    """
+    with rasterio.open(file_path) as src:
+        pad = int(np.ceil(max(src.res) / min(abs(transform.a), abs(transform.e)))) + 1
+        return pad, {'XSCALE': src.res[0] / abs(transform.a), 'YSCALE': src.res[1] / abs(transform.e)}
+
+def compute_na_tile(file_paths, transform, window):
+    """
+    Computes the common NA mask for a single tile of the common grid. Each source
+    is warped onto just this window, so memory is bounded by the tile size. The
+    window is padded by the source's kernel radius before warping and cropped
+    afterwards, and the resampling factor is fixed (`kernel_padding`), so GDAL reads
+    every source pixel that the edge pixels of the tile depend on and weighs them
+    the same as when warping the whole grid
+
+    Args:
+        file_paths (list of str): A list of file paths to the input raster files
+        transform (Affine): The affine transformation of the full common grid
+        window (Window): The tile of the common grid to compute
+
+    Returns:
+        tuple: A tuple containg:
+            - window (Window): The tile that was computed
+            - tile_mask (numpy.ndarray): uint8 array of the tile, 1 where any input is NA
+    """
+    tile_mask = np.zeros((window.height, window.width), dtype=bool)
+    with block('na_tile', **window_fields(window)) as record:
+        for path in file_paths:
+            pad, scale = kernel_padding(path, transform)
+            padded = Window(window.col_off - pad, window.row_off - pad, window.width + 2 * pad, window.height + 2 * pad)
+            resampled_data, _, nodata = read_and_resample(path, rasterio.windows.transform(padded, transform),
+                                                          padded.width, padded.height, scale)
+            resampled_data = resampled_data[:, pad:pad + window.height, pad:pad + window.width]
+            # True where there is an NA in the current resampled tile
+            tile_mask |= np.all((np.isnan(resampled_data) | (resampled_data == nodata)), axis=0)
+        record['na_fraction'] = round(float(tile_mask.mean()), 4)
+    return window, tile_mask.astype(np.uint8)
+
+def create_na_mask_windowed(type, directory, tile_size=4096, workers=1):
+    """
+    Creates and saves a common NA mask the same as `create_na_mask`, but walks the
+    common grid in tiles instead of allocating it in full. Tiles are computed by a
+    pool of worker processes and written to the output as they finish, so peak
+    memory is roughly `workers * tile_size**2 * bands` rather than the whole continent.
+    The mask is identical to the one of `create_na_mask`
+
+    Args:
+        type (str): The region for which to create the NA mask.
+                    Options are "Canada" or "ABoVE"
+        directory (str): Root directory of the ABoVE Biomass datasets
+        tile_size (int): The edge length of a tile in pixels
+        workers (int): Number of worker processes used to compute tiles
+    """
+    file_paths = get_mask_file_paths(type, directory)
+    transform, width, height = calculate_common_grid(file_paths, resolution=30) # Use the best resolution
+    mask_profile = get_mask_profile(file_paths, transform, width, height)
+    output_path = f"{directory}/OtherSpatialDatasets/CommonNA_{type}_Mask.tif"
+
+    tasks = ((file_paths, transform, window) for window in iter_tiles(width, height, tile_size))
+    index = MaskIndexBuilder(height, width)
+
+    with rasterio.open(output_path, "w", **mask_profile) as mask_dst:
+        for window, tile_mask in imap_bounded(compute_na_tile, tasks, workers):
+            mask_dst.write(tile_mask, 1, window=window)
+            index.update(window, tile_mask)
+
+    print(f"Common NA mask saved to: {output_path}")
+    # Save the tile index used to skip fully masked or valid blocks downstream
+    index.save(output_path)
+
 if __name__ == "__main__":
     # Parse arguments
     parser = argparse.ArgumentParser(description="Common NA Mask Script")
     parser.add_argument('--type', type=str, choices=['ABoVE', 'Canada'], required=True, help="Type of script to run (ABoVE or Canada)")
+    parser.add_argument('--tile-size', type=int, default=4096, help="Tile edge length in pixels, 0 builds the whole grid in memory")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Number of worker processes for tiles")
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    setup_metrics(args)
 
     # Change this variable as necessary
     directory = "/projects/arctic/share/ABoVE_Biomass"
 
     # Run script
-    create_na_mask(args.type, directory)
+    with stage('create_na_mask', type=args.type, tile_size=args.tile_size, workers=args.workers):
+        if args.tile_size > 0:
+            create_na_mask_windowed(args.type, directory, args.tile_size, args.workers)
+        else:
+            create_na_mask(args.type, directory)
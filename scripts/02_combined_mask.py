@@ -1,9 +1,15 @@
+import argparse
 import rasterio
 import numpy as np
 from rasterio.warp import reproject, Resampling
 from rasterio.transform import from_origin
+from rasterio.windows import Window
+from mask_tools import MaskIndexBuilder
+from raster_output import OutputFormat, add_output_format_arguments
+from run_metrics import add_metrics_arguments, setup_metrics, stage
 
-def combine_masks(mask_path_1, mask_path_2, output_path):
+def combine_masks(mask_path_1, mask_path_2, output_path, output_format=None):
+    output_format = output_format or OutputFormat(resampling='nearest')
     with rasterio.open(mask_path_1) as src1, rasterio.open(mask_path_2) as src2:
         # Step 1: Get the combined extent
         min_x = min(src1.bounds.left, src2.bounds.left)
@@ -61,15 +67,31 @@ def combine_masks(mask_path_1, mask_path_2, output_path):
         # Step 5: Combine masks using logical AND (keep valid data where either mask is 0)
         combined_mask = np.logical_and(resampled_mask_1, resampled_mask_2).astype(np.uint8)
 
-        # Step 6: Write the combined mask
-        with rasterio.open(output_path, 'w', **target_profile) as dst:
+        # Step 6: Write the combined mask (with overviews unless the layout is "source")
+        with rasterio.open(output_format.write_path(output_path), 'w', **output_format.profile(target_profile)) as dst:
             dst.write(combined_mask, 1)
+            output_format.finish(dst)
+        output_format.finalize(output_path)
 
     print(f"Combined mask saved to: {output_path}")
 
-# Usage
-directory = "/projects/arctic/share/ABoVE_Biomass"
-mask_path_1 = f"{directory}/OtherSpatialDatasets/CommonNA_ABoVE_Mask.tif"
-mask_path_2 = f"{directory}/OtherSpatialDatasets/CommonNA_Canada_Mask.tif"
-output_path = f"{directory}/OtherSpatialDatasets/Combined_Mask.tif"
-combine_masks(mask_path_1, mask_path_2, output_path)
+    # Step 7: Save the tile index used to skip fully masked or valid blocks downstream
+    index = MaskIndexBuilder(target_height, target_width)
+    index.update(Window(0, 0, target_width, target_height), combined_mask)
+    index.save(output_path)
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Combine Common NA Masks Script")
+    add_output_format_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    # Usage
+    directory = "/projects/arctic/share/ABoVE_Biomass"
+    mask_path_1 = f"{directory}/OtherSpatialDatasets/CommonNA_ABoVE_Mask.tif"
+    mask_path_2 = f"{directory}/OtherSpatialDatasets/CommonNA_Canada_Mask.tif"
+    output_path = f"{directory}/OtherSpatialDatasets/Combined_Mask.tif"
+    with stage('combine_masks', output=output_path, format=args.output_format):
+        combine_masks(mask_path_1, mask_path_2, output_path, OutputFormat.from_args(args, resampling='nearest'))
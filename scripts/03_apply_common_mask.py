@@ -1,10 +1,172 @@
+import argparse
+import itertools
 import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import rasterio
 import numpy as np
-from rasterio.warp import reproject, Resampling
 import traceback
+from checkpoints import BlockCheckpoint, checkpoint_key, file_fingerprint
+from job_memory import gdal_cache_bytes, plan_concurrency
+from mask_tools import TILE_MASKED, TILE_VALID, MaskAligner, load_mask_index
+from raster_output import OutputFormat, add_output_format_arguments
+from run_metrics import add_metrics_arguments, setup_metrics, stage, block, window_fields
 
-def apply_na_mask(dataset_path, mask_path, name):
+def get_output_profile(src, dataset_path):
+    """
+    Builds the profile of the masked output and the nodata value written to it
+
+    Args:
+        src (DatasetReader): The open dataset
+        dataset_path (str): Path to the dataset
+
+    Returns:
+        tuple: A tuple containg:
+            - profile (dict): Profile of the masked output
+            - nodata (float): NoData value of the masked output
+    """
+    nodata = src.nodata if src.nodata is not None else np.nan
+    profile = src.profile
+
+    # This is just for Duncanson to ensure proper processing
+    if os.path.basename(dataset_path) == "Duncanson2025_102001.tif":
+        profile.update({'BIGTIFF': 'YES'})
+        profile.update({'tiled': True})
+
+    # Ensure the dataset is float and update the NoData value
+    if np.isnan(nodata):
+        print(f"NoData value is nan in {dataset_path}. Defaulting to 0.0.")
+        nodata = 0.0
+        profile.update({'nodata': 0.0, 'dtype': rasterio.float32})
+    else:
+        profile.update({'nodata': float(nodata)})  # Ensure nodata is explicitly set
+    return profile, nodata
+
+def get_output_path(dataset_path, name):
+    """
+    Returns the path of the masked output, `<dataset>_masked_<name>.tif`
+    """
+    dir_name, base_name = os.path.split(dataset_path)
+    return os.path.join(dir_name, base_name.replace('.tif', f'_masked_{name}.tif'))
+
+class BlockError(Exception):
+    """
+    Raised when masking a block fails, carrying the block's indices and window so the
+    failure is reported for the right block even when blocks are masked on threads
+    """
+
+    def __init__(self, ji, window):
+        super().__init__(f"Masking block {ji} failed")
+        self.ji = ji
+        self.window = window
+
+def mask_block(src, aligner, window, nodata):
+    """
+    Reads one window of a dataset and sets the pixels under the common NA mask
+    (and any NaN) to nodata
+
+    Args:
+        src (DatasetReader): The open dataset
+        aligner (MaskAligner): Reads the common NA mask aligned to the dataset
+        window (Window): The window to process
+        nodata (float): NoData value of the masked output
+
+    Returns:
+        original_data (numpy.ndarray): The masked data of the window
+    """
+    with block('mask_block', **window_fields(window)) as record:
+        # Fully masked windows are all nodata, no need to read them
+        status = aligner.window_status(window)
+        record['status'] = int(status)
+        if status == TILE_MASKED:
+            return np.full((window.height, window.width), nodata, dtype=src.dtypes[0])
+
+        # Read the data for this window
+        original_data = src.read(1, window=window)
+        record['pixels'] = original_data.size
+
+        # Ensure NoData values are consistent (replace nans with nodata)
+        original_data = np.nan_to_num(original_data, nan=nodata)
+
+        # Fully valid windows only need their NaNs replaced
+        if status == TILE_VALID:
+            return original_data
+
+        # Get the mask for the current window
+        mask_aligned = aligner.read(window)
+
+        # Apply the mask to the data
+        mask_bool = mask_aligned.astype(bool)
+        original_data[mask_bool] = nodata
+
+        # Replace any remaining NaN values in the data with the nodata value
+        return np.nan_to_num(original_data, nan=nodata)
+
+def mask_indexed_block(src, aligner, ji, window, nodata):
+    """
+    Runs `mask_block` on the window `ji`, raising a `BlockError` for that window when it fails
+    """
+    try:
+        return mask_block(src, aligner, window, nodata)
+    except Exception as e:
+        raise BlockError(ji, window) from e
+
+def iter_masked_blocks(dataset_path, mask_path, windows, nodata, workers, lookups=None, index=None, max_inflight=None):
+    """
+    Masks windows of a dataset on a pool of threads and yields them in the order of
+    `windows`. Each thread keeps its own open dataset and mask (rasterio handles are
+    not thread safe), and GDAL releases the GIL while reading and warping, so reads
+    and mask warps of different windows overlap. At most `max_inflight` windows are
+    queued, which bounds memory
+
+    Args:
+        dataset_path (str): Path to the dataset
+        mask_path (str): Path to common NA mask
+        windows (iterable of tuple): `(ji, window)` pairs, e.g. from `block_windows`
+        nodata (float): NoData value of the masked output
+        workers (int): Number of threads
+        lookups (tuple or None): Mask lookups shared by the threads' `MaskAligner`s
+        index (MaskIndex or None): Tile index of the mask shared by the threads
+        max_inflight (int or None): Limit of queued windows, default `4 * workers`
+
+    Yields:
+        tuple: `(ji, window, masked_data)` in the order of `windows`. A failed window
+        raises a `BlockError` naming it
+    """
+    max_inflight = max_inflight or 4 * workers
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def process(ji, window):
+        if not hasattr(local, 'src'):
+            local.src = rasterio.open(dataset_path)
+            local.mask_src = rasterio.open(mask_path)
+            local.aligner = MaskAligner(local.mask_src, local.src, lookups, index)
+            with handles_lock:
+                handles.extend([local.src, local.mask_src])
+        return mask_indexed_block(local.src, local.aligner, ji, window, nodata)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for ji, window in windows:
+                pending.append((ji, window, executor.submit(process, ji, window)))
+                if len(pending) >= max_inflight:
+                    ji, window, future = pending.popleft()
+                    yield ji, window, future.result()
+            while pending:
+                ji, window, future = pending.popleft()
+                yield ji, window, future.result()
+    finally:
+        for handle in handles:
+            handle.close()
+
+def apply_na_mask(dataset_path, mask_path, name, workers=1, output_format=None, output_path=None,
+                  checkpoint_interval=None):
     """
     Apply a single mask to a dataset, preserving the dataset's original resolution and extent.
     Save the masked dataset to a new file.
@@ -13,83 +175,218 @@ def apply_na_mask(dataset_path, mask_path, name):
         dataset_path (str): Path to dataset to apply common mask to (should be of type `.tif`)
         mask_path (str): Path to common NA mask (should be of type `.tif`)
         name (str): Name of which type of mask was applied
+        workers (int): Number of threads masking blocks. Blocks are always written
+                       in order by one writer, so the output is the same for any value
+        output_format (OutputFormat or None): Layout of the output, the input's layout when None
+        output_path (str or None): Path of the output, `get_output_path` when None
+        checkpoint_interval (float or None): Seconds between checkpoints, None to disable.
+                                             At a checkpoint the output is closed (flushing
+                                             its blocks) and the number of written blocks
+                                             saved to `<output>.checkpoint`, so a rerun with
+                                             the same inputs continues from there
+
+    Returns:
+        output_path (str or None): The masked dataset, None when masking failed
     """
+    output_format = output_format or OutputFormat()
     with rasterio.open(dataset_path) as src:
         # Read the dataset metadata
-        dataset_crs = src.crs
-        nodata = src.nodata if src.nodata is not None else np.nan
-        profile = src.profile
-
-        # This is just for Duncanson to ensure proper processing
-        if os.path.basename(dataset_path) == "Duncanson2025_102001.tif":
-            profile.update({'BIGTIFF': 'YES'})
-            profile.update({'tiled': True})
-
-        # Ensure the dataset is float and update the NoData value
-        if np.isnan(nodata):
-            print(f"NoData value is nan in {dataset_path}. Defaulting to 0.0.")
-            nodata = 0.0
-            profile.update({'nodata': 0.0, 'dtype': rasterio.float32})
-        else:
-            profile.update({'nodata': float(nodata)})  # Ensure nodata is explicitly set
-        
+        profile, nodata = get_output_profile(src, dataset_path)
+        profile = output_format.profile(profile)
+
         # Prepare output file path
-        dir_name, base_name = os.path.split(dataset_path)
-        output_path = os.path.join(dir_name, base_name.replace('.tif', f'_masked_{name}.tif'))
+        output_path = output_path or get_output_path(dataset_path, name)
+        write_path = output_format.write_path(output_path)
+
+        checkpoint, completed, failed = None, 0, False
+        if checkpoint_interval is not None:
+            key = checkpoint_key(dataset=file_fingerprint(dataset_path), mask=file_fingerprint(mask_path),
+                                 output_format=str(output_format), output=write_path)
+            checkpoint = BlockCheckpoint(f"{write_path}.checkpoint", key, checkpoint_interval)
+            completed, _ = checkpoint.load()
+            if completed and not os.path.exists(write_path):
+                completed = 0
 
         # Open the mask raster
-        with rasterio.open(mask_path) as mask_src, rasterio.open(output_path, 'w', **profile) as dst:
+        with rasterio.open(mask_path) as mask_src:
+            dst = rasterio.open(write_path, 'r+') if completed else rasterio.open(write_path, 'w', **profile)
+            ji, window, original_data = None, None, None
+            # Map dataset pixels to mask pixels once instead of warping the mask per block
+            # and use the mask's tile index to skip fully masked or fully valid blocks
+            aligner = MaskAligner(mask_src, src, index=load_mask_index(mask_path))
+            if aligner.lookups is None:
+                print(f"Mask {mask_path} is not index aligned with {dataset_path}, reprojecting it per block")
+            # Write whole output tiles when the layout differs from the input's, so no
+            # compressed tile is written twice
+            windows = src.block_windows(1) if output_format.format == 'source' else list(dst.block_windows(1))
+            windows = itertools.islice(windows, completed, None)
             try:
-                for ji, window in src.block_windows(1):
-                    # Read the data for this window
-                    original_data = src.read(1, window=window)
-
-                    # Ensure NoData values are consistent (replace nans with nodata)
-                    original_data = np.nan_to_num(original_data, nan=nodata)
-
-                    # Create a np array similar to the original data to fill in with masked values
-                    mask_aligned = np.empty_like(original_data, dtype=np.uint8)
-
-                    # Reproject the mask to align with the current window
-                    reproject(
-                        source=rasterio.band(mask_src, 1),
-                        destination=mask_aligned,
-                        src_transform=mask_src.transform,
-                        src_crs=mask_src.crs,
-                        dst_transform=src.window_transform(window),
-                        dst_crs=dataset_crs,
-                        dst_width=window.width,
-                        dst_height=window.height,
-                        resampling=Resampling.nearest
-                    )
-
-                    # Apply the mask to the data
-                    mask_bool = mask_aligned.astype(bool)
-                    original_data[mask_bool] = nodata
-
-                    # Replace any remaining NaN values in the data with the nodata value
-                    original_data = np.nan_to_num(original_data, nan=nodata)
-
+                if workers > 1:
+                    blocks = iter_masked_blocks(dataset_path, mask_path, windows, nodata, workers,
+                                                aligner.lookups, aligner.index)
+                else:
+                    blocks = ((ji, window, mask_indexed_block(src, aligner, ji, window, nodata))
+                              for ji, window in windows)
+                for completed, (ji, window, original_data) in enumerate(blocks, start=completed + 1):
                     # Write the masked data for this window
-                    dst.write(original_data, 1, window=window)
+                    with block('write_block', **window_fields(window)):
+                        dst.write(original_data, 1, window=window)
+                    if checkpoint is not None and checkpoint.due():
+                        # Closing flushes the written blocks, only then are they recorded
+                        dst.close()
+                        checkpoint.save(completed)
+                        dst = rasterio.open(write_path, 'r+')
+                output_format.finish(dst)
 
             # Something happened when processing the raster
             except Exception as e:
                 error_details = traceback.format_exc()
+                if isinstance(e, BlockError):
+                    # Masking failed, report that block rather than the last one written
+                    ji, window, original_data, e = e.ji, e.window, None, e.__cause__
                 print(f"Error processing raster: {dataset_path}")
-                print(f"Window indices: {ji}")  # Show the indices of the block being processed
-                print(f"Window size: {window.width}x{window.height}")  # Show window size
-                print(f"Window: {window}")
-                print(f"Original data shape: {original_data.shape}")  # Show data shape
+                if window is not None:
+                    print(f"Window indices: {ji}")  # Show the indices of the block being processed
+                    print(f"Window size: {window.width}x{window.height}")  # Show window size
+                    print(f"Window: {window}")
+                if original_data is not None:
+                    print(f"Original data shape: {original_data.shape}")  # Show data shape
                 print(f"Nodata value: {nodata}")  # Show the nodata value being used
                 print(f"Error Message: {e}")  # Show the error message
                 print("Traceback:")
                 print(error_details)  # Show the full traceback
+                failed = True
+            finally:
+                dst.close()
+
+    if failed:
+        # A checkpoint resumes from the partial output, otherwise it is of no use
+        if checkpoint is None:
+            output_format.discard(output_path)
+        return None
+
+    output_format.finalize(output_path)
+    if checkpoint is not None:
+        checkpoint.remove()
+    print(f"Masked dataset saved to: {output_path} ({output_format})")
+    return output_path
+
+def estimate_job_memory(dataset_path, workers):
+    """
+    Estimates the peak memory of `apply_na_mask` on a dataset: every queued window
+    holds the block, its float copy and the aligned mask, plus GDAL's block cache
+    (`GDAL_CACHEMAX` in MB, 512 MB when unset or given as a percentage)
+
+    Args:
+        dataset_path (str): Path to the dataset
+        workers (int): Number of threads masking blocks
+
+    Returns:
+        estimate (int): Estimated memory in bytes
+    """
+    with rasterio.open(dataset_path) as src:
+        block_height, block_width = src.block_shapes[0]
+        itemsize = max(np.dtype(src.dtypes[0]).itemsize, 4)
+    block_bytes = block_height * block_width * (2 * itemsize + 1)
+    return 4 * workers * block_bytes + gdal_cache_bytes()
+
+def apply_na_mask_job(dataset_path, mask_path, name, workers, output_format, checkpoint_interval):
+    """
+    Runs `apply_na_mask` on one dataset of `apply_na_masks` as a metrics stage
+    """
+    with stage('apply_na_mask', dataset=dataset_path, type=name, format=str(output_format), workers=workers):
+        return apply_na_mask(dataset_path, mask_path, name, workers, output_format,
+                             checkpoint_interval=checkpoint_interval)
 
-    print(f"Masked dataset saved to: {output_path}")
+def apply_na_masks(jobs, workers=1, memory_budget=None, output_format=None, checkpoint_interval=None):
+    """
+    Applies masks to several datasets at once. Datasets run in separate processes,
+    largest first, and share the `workers` threads between them. No more datasets
+    run at once than fit in `memory_budget`
+
+    Args:
+        jobs (list of tuple): `(dataset_path, mask_path, name)` for every dataset
+        workers (int): Total number of threads across all datasets
+        memory_budget (int or None): Memory limit in bytes, None for no limit
+        output_format (OutputFormat or None): Layout of the outputs, see `apply_na_mask`
+        checkpoint_interval (float or None): Seconds between block checkpoints, see `apply_na_mask`
+    """
+    jobs = sorted(jobs, key=lambda job: os.path.getsize(job[0]), reverse=True)
+    concurrent, threads = plan_concurrency(jobs, workers, memory_budget,
+                                           lambda job, threads: estimate_job_memory(job[0], threads))
+    print(f"Masking {len(jobs)} datasets, {concurrent} at a time with {threads} threads each")
+
+    if concurrent == 1:
+        for dataset_path, mask_path, name in jobs:
+            apply_na_mask_job(dataset_path, mask_path, name, threads, output_format, checkpoint_interval)
+        return
+    with ProcessPoolExecutor(max_workers=concurrent) as executor:
+        futures = [executor.submit(apply_na_mask_job, dataset_path, mask_path, name, threads, output_format,
+                                   checkpoint_interval)
+                   for dataset_path, mask_path, name in jobs]
+        for future in as_completed(futures):
+            future.result()
+
+
+# Output layouts compared by `benchmark_output_formats`
+BENCHMARK_FORMATS = [OutputFormat('source'),
+                     OutputFormat('tiled', 256, 'deflate'), OutputFormat('tiled', 512, 'deflate'),
+                     OutputFormat('tiled', 256, 'zstd'), OutputFormat('tiled', 512, 'zstd'),
+                     OutputFormat('tiled', 1024, 'zstd'), OutputFormat('cog', 512, 'zstd')]
+
+def benchmark_output_formats(dataset_path, mask_path, workers=1, formats=None, output_dir=None):
+    """
+    Masks one dataset with every output layout and prints the write time and file
+    size of each, with the size relative to the first layout that succeeded.
+    Outputs are written to a temporary directory and removed
+
+    Args:
+        dataset_path (str): Path to the dataset
+        mask_path (str): Path to common NA mask
+        workers (int): Number of threads masking blocks
+        formats (list of OutputFormat or None): Layouts to compare, `BENCHMARK_FORMATS` when None
+        output_dir (str or None): Directory for the outputs, e.g. on the same file
+                                  system as the real outputs
+
+    Returns:
+        results (list of tuple): `(format, seconds, bytes)` for every layout, with None
+                                 seconds and bytes for a layout that failed
+    """
+    results = []
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        for i, output_format in enumerate(formats or BENCHMARK_FORMATS):
+            output_path = os.path.join(tmp_dir, f"benchmark_{i}.tif")
+            start = time.perf_counter()
+            if apply_na_mask(dataset_path, mask_path, 'benchmark', workers, output_format, output_path) is None:
+                results.append((str(output_format), None, None))
+                continue
+            seconds = time.perf_counter() - start
+            results.append((str(output_format), seconds, os.path.getsize(output_path)))
+            os.remove(output_path)
+
+    print(f"Output formats for {dataset_path}:")
+    print(f"{'Format':<24}{'Write (s)':>12}{'Size (MB)':>12}{'Ratio':>12}")
+    base = next((size for _, _, size in results if size is not None), None)
+    for label, seconds, size in results:
+        if size is None:
+            print(f"{label:<24}{'failed':>12}")
+            continue
+        print(f"{label:<24}{seconds:>12.1f}{size / 1024**2:>12.1f}{size / base:>12.2f}")
+    return results
 
 
 if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Apply Common NA Mask Script")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Total number of threads")
+    parser.add_argument('--memory-budget', type=float, default=None, help="Memory limit in GB for datasets masked at once")
+    parser.add_argument('--checkpoint-interval', type=float, default=None, help="Seconds between block checkpoints, a rerun resumes an interrupted dataset from its last checkpoint")
+    add_output_format_arguments(parser)
+    add_metrics_arguments(parser)
+    parser.add_argument('--benchmark', type=str, nargs=2, metavar=('DATASET', 'MASK'), default=None, help="Compare write time and size of the output formats on one dataset instead of masking")
+    args = parser.parse_args()
+    setup_metrics(args)
+
     # Change this variable as necessary
     directory = "/projects/arctic/share/ABoVE_Biomass"
 
@@ -107,14 +404,13 @@ if __name__ == "__main__":
                             f"{directory}/Duncanson2025/Duncanson2025_102001.tif",
                             f"{directory}/Xu2021/Xu2021_102001.tif"]
 
-    # Apply ABoVE mask to ABoVE datasets
-    for dataset in above_datasets:
-        apply_na_mask(dataset, above_mask, 'ABoVE')
-
-    # Apply Canada mask to Canada datasets
-    for dataset in canada_datasets:
-        apply_na_mask(dataset, canada_mask, 'Canada')
-    
-    # Apply both masks to datasets where they both apply
-    for dataset in combined_datasets:
-        apply_na_mask(dataset, combined_mask, 'Combined')
+    # Apply ABoVE mask to ABoVE datasets, Canada mask to Canada datasets
+    # and both masks to datasets where they both apply
+    jobs = ([(dataset, above_mask, 'ABoVE') for dataset in above_datasets]
+            + [(dataset, canada_mask, 'Canada') for dataset in canada_datasets]
+            + [(dataset, combined_mask, 'Combined') for dataset in combined_datasets])
+    memory_budget = int(args.memory_budget * 1024**3) if args.memory_budget else None
+    if args.benchmark:
+        benchmark_output_formats(*args.benchmark, args.workers, output_dir=os.path.dirname(args.benchmark[0]))
+    else:
+        apply_na_masks(jobs, args.workers, memory_budget, OutputFormat.from_args(args), args.checkpoint_interval)
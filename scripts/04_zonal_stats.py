@@ -1,147 +1,1081 @@
 import argparse
+import copy
 import os
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 from multiprocessing import Pool
 import rasterio
 import geopandas as gpd
 import numpy as np
-from rasterio.mask import mask
+from affine import Affine
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.warp import Resampling
+from rasterio.windows import Window, bounds as window_bounds
+import shapely
 from shapely.geometry import shape
+from shapely import STRtree
 from shapely.geometry import box
+from checkpoints import BlockCheckpoint, checkpoint_key, file_fingerprint
+from mask_tools import TILE_MASKED, TILE_MIXED, TILE_VALID, Grid, MaskAligner, load_mask_index
+from raster_output import add_external_overviews
+from results_store import append_results, get_txt_name, results_table, write_txt
+from run_metrics import add_metrics_arguments, setup_metrics, stage, block, window_fields
+from tiling import iter_tiles
+from zonal_accumulators import ExactQuantiles, ZonalAccumulator
+from zone_labels import (build_zone_labels, get_zone_column, get_zone_labels, iter_read_windows, rasterize_zones,
+                         zone_label_key)
 
-def process_zone(zone_row, src, file_type, coverage_ratio):
+def select_band(raster_file, count):
     """
-    Processes a geographic zone to extract raster statistics based on coverage
-    within the zone's geometry
+    Returns the band used for statistics in a multi-band raster. Duncanson2025 and
+    Xu2021 keep the estimate in the first band, the other datasets in the last band
 
     Args:
-        zone_row (Geoseries): A row from a geoDataFrame representing a geographic zone
-                              Must include a `geometry` column and column for zone ID
-        src (str): File path to the input raster file
-        file_type (str): The type of geographic zone dataset
-                            - `Canada`: Uses the `postal` column for zone ID
-                            - `EPA2`: Uses the `NA_L2KEY` column for zone identification
-        coverage_ratio (float): The minimum faction of the zone's area that must be covered
-                                by valid raster data for the zone to be included in results
-    
+        raster_file (str): File path to the input raster file
+        count (int): Number of bands in the raster
+
+    Returns:
+        bidx (int): 1-based band index
+    """
+    if count > 1 and raster_file.split('/')[-2] not in ('Duncanson2025', 'Xu2021'):
+        return count
+    return 1
+
+def get_read_nodata(src, bidx, apply_mask=False):
+    """
+    Returns the NoData value and data type raster values are compared in. When a
+    mask is applied on the fly to a raster without NoData (or NaN NoData) this is
+    0.0 in float32, like in the masked copy written by `03_apply_common_mask.py`
+
     Returns:
         tuple: A tuple containg:
-            - zone_name (str): Name of zone
-            - mean (float or None): Mean of raster values within zone
-            - median (float or None): Median of raster values within zone
-            - sum (float or None): the sum of raster values within the zone
-            - std (float or None): The standard deviation of the raster values within the zone
-    """
-    # Get the geometry and zone name
-    geometry = zone_row['geometry']
-    if file_type == 'Canada':
-        zone_name = zone_row['postal']
-    elif file_type == 'EPA2':
-        zone_name = zone_row['NA_L2KEY']
-
-    try: 
-        # Mask raster by geometry
-        with rasterio.open(src) as file:
-            file_bounds = box(*file.bounds)
-            # Check for intersection with the zone shape
-            if not file_bounds.intersects(box(*geometry.bounds)):
-                print(f"Shape {zone_name} does not intersect raster, skipping.")
-                return (zone_name, None, None, None, None, None)
-            try:
-                # Get a mask of the zone shape area from the original raster
-                out_image, out_transform = mask(file, [geometry], crop=True)
-                no_data_value = file.nodata
-                pixel_area = file.res[0] * file.res[1]
-            # There was an error in processing
-            except ValueError as e:
-                print(f"Error processing {zone_name}: {e}")
-                return (zone_name, None, None, None, None, None)
-    except Exception as e:
-        print(f"Failed to open raster {src}: {e}")
-
-    # Flatten, remove NoData, calculate percentage of shape covered by valid data
-    if out_image.shape[0] > 1:  # If multi-band
-        print("Multiband dataset")
-        if src.split('/')[-2] == 'Duncanson2025' or src.split('/')[-2] == 'Xu2021':
-            out_image = out_image[0].flatten() # Assume get first row
+            - no_data_value (float or None): NoData value of the values
+            - dtype (str): Data type of the values
+    """
+    no_data_value = src.nodata
+    dtype = src.dtypes[bidx - 1]
+    if apply_mask and (no_data_value is None or np.isnan(no_data_value)):
+        # The masked copy stores NaN as 0.0 in float32, so 0.0 becomes nodata
+        no_data_value = 0.0
+        dtype = 'float32'
+    return no_data_value, dtype
+
+def is_valid(data, no_data_value):
+    """
+    Returns True where raster values are neither NaN nor `no_data_value`
+    """
+    if no_data_value is None or np.isnan(no_data_value):
+        return ~np.isnan(data)
+    return (data != no_data_value) & ~np.isnan(data)
+
+def read_valid_blocks(src, label_src, bidx, aligner=None, apply_mask=False, windows=None):
+    """
+    Reads a raster and its zone label raster chunk by chunk and yields the zone
+    label and value of every valid pixel that falls in a zone
+
+    Args:
+        src (DatasetReader): The open dataset
+        label_src (DatasetReader): The open zone label raster on the dataset's grid
+        bidx (int): Band of the dataset to read
+        aligner (MaskAligner or None): The common NA mask of the dataset. Chunks its
+                                       tile index marks as fully masked are skipped
+        apply_mask (bool): Apply the mask on the fly to an unmasked dataset, giving the
+                           same valid pixels as `03_apply_common_mask.py` output would
+        windows (iterable of Window or None): Chunks to read, `iter_read_windows` when None
+
+    Yields:
+        tuple: A tuple containg:
+            - labels (numpy.ndarray): 1-based zone labels of the valid pixels
+            - values (numpy.ndarray): Raster values of the valid pixels
+    """
+    no_data_value, dtype = get_read_nodata(src, bidx, apply_mask)
+    if windows is None:
+        windows = iter_read_windows(src, bidx=bidx)
+    for window in windows:
+        with block('zone_chunk', **window_fields(window)) as record:
+            status = aligner.window_status(window) if aligner is not None else TILE_MIXED
+            record['status'] = int(status)
+            if status == TILE_MASKED:
+                continue  # Only nodata left in this chunk
+            labels = label_src.read(1, window=window)
+            in_zone = labels > 0
+            if not in_zone.any():
+                continue
+            data = src.read(bidx, window=window).astype(dtype, copy=False)
+            record['pixels'] = data.size
+            valid = in_zone & is_valid(data, no_data_value)
+            if apply_mask and status != TILE_VALID:
+                valid &= ~aligner.read(window).astype(bool)
+        yield labels[valid], data[valid]
+
+def accumulate_zones(raster_file, label_path, n_labels, quantiles=(0.5,), quantile_method='sketch', quantile_error=0.005,
+                     mask_path=None, apply_mask=False, checkpoint=None):
+    """
+    Scans a raster and its zone label raster chunk by chunk and accumulates
+    per-zone statistics without holding the pixels of a zone in memory
+
+    Args:
+        raster_file (str): Path to the input raster file
+        label_path (str): Path to the zone label raster made by `build_zone_labels`
+        n_labels (int): Number of labels including the unused label 0
+        quantiles (list of float): Quantiles in [0, 1] to estimate per zone
+        quantile_method (str): How quantiles are found
+                                - "sketch": From a log-bucket sketch in the same scan
+                                - "exact": With a second scan (radix select)
+        quantile_error (float): Relative error bound of the sketch
+        mask_path (str or None): Common NA mask of the raster, whose tile index lets
+                                 fully masked chunks be skipped
+        apply_mask (bool): Apply `mask_path` on the fly to an unmasked raster instead
+                           of reading a masked copy
+        checkpoint (BlockCheckpoint or None): Saves the accumulated statistics and the
+                                              chunks done, so an interrupted scan resumes
+
+    Returns:
+        tuple: A tuple containg:
+            - accumulator (ZonalAccumulator): Exact moments and the quantile sketch
+            - estimates (numpy.ndarray): Quantiles per label, shape (labels, quantiles)
+    """
+    accumulator = ZonalAccumulator(n_labels, relative_error=quantile_error)
+    exact = ExactQuantiles(n_labels) if quantile_method == 'exact' else None
+    scan, completed = 1, 0
+    if checkpoint is not None:
+        completed, state = checkpoint.load()
+        if state is not None:
+            scan, accumulator, exact = state
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(raster_file))
+        label_src = stack.enter_context(rasterio.open(label_path))
+        bidx = select_band(raster_file, src.count)
+        aligner = None
+        if mask_path is not None:
+            index = load_mask_index(mask_path)
+            if index is None:
+                print(f"No tile index for {mask_path}, reading every chunk")
+            if index is not None or apply_mask:
+                aligner = MaskAligner(stack.enter_context(rasterio.open(mask_path)), src, index=index)
+        if apply_mask:
+            print(f"Applying mask {mask_path} on the fly")
+
+        windows = list(iter_read_windows(src, bidx=bidx))
+
+        def scan_chunks(number, update):
+            start = completed if scan == number else 0
+            for i in range(start, len(windows)):
+                for labels, values in read_valid_blocks(src, label_src, bidx, aligner, apply_mask, windows[i:i + 1]):
+                    update(labels, values)
+                if checkpoint is not None and checkpoint.due():
+                    checkpoint.save(i + 1, (number, accumulator, exact))
+
+        def update_first(labels, values):
+            accumulator.update(labels, values)
+            if exact is not None:
+                exact.update(labels, values)
+
+        if scan == 1:
+            scan_chunks(1, update_first)
+        if exact is None:
+            print(accumulator.error_report())
+            estimates = accumulator.quantiles(quantiles)
         else:
-            out_image = out_image[-1].flatten() # Get the last row
-    else:
-        out_image = out_image.flatten()
-    if np.isnan(no_data_value):
-        valid_data = out_image[~np.isnan(out_image)]
-    else:
-        valid_data = out_image[out_image != no_data_value]
-    valid_pixels = valid_data.size
-    valid_area = valid_pixels * pixel_area
-    geometry_area = geometry.area
-    actual_cover = valid_area / geometry_area
-
-    # Check if the raster actually covers the zone well
-    if not np.isnan(actual_cover):
+            # Second scan for the exact quantiles
+            if scan == 1:
+                exact.prepare(quantiles)
+            if accumulator.count.any():
+                scan_chunks(2, exact.update_low)
+            estimates = exact.quantiles()
+    if checkpoint is not None:
+        checkpoint.remove()
+    return accumulator, estimates
+
+def get_preview_grid(src, level):
+    """
+    Returns the grid of a raster decimated by `2**level`, covering the same bounds
+    like a GDAL overview of that level
+
+    Returns:
+        tuple: A tuple containg:
+            - transform (Affine): The affine transformation of the preview grid
+            - width (int): The width of the preview grid in pixels
+            - height (int): The height of the preview grid in pixels
+    """
+    factor = 2 ** level
+    width = max(1, -(-src.width // factor))
+    height = max(1, -(-src.height // factor))
+    transform = src.transform * Affine.scale(src.width / width, src.height / height)
+    return transform, width, height
+
+def check_preview_overviews(raster_file, level, build_overviews=False):
+    """
+    Makes sure the decimated reads of a preview are served from nearest resampled
+    overviews, so only a fraction of the full resolution data is read. Averaged
+    overviews are not used: a coarse pixel of them is valid when any of its pixels
+    is, which inflates coverage and sums
+
+    Args:
+        raster_file (str): Path to the input raster file
+        level (int): Preview level, pixels are `2**level` times larger per side
+        build_overviews (bool): Build missing overviews into `<raster>.ovr`, see
+                                `raster_output.add_external_overviews`
+
+    Raises:
+        ValueError: When the raster has no usable overviews, since a decimated read
+                    without them still decompresses every full resolution block
+    """
+    with rasterio.open(raster_file) as src:
+        overviews = src.overviews(1)
+        resampling = src.tags(ns='rio_overview').get('resampling', 'nearest')
+    if overviews and resampling != 'nearest':
+        raise ValueError(f"Overviews of {raster_file} use {resampling} resampling, which inflates coverage and sums. "
+                         "Write it with --overview-resampling nearest to preview it")
+    if not overviews:
+        if not build_overviews:
+            raise ValueError(f"{raster_file} has no overviews, a preview would read every full resolution block. "
+                             "Pass --build-overviews to build nearest resampled ones first")
+        add_external_overviews(raster_file, 2 ** level)
+
+def read_grid_window(src, bidx, tree, geometries, grid, window, aligner=None, apply_mask=False):
+    """
+    Reads one window of a grid covering a raster, at the raster's resolution or
+    coarser: the raster is read decimated to the window's shape with nearest
+    resampling (from its overviews when coarser) and the zones are burned on the
+    grid directly
+
+    Args:
+        src (DatasetReader): The open dataset
+        bidx (int): Band of the dataset to read
+        tree (STRtree): Spatial index of `geometries`
+        geometries (list of shapely.Geometry): Zone geometries, in label order
+        grid (Grid): Grid with the dataset's bounds, see `get_preview_grid`
+        window (Window): Window of `grid` to read
+        aligner (MaskAligner or None): The common NA mask aligned to `grid`. Windows
+                                       its tile index marks as fully masked are skipped
+        apply_mask (bool): Apply the mask on the fly, see `read_valid_blocks`
+
+    Returns:
+        tuple or None: `(labels, values)` of the valid pixels in a zone, see
+        `read_valid_blocks`, or None when the window has none
+    """
+    status = aligner.window_status(window) if aligner is not None else TILE_MIXED
+    if status == TILE_MASKED:
+        return None
+    out_shape = (window.height, window.width)
+    labels = rasterize_zones(tree, geometries, out_shape, grid.window_transform(window))
+    if labels is None:
+        return None
+    in_zone = labels > 0
+    if not in_zone.any():
+        return None
+    no_data_value, dtype = get_read_nodata(src, bidx, apply_mask)
+    scale_x, scale_y = src.width / grid.width, src.height / grid.height
+    source_window = Window(window.col_off * scale_x, window.row_off * scale_y, window.width * scale_x, window.height * scale_y)
+    data = src.read(bidx, window=source_window, out_shape=out_shape,
+                    resampling=Resampling.nearest).astype(dtype, copy=False)
+    valid = in_zone & is_valid(data, no_data_value)
+    if apply_mask and status != TILE_VALID:
+        valid &= ~aligner.read(window).astype(bool)
+    return labels[valid], data[valid]
+
+def accumulate_zones_preview(raster_file, geometries, level, quantiles=(0.5,), quantile_error=0.005, mask_path=None,
+                             apply_mask=False, chunk_size=2048, build_overviews=False):
+    """
+    Accumulates per-zone statistics from a raster read at `1/2**level` of its
+    resolution from its nearest resampled overviews, see `check_preview_overviews`.
+    The zones are rasterized on the coarse grid directly, so no full resolution label
+    raster is needed, and the mask is aligned to the coarse grid once
+
+    Args:
+        raster_file (str): Path to the input raster file
+        geometries (list of shapely.Geometry): Zone geometries, in label order
+        level (int): Preview level, pixels are `2**level` times larger per side
+        quantiles (list of float): Quantiles in [0, 1] to estimate per zone
+        quantile_error (float): Relative error bound of the sketch
+        mask_path (str or None): Common NA mask of the raster. Its tile index lets fully
+                                 masked chunks be skipped
+        apply_mask (bool): Apply `mask_path` on the fly to an unmasked raster
+        chunk_size (int): Edge length of a chunk of the coarse grid in pixels
+        build_overviews (bool): Build missing overviews first, see `check_preview_overviews`
+
+    Returns:
+        tuple: A tuple containg:
+            - accumulator (ZonalAccumulator): Statistics of the coarse pixels
+            - estimates (numpy.ndarray): Quantiles per label, shape (labels, quantiles)
+            - pixel_scale (float): Full resolution pixels represented by one coarse pixel
+    """
+    check_preview_overviews(raster_file, level, build_overviews)
+    accumulator = ZonalAccumulator(len(geometries) + 1, relative_error=quantile_error)
+    tree = STRtree(geometries)
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(raster_file))
+        bidx = select_band(raster_file, src.count)
+        grid = Grid(src.crs, *get_preview_grid(src, level))
+        aligner = None
+        if mask_path is not None:
+            mask_src = stack.enter_context(rasterio.open(mask_path))
+            aligner = MaskAligner(mask_src, grid, index=load_mask_index(mask_path))
+        pixel_scale = (src.width / grid.width) * (src.height / grid.height)
+        print(f"Preview level {level}: reading {grid.width} x {grid.height} pixels instead of {src.width} x {src.height}")
+
+        for window in iter_tiles(grid.width, grid.height, chunk_size):
+            pixels = read_grid_window(src, bidx, tree, geometries, grid, window, aligner, apply_mask)
+            if pixels is not None:
+                accumulator.update(*pixels)
+    print(accumulator.error_report())
+    return accumulator, accumulator.quantiles(quantiles), pixel_scale
+
+def get_sample_window(src, geometry, window_size, factor):
+    """
+    Returns a window of at most `window_size` pixels per side centred on a zone's
+    representative point, with offsets that are multiples of `factor` so it covers
+    whole preview pixels
+    """
+    point = geometry.representative_point()
+    row, col = src.index(point.x, point.y)
+    size = max(factor, window_size // factor * factor)
+    col_off = min(max(0, col - size // 2), max(0, src.width - size)) // factor * factor
+    row_off = min(max(0, row - size // 2), max(0, src.height - size)) // factor * factor
+    return Window(col_off, row_off, min(size, src.width - col_off), min(size, src.height - row_off))
+
+def estimate_preview_error(raster_file, geometries, zone_names, accumulator, level, sample_size=3, mask_path=None,
+                           apply_mask=False, seed=0, window_size=2048):
+    """
+    Estimates the error of preview statistics by computing them at full and at preview
+    resolution on the same windows. A window of `window_size` full resolution pixels
+    is placed on each zone of a random sample, so the check reads a few windows
+    however large the zones are
+
+    Args:
+        raster_file (str): Path to the input raster file
+        geometries (list of shapely.Geometry): Zone geometries, in label order
+        zone_names (list of str): Zone names, in label order
+        accumulator (ZonalAccumulator): Preview statistics from `accumulate_zones_preview`,
+                                        zones with valid pixels in it are sampled
+        level (int): Preview level of `accumulator`
+        sample_size (int): Number of zones to sample
+        mask_path (str or None): Common NA mask of the raster, see `accumulate_zones`
+        apply_mask (bool): Apply `mask_path` on the fly, see `accumulate_zones`
+        seed (int): Seed of the zone sample
+        window_size (int): Edge length of a sample window in full resolution pixels
+
+    Returns:
+        errors (list of tuple): `(zone_name, statistic, preview, full, relative_error)`
+        for the mean, sum and coverage of every sampled zone within the sample windows
+    """
+    candidates = np.flatnonzero(accumulator.count[1:] > 0)
+    if len(candidates) == 0 or sample_size <= 0:
+        return []
+    sample = np.sort(np.random.default_rng(seed).choice(candidates, min(sample_size, len(candidates)), replace=False))
+    tree = STRtree(geometries)
+    full = ZonalAccumulator(len(geometries) + 1)
+    preview = ZonalAccumulator(len(geometries) + 1)
+    factor = 2 ** level
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(raster_file))
+        bidx = select_band(raster_file, src.count)
+        full_grid = Grid(src.crs, src.transform, src.width, src.height)
+        preview_grid = Grid(src.crs, *get_preview_grid(src, level))
+        full_aligner, preview_aligner = None, None
+        if mask_path is not None:
+            mask_src = stack.enter_context(rasterio.open(mask_path))
+            index = load_mask_index(mask_path)
+            full_aligner = MaskAligner(mask_src, full_grid, index=index)
+            preview_aligner = MaskAligner(mask_src, preview_grid, index=index)
+        pixel_scale = (src.width / preview_grid.width) * (src.height / preview_grid.height)
+        pixel_area = src.res[0] * src.res[1]
+
+        windows = [get_sample_window(src, geometries[z], window_size, factor) for z in sample]
+        for window in windows:
+            preview_window = Window(window.col_off // factor, window.row_off // factor,
+                                    -(-window.width // factor), -(-window.height // factor)
+                                    ).intersection(Window(0, 0, preview_grid.width, preview_grid.height))
+            for accumulated, grid, grid_window, aligner in ((full, full_grid, window, full_aligner),
+                                                            (preview, preview_grid, preview_window, preview_aligner)):
+                pixels = read_grid_window(src, bidx, tree, geometries, grid, grid_window, aligner, apply_mask)
+                if pixels is not None:
+                    accumulated.update(*pixels)
+        window_boxes = [box(*src.window_bounds(window)) for window in windows]
+
+    preview_mean, full_mean = preview.mean(), full.mean()
+    errors = []
+    for z in sample:
+        label = z + 1
+        # Area of the zone inside the sample windows (overlapping windows count twice, as their pixels do)
+        area = sum(geometries[z].intersection(window_box).area for window_box in window_boxes)
+        pairs = [('Mean', preview_mean[label], full_mean[label]),
+                 ('Sum', preview.total[label] * pixel_scale, full.total[label]),
+                 ('Coverage', preview.count[label] * pixel_scale * pixel_area / area, full.count[label] * pixel_area / area)]
+        for statistic, estimate, exact in pairs:
+            relative_error = abs(estimate - exact) / abs(exact) if exact else np.nan
+            errors.append((zone_names[z], statistic, estimate, exact, relative_error))
+    return errors
+
+def write_preview_error(errors, output_file):
+    """
+    Prints the preview error summary and writes the per-zone errors next to the results
+    """
+    for statistic in ('Mean', 'Sum', 'Coverage'):
+        values = [e[4] for e in errors if e[1] == statistic and not np.isnan(e[4])]
+        if values:
+            print(f"Preview {statistic} error on {len(values)} sampled zones: "
+                  f"mean {np.mean(values):.2%}, max {np.max(values):.2%}")
+    with open(output_file, 'w') as f:
+        f.write("Zone, Statistic, Preview, Full, Relative_Error \n")
+        for error in errors:
+            f.write(", ".join(str(value) for value in error) + " \n")
+    print(f"Preview error estimate saved to: {output_file}")
+
+def summarize_zones(accumulator, estimates, geometries, zone_names, raster_file, coverage_ratio, pixel_scale=1.0):
+    """
+    Turns accumulated per-zone statistics into result rows, keeping only zones whose
+    area is covered by valid data at least `coverage_ratio`
+
+    Args:
+        accumulator (ZonalAccumulator): Accumulated statistics, indexed by label
+        estimates (numpy.ndarray): Quantiles per label, the median first
+        geometries (list of shapely.Geometry): Zone geometries, in label order
+        zone_names (list of str): Zone names, in label order
+        raster_file (str): Path to the input raster file
+        coverage_ratio (float): The minimum fraction of a zone's area that must be covered by valid raster 
+                                data for it to be included in the results
+        pixel_scale (float): Full resolution pixels represented by one accumulated pixel,
+                             above 1 for preview reads
+
+    Returns:
+        results (list of tuple): One `(zone_name, mean, median, sum, std, coverage, *percentiles)`
+        tuple per zone, in label order
+    """
+    with rasterio.open(raster_file) as src:
+        pixel_area = src.res[0] * src.res[1] * pixel_scale
+        file_bounds = box(*src.bounds)
+    mean = accumulator.mean()
+    std = accumulator.std()
+    empty = (None,) * (4 + estimates.shape[1])
+
+    results = []
+    for z, (geometry, zone_name) in enumerate(zip(geometries, zone_names), start=1):
+        if not file_bounds.intersects(box(*geometry.bounds)):
+            print(f"Shape {zone_name} does not intersect raster, skipping.")
+            results.append((zone_name,) + empty)
+            continue
+        actual_cover = accumulator.count[z] * pixel_area / geometry.area
         print(f"The coverage area of {zone_name} is {actual_cover}", flush=True)
+        if accumulator.count[z] > 0 and actual_cover >= float(coverage_ratio):
+            results.append((zone_name, mean[z], estimates[z, 0], accumulator.total[z] * pixel_scale, std[z], actual_cover)
+                           + tuple(estimates[z, 1:]))
+        else:
+            results.append((zone_name,) + empty)
+    return results
+
+def calculate_zonal_stats_labels(raster_file, geometries, zone_names, label_path, coverage_ratio,
+                                 percentiles=(), quantile_method='sketch', quantile_error=0.005, mask_path=None,
+                                 apply_mask=False):
+    """
+    Calculates zonal statistics from a zone label raster in one sequential scan of
+    the raster (two with exact quantiles) instead of one masked read per zone
+
+    Args:
+        raster_file (str): Path to the input raster file
+        geometries (list of shapely.Geometry): Zone geometries, in label order
+        zone_names (list of str): Zone names, in label order
+        label_path (str): Path to the zone label raster made by `build_zone_labels`
+        coverage_ratio (float): The minimum fraction of a zone's area that must be covered by valid raster 
+                                data for it to be included in the results
+        percentiles (list of float): Extra percentiles (0-100) reported after the coverage
+        quantile_method (str): "sketch" or "exact", see `accumulate_zones`
+        quantile_error (float): Relative error bound of the sketch
+        mask_path (str or None): Common NA mask of the raster, see `accumulate_zones`
+        apply_mask (bool): Apply `mask_path` on the fly, see `accumulate_zones`
+
+    Returns:
+        results (list of tuple): One `(zone_name, mean, median, sum, std, coverage, *percentiles)`
+        tuple per zone, in label order
+    """
+    quantiles = [0.5] + [p / 100 for p in percentiles]
+    accumulator, estimates = accumulate_zones(raster_file, label_path, len(geometries) + 1,
+                                              quantiles, quantile_method, quantile_error, mask_path, apply_mask)
+    return summarize_zones(accumulator, estimates, geometries, zone_names, raster_file, coverage_ratio)
+
+def get_mask_type(mask_path):
+    """
+    Returns the mask type used in output file names (Canada, ABoVE or Combined) from
+    a mask path such as `CommonNA_Canada_Mask.tif` or `Combined_Mask.tif`
+    """
+    name = os.path.splitext(os.path.basename(mask_path))[0]
+    return name.replace('CommonNA_', '').replace('_Mask', '')
+
+# Per-process state of the zone tile workers, set once by `init_zone_worker`
+_zone_worker = {}
+
+def split_zone_windows(src, geometry, tile_size=2048, bidx=1):
+    """
+    Cuts the part of a raster covered by a zone into sub-tiles on the raster's chunk
+    grid (see `iter_read_windows`), so a giant zone becomes many tasks of bounded
+    size. Tiles that only touch the zone's bounding box are dropped
+
+    Args:
+        src (DatasetReader): The open dataset
+        geometry (shapely.Geometry): Zone geometry in the dataset's CRS
+        tile_size (int): Approximate edge length of a sub-tile in pixels
+        bidx (int): Band whose block layout is used
+
+    Returns:
+        windows (list of Window): Sub-tiles of the zone, empty when it misses the raster
+    """
+    try:
+        zone_window = geometry_window(src, [geometry])
+    except WindowError:
+        return []
+    shapely.prepare(geometry)
+    return [window for window in iter_read_windows(src, tile_size, bidx, within=zone_window)
+            if geometry.intersects(box(*window_bounds(window, src.transform)))]
+
+def init_zone_worker(raster_file, geometries_wkb, quantile_error, exact):
+    """
+    Opens the dataset once per worker process and loads the zone geometries, which
+    are shipped once as WKB instead of with every task
+    """
+    src = rasterio.open(raster_file)
+    _zone_worker.update(src=src, bidx=select_band(raster_file, src.count), geometries=shapely.from_wkb(geometries_wkb),
+                        quantile_error=quantile_error, exact=exact)
+
+def read_zone_tile(label, window):
+    """
+    Returns the valid raster values of a zone in one sub-tile. Pixels are assigned
+    to the zone the same way as `rasterio.mask.mask` (pixel centre inside the polygon)
+    """
+    src = _zone_worker['src']
+    data = src.read(_zone_worker['bidx'], window=window)
+    inside = geometry_mask([_zone_worker['geometries'][label - 1]], out_shape=data.shape,
+                           transform=src.window_transform(window), invert=True)
+    no_data_value = src.nodata
+    if no_data_value is None or np.isnan(no_data_value):
+        valid = inside & ~np.isnan(data)
     else:
-        print(f"The coverage area of {zone_name} is NaN", flush=True)
+        valid = inside & (data != no_data_value) & ~np.isnan(data)
+    return data[valid]
+
+def scan_zone_tile(task):
+    """
+    Accumulates one `(label, window)` sub-tile of a zone
 
-    #Check 
-    if actual_cover >= float(coverage_ratio):
-        # Calculate statistics
-        mean = np.nanmean(valid_data)
-        median = np.nanmedian(valid_data)
-        sum = np.nansum(valid_data)
-        std = np.nanstd(valid_data)
-        return (zone_name, mean, median, sum, std, actual_cover)
-    return (zone_name, None, None, None, None, None)
+    Returns:
+        tuple: A tuple containg:
+            - label (int): Zone label of the tile
+            - accumulator (ZonalAccumulator): Statistics of the tile, as label 0
+            - exact (ExactQuantiles or None): First scan of the exact quantiles
+    """
+    label, window = task
+    with block('zone_tile', zone=label, **window_fields(window)) as record:
+        values = read_zone_tile(label, window)
+        record['pixels'] = int(window.width * window.height)
+        labels = np.zeros(values.size, dtype=np.int64)
+        accumulator = ZonalAccumulator(1, relative_error=_zone_worker['quantile_error'])
+        accumulator.update(labels, values)
+        exact = None
+        if _zone_worker['exact']:
+            exact = ExactQuantiles(1)
+            exact.update(labels, values)
+    return label, accumulator, exact
+
+def scan_zone_tile_low(task):
+    """
+    Second scan of the exact quantiles over one `(label, window, exact)` sub-tile,
+    where `exact` is the zone's prepared `ExactQuantiles`
+    """
+    label, window, exact = task
+    with block('zone_tile_low', zone=label, **window_fields(window)) as record:
+        values = read_zone_tile(label, window)
+        record['pixels'] = int(window.width * window.height)
+        exact.update_low(np.zeros(values.size, dtype=np.int64), values)
+    return label, exact
 
-def calculate_zonal_stats_parallel(raster_file, shapefile, output_file, file_type, coverage_ratio):
+def calculate_zonal_stats_tiles(raster_file, geometries, zone_names, coverage_ratio, percentiles=(), workers=1,
+                                tile_size=2048, quantile_method='sketch', quantile_error=0.005):
     """
-    Calculates zonal statistics for geographic zones in parallel and writes the results to a file.
+    Calculates zonal statistics by masking the raster with each zone polygon, with
+    zones cut into raster-aligned sub-tiles (`split_zone_windows`) so one giant zone
+    does not leave the other workers idle. Tiles are dispatched largest first from a
+    shared queue that idle workers pull from, and the partial accumulators of a
+    zone's tiles are merged
+
+    Args:
+        raster_file (str): Path to the input raster file
+        geometries (list of shapely.Geometry): Zone geometries, in label order
+        zone_names (list of str): Zone names, in label order
+        coverage_ratio (float): The minimum fraction of a zone's area that must be covered by valid raster 
+                                data for it to be included in the results
+        percentiles (list of float): Extra percentiles (0-100) reported after the coverage
+        workers (int): Number of worker processes
+        tile_size (int): Approximate edge length of a sub-tile in pixels
+        quantile_method (str): "sketch" or "exact", see `accumulate_zones`
+        quantile_error (float): Relative error bound of the sketch
+
+    Returns:
+        results (list of tuple): One `(zone_name, mean, median, sum, std, coverage, *percentiles)`
+        tuple per zone, in shapefile order
+    """
+    quantiles = [0.5] + [p / 100 for p in percentiles]
+    exact = quantile_method == 'exact'
+    with rasterio.open(raster_file) as src:
+        bidx = select_band(raster_file, src.count)
+        tasks = [(label, window) for label, geometry in enumerate(geometries, start=1)
+                 for window in split_zone_windows(src, geometry, tile_size, bidx)]
+    tasks.sort(key=lambda task: task[1].width * task[1].height, reverse=True)
+    print(f"Split {len(geometries)} zones into {len(tasks)} tiles for {workers} workers", flush=True)
+
+    # Label 0 is unused, like in the label raster
+    accumulators = [ZonalAccumulator(1, relative_error=quantile_error) for _ in range(len(geometries) + 1)]
+    exacts = [ExactQuantiles(1) for _ in range(len(geometries) + 1)] if exact else None
+    initargs = (raster_file, shapely.to_wkb(geometries), quantile_error, exact)
+    with Pool(processes=workers, initializer=init_zone_worker, initargs=initargs) as pool:
+        # chunksize=1 lets every idle worker take the next largest tile
+        for label, accumulator, high in pool.imap_unordered(scan_zone_tile, tasks, chunksize=1):
+            accumulators[label].merge(accumulator)
+            if exact:
+                exacts[label].merge(high)
+        if exact:
+            for part in exacts:
+                part.prepare(quantiles)
+            # Copies are sent before any results are merged into the originals
+            low_tasks = [(label, window, copy.copy(exacts[label])) for label, window in tasks
+                         if exacts[label].count.any()]
+            for label, low in pool.imap_unordered(scan_zone_tile_low, low_tasks, chunksize=1):
+                exacts[label].merge(low)
+
+    accumulator = ZonalAccumulator.concatenate(accumulators)
+    if exact:
+        estimates = np.vstack([part.quantiles() for part in exacts])
+    else:
+        print(accumulator.error_report())
+        estimates = accumulator.quantiles(quantiles)
+    return summarize_zones(accumulator, estimates, geometries, zone_names, raster_file, coverage_ratio)
+
+def calculate_zonal_stats_parallel(raster_file, shapefile, output_file, file_type, coverage_ratio, engine='labels',
+                                   cache_dir=None, cache_size=100 * 1024**3, percentiles=(),
+                                   quantile_method='sketch', quantile_error=0.005, mask_path=None, apply_mask=False,
+                                   workers=1, tile_size=2048, preview_level=0, preview_sample=3, checkpoint_dir=None,
+                                   checkpoint_interval=600, results_store=None, export_txt=True, mask_type=None,
+                                   build_overviews=False):
+    """
+    Calculates zonal statistics for geographic zones in parallel and writes the results to the
+    results store and/or a text file.
 
     Args:
         raster_file (str): Path to the input raster file.
         shapefile (str): Path to the shapefile containing the geographic zones.
-        output_file (str): Path to the output file where the zonal statistics will be saved.
+        output_file (str): Path to the text file where the zonal statistics will be saved, also
+                           the base name of the preview error file.
         file_type (str): The type of geographic zones in the shapefile.
                             - "Canada": Uses the 'postal' column for zone identification.
                             - "EPA2": Uses the 'NA_L2KEY' column for zone identification.
         coverage_ratio (float): The minimum fraction of a zone's area that must be covered by valid raster 
                                 data for it to be included in the results.
+        engine (str): How zones are read from the raster
+                        - "labels": Burns all zones into a label raster once and scans the raster
+                        - "polygon": Masks the raster with every zone polygon, see `calculate_zonal_stats_tiles`
+        cache_dir (str or None): Directory where zone label rasters are cached between runs.
+                                 When None the labels are rebuilt in a temporary directory.
+                                 Labels engine only, the polygon engine has no label raster
+        cache_size (int): Size limit of the zone label cache in bytes
+        percentiles (list of float): Extra percentiles (0-100) added as columns
+        quantile_method (str): "sketch" (one scan, bounded error) or "exact" (two scans)
+        quantile_error (float): Relative error bound of the quantile sketch
+        mask_path (str or None): Common NA mask of the raster. Its tile index lets fully
+                                 masked chunks be skipped, labels engine only
+        apply_mask (bool): Apply `mask_path` on the fly to the original raster so no masked
+                           copy has to be written, labels engine only
+        workers (int): Number of worker processes, polygon engine only
+        tile_size (int): Edge length of the zone sub-tiles, polygon engine only
+        preview_level (int): Quick statistics from a `1/2**preview_level` resolution read
+                             with an error estimate, labels engine only (0 for full resolution)
+        preview_sample (int): Number of zones whose surroundings are recomputed at full resolution
+                              for the error estimate
+        checkpoint_dir (str or None): Directory where the scan is checkpointed so an interrupted
+                                      run resumes, labels engine only (None disables checkpoints)
+        checkpoint_interval (float): Seconds between checkpoints
+        results_store (str or None): Directory of the Parquet results store the results are
+                                     added to, see `results_store.append_results` (None skips it)
+        export_txt (bool): Also write the results to `output_file` in the legacy text format
+        mask_type (str or None): Mask type stored with the results, see `get_result_keys`
+        build_overviews (bool): Build missing overviews for a preview, see `check_preview_overviews`
+
+    Raises:
+        ValueError: When options of the labels engine are given to the polygon engine, which
+                    would otherwise ignore them and store unmasked results under a mask type
     """
+    if engine != 'labels':
+        unsupported = {'mask_path': mask_path is not None, 'apply_mask': apply_mask,
+                       'preview_level': preview_level > 0, 'checkpoint_dir': checkpoint_dir is not None}
+        unsupported = [name for name, given in unsupported.items() if given]
+        if unsupported:
+            raise ValueError(f"The {engine} engine does not support {', '.join(unsupported)}")
     print(f"Looking at dataset: {raster_file} with file type {file_type}")
+
+    with stage('zonal_stats', raster=raster_file, zones=file_type, engine=engine, preview_level=preview_level):
+        if engine == 'labels':
+            quantiles = [0.5] + [p / 100 for p in percentiles]
+            geometries, zone_names, accumulator, estimates, pixel_scale = zone_statistics(
+                raster_file, shapefile, file_type, cache_dir, cache_size, quantiles, quantile_method, quantile_error,
+                mask_path, apply_mask, preview_level, checkpoint_dir, checkpoint_interval, build_overviews)
+            results = summarize_zones(accumulator, estimates, geometries, zone_names, raster_file, coverage_ratio,
+                                      pixel_scale)
+            if preview_level > 0:
+                report_preview_error(raster_file, geometries, zone_names, accumulator, preview_level, output_file,
+                                     preview_sample, mask_path, apply_mask)
+        else:
+            shapes = gpd.read_file(shapefile)
+            print(f"Shapefile CRS: {shapes.crs}")
+            results = calculate_zonal_stats_tiles(raster_file, list(shapes.geometry), list(shapes[get_zone_column(file_type)]),
+                                                  coverage_ratio, percentiles, workers, tile_size, quantile_method,
+                                                  quantile_error)
+
+    # Write results to the store and/or a text file
+    if results_store is not None:
+        keys = get_result_keys(raster_file, file_type, coverage_ratio, mask_type, preview_level)
+        append_results(results_store, [results_table(results, percentiles, **keys)])
+    if export_txt:
+        write_txt(results, output_file, percentiles)
+
+def get_zone_checkpoint(checkpoint_dir, interval, raster_file, shapefile, quantiles, quantile_method, quantile_error,
+                        mask_path=None, apply_mask=False):
+    """
+    Returns the checkpoint of a zone scan in `checkpoint_dir`, named after the raster,
+    the zone label key (shapefile contents and grid) and the scan settings, so only
+    a rerun of the same scan picks it up
+
+    Returns:
+        checkpoint (BlockCheckpoint): The checkpoint of the scan
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    key = checkpoint_key(raster=file_fingerprint(raster_file), zones=zone_label_key(shapefile, raster_file),
+                         quantiles=list(quantiles), quantile_method=quantile_method, quantile_error=quantile_error,
+                         mask=file_fingerprint(mask_path) if mask_path else None, apply_mask=apply_mask)
+    return BlockCheckpoint(os.path.join(checkpoint_dir, f"{key}.checkpoint"), key, interval)
+
+def zone_statistics(raster_file, shapefile, file_type, cache_dir=None, cache_size=100 * 1024**3, quantiles=(0.5,),
+                    quantile_method='sketch', quantile_error=0.005, mask_path=None, apply_mask=False, preview_level=0,
+                    checkpoint_dir=None, checkpoint_interval=600, build_overviews=False):
+    """
+    Accumulates the raw per-zone statistics of a raster for one zone set. No coverage
+    threshold is applied yet, so one result serves any number of coverage ratios
+    through `summarize_zones`
+
+    Args:
+        raster_file (str): Path to the input raster file
+        shapefile (str): Path to the shapefile containing the geographic zones
+        file_type (str): The type of geographic zones in the shapefile (Canada or EPA2)
+        cache_dir (str or None): Zone label cache directory, labels are rebuilt in a
+                                 temporary directory when None
+        cache_size (int): Size limit of the zone label cache in bytes
+        quantiles (list of float): Quantiles in [0, 1], the median first
+        quantile_method (str): "sketch" or "exact", see `accumulate_zones`
+        quantile_error (float): Relative error bound of the sketch
+        mask_path (str or None): Common NA mask of the raster, see `accumulate_zones`
+        apply_mask (bool): Apply `mask_path` on the fly, see `accumulate_zones`
+        preview_level (int): Read the raster at `1/2**preview_level` resolution with
+                             `accumulate_zones_preview` (sketch quantiles), 0 for full resolution
+        checkpoint_dir (str or None): Directory of scan checkpoints, see `get_zone_checkpoint`.
+                                      None disables checkpoints
+        checkpoint_interval (float): Seconds between checkpoints
+        build_overviews (bool): Build missing overviews for a preview, see `check_preview_overviews`
+
+    Returns:
+        tuple: A tuple containg:
+            - geometries (list of shapely.Geometry): Zone geometries, in label order
+            - zone_names (list of str): Zone names, in label order
+            - accumulator (ZonalAccumulator): Accumulated statistics, indexed by label
+            - estimates (numpy.ndarray): Quantiles per label, shape (labels, quantiles)
+            - pixel_scale (float): Full resolution pixels represented by one accumulated pixel
+    """
     shapes = gpd.read_file(shapefile)
     print(f"Shapefile CRS: {shapes.crs}")
-    
-    # Use multiprocessing to process zones in parallel
-    with Pool(processes=4) as pool:
-        results = pool.starmap(process_zone, [(row, raster_file, file_type, coverage_ratio) for _, row in shapes.iterrows()])
+    geometries = list(shapes.geometry)
+    zone_names = list(shapes[get_zone_column(file_type)])
+    n_labels = len(geometries) + 1
+    if preview_level > 0:
+        accumulator, estimates, pixel_scale = accumulate_zones_preview(raster_file, geometries, preview_level, quantiles,
+                                                                       quantile_error, mask_path, apply_mask,
+                                                                       build_overviews=build_overviews)
+        return geometries, zone_names, accumulator, estimates, pixel_scale
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = get_zone_checkpoint(checkpoint_dir, checkpoint_interval, raster_file, shapefile, quantiles,
+                                         quantile_method, quantile_error, mask_path, apply_mask)
+    if cache_dir is not None:
+        with stage('zone_labels', raster=raster_file, zones=file_type):
+            label_path = get_zone_labels(geometries, shapefile, raster_file, cache_dir, cache_size)
+        accumulator, estimates = accumulate_zones(raster_file, label_path, n_labels, quantiles, quantile_method,
+                                                  quantile_error, mask_path, apply_mask, checkpoint)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            label_path = os.path.join(tmp_dir, "zone_labels.tif")
+            with stage('zone_labels', raster=raster_file, zones=file_type):
+                build_zone_labels(geometries, raster_file, label_path)
+            accumulator, estimates = accumulate_zones(raster_file, label_path, n_labels, quantiles, quantile_method,
+                                                      quantile_error, mask_path, apply_mask, checkpoint)
+    return geometries, zone_names, accumulator, estimates, 1.0
 
-    # Write results to a file
-    print(f"Writing results to file: {output_file}")
-    with open(output_file, 'w') as f:
-        f.write("Zone, Mean, Median, Sum, Std, Coverage \n")
-        for result in results:
-            f.write(f"{result[0]}, {result[1]}, {result[2]}, {result[3]}, {result[4]}, {result[5]} \n")
+def report_preview_error(raster_file, geometries, zone_names, accumulator, preview_level, output_file, preview_sample=3,
+                         mask_path=None, apply_mask=False):
+    """
+    Measures the error of preview statistics around `preview_sample` zones and writes
+    it to `<output_file>_error.txt`, see `estimate_preview_error`
+    """
+    errors = estimate_preview_error(raster_file, geometries, zone_names, accumulator, preview_level, preview_sample,
+                                    mask_path, apply_mask)
+    write_preview_error(errors, os.path.splitext(output_file)[0] + '_error.txt')
+
+def get_output_file(raster_file, file_type, coverage_ratio, mask_type=None, output_dir="zonal_stats", preview_level=0):
+    """
+    Returns the legacy text result file name, `zonal_stats_{type}_{folder}_{mask}_{percent}.txt`,
+    with a `_preview{level}` suffix for preview results
+
+    Args:
+        raster_file (str): Path to the input raster file
+        file_type (str): The type of geographic zones (Canada or EPA2)
+        coverage_ratio (float): Coverage ratio of the results
+        mask_type (str or None): Mask type in the name, taken from the `*_masked_<type>.tif`
+                                 raster name when None
+        output_dir (str): Directory of the result files
+        preview_level (int): Preview level of the results, 0 for full resolution
+    """
+    folder_name, mask_type = get_result_names(raster_file, mask_type)
+    return os.path.join(output_dir, get_txt_name(file_type, folder_name, mask_type, coverage_ratio, preview_level))
+
+def get_dataset_name(raster_file):
+    """
+    Returns the dataset name of a raster's results: its folder, without any suffix
+    after a dot
+    """
+    return os.path.basename(os.path.dirname(raster_file)).split('.')[0]
+
+def get_result_names(raster_file, mask_type=None):
+    """
+    Returns the dataset name (see `get_dataset_name`) and mask type of a raster's results,
+    the mask type taken from the `*_masked_<type>.tif` raster name when None
+    """
+    folder_name = get_dataset_name(raster_file)
+    if mask_type is None:
+        mask_type = os.path.basename(raster_file).split('_')[-1].split('.')[0]
+    return folder_name, mask_type
+
+def get_result_keys(raster_file, file_type, coverage_ratio, mask_type=None, preview_level=0):
+    """
+    Returns the columns identifying a set of results in the results store: `dataset`,
+    `zone_set`, `mask_type`, `coverage_ratio`, `band` (read by `select_band`) and
+    `preview_level`
+    """
+    dataset, mask_type = get_result_names(raster_file, mask_type)
+    with rasterio.open(raster_file) as src:
+        band = select_band(raster_file, src.count)
+    return {'dataset': dataset, 'zone_set': file_type, 'mask_type': mask_type, 'coverage_ratio': coverage_ratio,
+            'band': band, 'preview_level': preview_level}
+
+def process_raster_batch(raster_file, zone_sets, coverage_ratios, mask_path=None, apply_mask=False, output_dir="zonal_stats",
+                         cache_dir=None, cache_size=100 * 1024**3, percentiles=(), quantile_method='sketch',
+                         quantile_error=0.005, preview_level=0, preview_sample=3, checkpoint_dir=None,
+                         checkpoint_interval=600, results_store=None, export_txt=True, build_overviews=False):
+    """
+    Computes the zonal statistics of one raster for every zone set and coverage ratio.
+    The raster is scanned once per zone set and each coverage ratio is only a filter
+    on the accumulated statistics. All coverage ratios of a zone set are added to the
+    results store in one file
+
+    Args:
+        raster_file (str): Path to the input raster file
+        zone_sets (dict): Shapefile of every zone type, e.g. `{'EPA2': path, 'Canada': path}`
+        coverage_ratios (list of float): Coverage ratios to write results for
+        mask_path (str or None): Common NA mask of the raster, see `accumulate_zones`
+        apply_mask (bool): Apply `mask_path` on the fly, see `accumulate_zones`
+        output_dir (str): Directory of the text result files
+        cache_dir, cache_size, percentiles, quantile_method, quantile_error, preview_level,
+            preview_sample, checkpoint_dir, checkpoint_interval, results_store, export_txt, build_overviews:
+            See `calculate_zonal_stats_parallel`
+
+    Returns:
+        output_files (list of str): The result files written
+    """
+    quantiles = [0.5] + [p / 100 for p in percentiles]
+    mask_type = get_mask_type(mask_path) if apply_mask else None
+    output_files = []
+    for file_type, shapefile in zone_sets.items():
+        print(f"Looking at dataset: {raster_file} with file type {file_type}", flush=True)
+        with stage('zonal_stats', raster=raster_file, zones=file_type, engine='labels', preview_level=preview_level):
+            geometries, zone_names, accumulator, estimates, pixel_scale = zone_statistics(
+                raster_file, shapefile, file_type, cache_dir, cache_size, quantiles, quantile_method, quantile_error,
+                mask_path, apply_mask, preview_level, checkpoint_dir, checkpoint_interval, build_overviews)
+        tables = []
+        for coverage_ratio in coverage_ratios:
+            results = summarize_zones(accumulator, estimates, geometries, zone_names, raster_file, coverage_ratio,
+                                      pixel_scale)
+            if results_store is not None:
+                keys = get_result_keys(raster_file, file_type, coverage_ratio, mask_type, preview_level)
+                tables.append(results_table(results, percentiles, **keys))
+            if export_txt:
+                output_file = get_output_file(raster_file, file_type, coverage_ratio, mask_type, output_dir, preview_level)
+                write_txt(results, output_file, percentiles)
+                output_files.append(output_file)
+        if tables:
+            output_files.append(append_results(results_store, tables))
+        if preview_level > 0:
+            # The error does not depend on the coverage ratio, it is named after the first one
+            report_preview_error(raster_file, geometries, zone_names, accumulator, preview_level,
+                                 get_output_file(raster_file, file_type, coverage_ratios[0], mask_type, output_dir,
+                                                 preview_level), preview_sample, mask_path, apply_mask)
+    return output_files
+
+def calculate_zonal_stats_batch(raster_files, zone_sets, coverage_ratios, mask_paths=None, apply_mask=False,
+                                output_dir="zonal_stats", workers=1, node_index=0, node_count=1, **options):
+    """
+    Calculates zonal statistics for many rasters, zone sets and coverage ratios in one
+    run. Rasters are split between `node_count` nodes (every node takes every
+    `node_count`-th raster, largest first) and a node's rasters are processed by
+    `workers` processes, each raster by `process_raster_batch`
+
+    Args:
+        raster_files (list of str): Paths to the input raster files
+        zone_sets (dict): Shapefile of every zone type, e.g. `{'EPA2': path, 'Canada': path}`
+        coverage_ratios (list of float): Coverage ratios to write results for
+        mask_paths (list of str or None): Common NA mask of every raster, or a single
+                                          mask used for all of them
+        apply_mask (bool): Apply the masks on the fly, see `accumulate_zones`
+        output_dir (str): Directory of the result files
+        workers (int): Number of rasters processed at the same time on this node
+        node_index (int): 0-based index of this node
+        node_count (int): Number of nodes sharing the rasters
+        **options: Passed on to `process_raster_batch` (cache and quantile settings)
+
+    Returns:
+        output_files (list of str): The result files written by this node
+    """
+    if mask_paths is None:
+        mask_paths = [None] * len(raster_files)
+    elif len(mask_paths) == 1:
+        mask_paths = list(mask_paths) * len(raster_files)
+    elif len(mask_paths) != len(raster_files):
+        raise ValueError("Give one mask, or one mask per raster")
+    if not 0 <= node_index < node_count:
+        raise ValueError(f"Node index {node_index} is not between 0 and {node_count - 1}")
+
+    # Largest rasters first so the long scans start early, then deal them out to the nodes
+    jobs = sorted(zip(raster_files, mask_paths), key=lambda job: os.path.getsize(job[0]), reverse=True)
+    jobs = jobs[node_index::node_count]
+    print(f"Node {node_index + 1}/{node_count}: {len(jobs)} rasters x {len(zone_sets)} zone sets x "
+          f"{len(coverage_ratios)} coverage ratios with {workers} workers")
+    os.makedirs(output_dir, exist_ok=True)
+
+    output_files = []
+    if workers <= 1:
+        for raster_file, mask_path in jobs:
+            output_files += process_raster_batch(raster_file, zone_sets, coverage_ratios, mask_path, apply_mask,
+                                                 output_dir, **options)
+        return output_files
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_raster_batch, raster_file, zone_sets, coverage_ratios, mask_path,
+                                   apply_mask, output_dir, **options): raster_file
+                   for raster_file, mask_path in jobs}
+        for future in as_completed(futures):
+            try:
+                output_files += future.result()
+                print(f"Finished {futures[future]}", flush=True)
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                traceback.print_exc()
+    return output_files
+
+def get_array_node_index():
+    """
+    Returns the 0-based position of this task in a SLURM job array, so arrays that
+    do not start at 0 (`--array=1-4`) or use a step (`--array=0-6:2`) still cover
+    every node index. 0 outside of a job array
+    """
+    if 'SLURM_ARRAY_TASK_ID' not in os.environ:
+        return 0
+    task_id = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    task_min = int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    task_step = int(os.environ.get('SLURM_ARRAY_TASK_STEP', 1))
+    return (task_id - task_min) // task_step
+
+ZONE_SHAPEFILES = {
+    'EPA2': "/projects/arctic/share/ABoVE_Biomass/OtherSpatialDatasets/EPA_ecoregion_lvl2_102001.shp",
+    'Canada': "/projects/arctic/share/ABoVE_Biomass/OtherSpatialDatasets/CanadaAlaska_Boundaries_102001.shp",
+}
 
 if __name__ == "__main__":
 
     # Parse arguments
     parser = argparse.ArgumentParser(description="Zonal Statistics Calculation Script")
-    parser.add_argument('--infile', type=str, required=True, help="Path to input raster file")
-    parser.add_argument('--script_type', type=str, choices=['EPA2', 'Canada'], required=True, help="Type of script to run (EPA2 or Canada)")
-    parser.add_argument('--coverage_ratio', type=float, required=True, help="Coverage ratio (number 0-1)")
+    parser.add_argument('--infile', type=str, nargs='+', required=True, help="Path to input raster file(s)")
+    parser.add_argument('--script_type', type=str, nargs='+', choices=['EPA2', 'Canada'], required=True, help="Type(s) of script to run (EPA2 and/or Canada)")
+    parser.add_argument('--coverage_ratio', type=float, nargs='+', required=True, help="Coverage ratio(s) (number 0-1)")
+    parser.add_argument('--engine', type=str, choices=['labels', 'polygon'], default='labels', help="Scan a zone label raster once (labels) or mask each zone separately (polygon)")
+    parser.add_argument('--cache-dir', type=str, default="/projects/arctic/share/ABoVE_Biomass/OtherSpatialDatasets/zone_label_cache", help="Directory for cached zone label rasters, 'none' disables the cache")
+    parser.add_argument('--cache-size', type=float, default=100, help="Size limit of the zone label cache in GB")
+    parser.add_argument('--percentiles', type=float, nargs='*', default=[], help="Extra percentile columns, e.g. 10 90")
+    parser.add_argument('--quantile-method', type=str, choices=['sketch', 'exact'], default='sketch', help="Median/percentiles from a one-scan sketch or an exact second scan")
+    parser.add_argument('--quantile-error', type=float, default=0.005, help="Relative error bound of the quantile sketch")
+    parser.add_argument('--mask', type=str, nargs='+', default=None, help="Common NA mask of --infile (one, or one per input), its tile index lets fully masked blocks be skipped")
+    parser.add_argument('--apply-mask', action='store_true', help="Apply --mask on the fly to an unmasked --infile instead of reading a masked copy")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Worker processes: rasters processed at the same time in batch mode, zone tiles with the polygon engine")
+    parser.add_argument('--tile-size', type=int, default=2048, help="Edge length in pixels of the sub-tiles zones are cut into by the polygon engine")
+    parser.add_argument('--node-index', type=int, default=get_array_node_index(), help="0-based index of this node when rasters are split between nodes")
+    parser.add_argument('--node-count', type=int, default=int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1)), help="Number of nodes the rasters are split between")
+    parser.add_argument('--preview-level', type=int, default=0, help="Quick statistics from a 1/2**level resolution read of the raster's nearest resampled overviews, 0 for full resolution")
+    parser.add_argument('--preview-sample', type=int, default=3, help="Zones whose surroundings are recomputed at full resolution to estimate the preview error")
+    parser.add_argument('--build-overviews', action='store_true', help="Build nearest resampled overviews into <raster>.ovr for a preview of a raster without overviews")
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help="Directory for scan checkpoints, an interrupted run with the same options resumes from them")
+    parser.add_argument('--checkpoint-interval', type=float, default=600, help="Seconds between scan checkpoints")
+    parser.add_argument('--results-store', type=str, default="zonal_stats/results", help="Parquet results store the results are added to, 'none' disables it")
+    parser.add_argument('--export-txt', action=argparse.BooleanOptionalAction, default=True, help="Also write the legacy zonal_stats_*.txt files (--no-export-txt writes only the results store)")
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    setup_metrics(args)
 
-    # Check which type of script to run
-    if args.script_type == 'EPA2':
-        shapefile = "/projects/arctic/share/ABoVE_Biomass/OtherSpatialDatasets/EPA_ecoregion_lvl2_102001.shp"
-    elif args.script_type == 'Canada':
-        shapefile = "/projects/arctic/share/ABoVE_Biomass/OtherSpatialDatasets/CanadaAlaska_Boundaries_102001.shp"
-    
-    # Create output file name
-    directory = os.path.dirname(args.infile)
-    folder_name = os.path.basename(directory).split('.')[0]
-    coverage_ratio_percent = int(args.coverage_ratio * 100)
-    mask_type = os.path.basename(args.infile).split('_')[-1].split('.')[0]
-    output_file = f"zonal_stats/zonal_stats_{args.script_type}_{folder_name}_{mask_type}_{coverage_ratio_percent}.txt"
-
-    # Run parallel zonal stats and write to file
-    calculate_zonal_stats_parallel(args.infile, shapefile, output_file, args.script_type, args.coverage_ratio)
+    if args.engine != 'labels':
+        # The polygon engine reads the raster as it is, so these would be silently ignored
+        for option, given in (('--preview-level', args.preview_level > 0), ('--mask', args.mask is not None),
+                              ('--apply-mask', args.apply_mask), ('--checkpoint-dir', args.checkpoint_dir is not None)):
+            if given:
+                parser.error(f"{option} needs the labels engine")
+    if not 0 <= args.node_index < args.node_count:
+        parser.error(f"--node-index {args.node_index} is not between 0 and --node-count - 1 ({args.node_count - 1}); "
+                     "in a job array it is the task's position in the array (any start or step, e.g. "
+                     "--array=1-4 or --array=0-6:2), so pass --node-count when it differs from the array size")
+    if args.apply_mask and args.mask is None:
+        parser.error("--apply-mask needs --mask")
+    if args.mask is not None and len(args.mask) not in (1, len(args.infile)):
+        parser.error("Give one --mask, or one per --infile")
+    cache_dir = None if args.cache_dir.lower() == 'none' else args.cache_dir
+    results_store = None if args.results_store.lower() == 'none' else args.results_store
+    if results_store is None and not args.export_txt:
+        parser.error("--results-store none cannot be combined with --no-export-txt")
+    zone_sets = {script_type: ZONE_SHAPEFILES[script_type] for script_type in args.script_type}
+
+    if args.engine == 'labels' and len(args.infile) * len(zone_sets) * len(args.coverage_ratio) > 1:
+        # Batch mode: one scan per raster and zone set, coverage ratios applied afterwards
+        calculate_zonal_stats_batch(args.infile, zone_sets, args.coverage_ratio, args.mask, args.apply_mask,
+                                    workers=args.workers, node_index=args.node_index, node_count=args.node_count,
+                                    cache_dir=cache_dir, cache_size=int(args.cache_size * 1024**3),
+                                    percentiles=args.percentiles, quantile_method=args.quantile_method,
+                                    quantile_error=args.quantile_error, preview_level=args.preview_level,
+                                    preview_sample=args.preview_sample, checkpoint_dir=args.checkpoint_dir,
+                                    checkpoint_interval=args.checkpoint_interval, results_store=results_store,
+                                    export_txt=args.export_txt, build_overviews=args.build_overviews)
+    else:
+        for i, infile in enumerate(args.infile):
+            mask_path = None if args.mask is None else args.mask[i % len(args.mask)]
+            mask_type = get_mask_type(mask_path) if args.apply_mask else None
+            for script_type, shapefile in zone_sets.items():
+                for coverage_ratio in args.coverage_ratio:
+                    # Run parallel zonal stats and write to file
+                    output_file = get_output_file(infile, script_type, coverage_ratio, mask_type,
+                                                  preview_level=args.preview_level)
+                    calculate_zonal_stats_parallel(infile, shapefile, output_file, script_type, coverage_ratio, args.engine,
+                                                   cache_dir, int(args.cache_size * 1024**3), args.percentiles,
+                                                   args.quantile_method, args.quantile_error, mask_path, args.apply_mask,
+                                                   args.workers, args.tile_size, args.preview_level, args.preview_sample,
+                                                   args.checkpoint_dir, args.checkpoint_interval, results_store,
+                                                   args.export_txt, mask_type, args.build_overviews)
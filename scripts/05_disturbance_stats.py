@@ -0,0 +1,249 @@
+import argparse
+import importlib
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
+import shapely
+from shapely import STRtree
+from shapely.geometry import box
+from run_metrics import add_metrics_arguments, setup_metrics, stage, block, window_fields
+from zone_labels import iter_read_windows
+
+zonal_stats = importlib.import_module('04_zonal_stats')
+
+STAT_COLUMNS = ["pixels", "valid_pixels", "coverage", "mean", "median", "sum", "std", "min", "max"]
+
+# Polygons whose box in a chunk has fewer pixels are tested pixel centre by pixel
+# centre, which avoids the per-call setup of rasterizing and is much faster for them
+POINT_TEST_PIXELS = 256 * 256
+
+def group_polygons_by_window(src, geometries, chunk_size=2048, bidx=1):
+    """
+    Finds which polygons every raster chunk has to serve. An STRtree over the
+    polygons is queried with the boxes of all chunks (snapped to the raster's
+    internal blocks) inside the polygons' combined extent in one call, so chunks
+    without polygons are never read
+
+    Args:
+        src (DatasetReader): The open raster
+        geometries (numpy.ndarray of shapely.Geometry): Polygons in the raster's CRS
+        chunk_size (int): Approximate edge length of a chunk in pixels
+        bidx (int): Band whose block layout is used
+
+    Returns:
+        tuple: A tuple containg:
+            - groups (list of tuple): `(window, polygon_indices)` for every chunk
+              touched by at least one polygon, in raster order
+            - windows_left (numpy.ndarray): Number of chunks every polygon touches
+    """
+    left, bottom, right, top = gpd.GeoSeries(geometries).total_bounds
+    within = from_bounds(left, bottom, right, top, src.transform)
+    within = Window(np.floor(within.col_off), np.floor(within.row_off),
+                    np.ceil(within.width) + 1, np.ceil(within.height) + 1)
+    windows = list(iter_read_windows(src, chunk_size, bidx, within=within))
+    if not windows:
+        return [], np.zeros(len(geometries), dtype=np.int64)
+    boxes = [box(*window_bounds(window, src.transform)) for window in windows]
+    window_index, polygon_index = STRtree(geometries).query(boxes, predicate='intersects')
+    order = np.argsort(window_index, kind='stable')
+    window_index, polygon_index = window_index[order], polygon_index[order]
+    splits = np.flatnonzero(np.diff(window_index)) + 1
+    groups = [(windows[indices[0]], polygons)
+              for indices, polygons in zip(np.split(window_index, splits), np.split(polygon_index, splits))
+              if len(indices)]
+    return groups, np.bincount(polygon_index, minlength=len(geometries))
+
+def polygon_pixels(geometry, data, valid, transform):
+    """
+    Returns the number of pixels of a chunk inside a polygon and their valid values.
+    Pixels are assigned to the polygon the same way as `rasterio.mask.mask` (pixel
+    centre inside the polygon), on the polygon's bounding box only. Small boxes test
+    the pixel centres with shapely, larger ones are rasterized
+
+    Args:
+        geometry (shapely.Geometry): The polygon
+        data (numpy.ndarray): Values of the chunk
+        valid (numpy.ndarray): True where the chunk's values are valid
+        transform (Affine): Transform of the chunk
+    """
+    box_window = from_bounds(*geometry.bounds, transform)
+    row_start = max(int(np.floor(box_window.row_off)), 0)
+    col_start = max(int(np.floor(box_window.col_off)), 0)
+    row_stop = min(int(np.ceil(box_window.row_off + box_window.height)), data.shape[0])
+    col_stop = min(int(np.ceil(box_window.col_off + box_window.width)), data.shape[1])
+    if row_stop <= row_start or col_stop <= col_start:
+        return 0, data[:0, :0].ravel()
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    if window.width * window.height <= POINT_TEST_PIXELS:
+        x = transform.c + (np.arange(col_start, col_stop) + 0.5) * transform.a
+        y = transform.f + (np.arange(row_start, row_stop) + 0.5) * transform.e
+        inside = shapely.contains_xy(geometry, x[np.newaxis, :], y[:, np.newaxis])
+    else:
+        inside = geometry_mask([geometry], out_shape=(window.height, window.width),
+                               transform=rasterio.windows.transform(window, transform), invert=True)
+    rows, cols = slice(row_start, row_stop), slice(col_start, col_stop)
+    return int(inside.sum()), data[rows, cols][inside & valid[rows, cols]]
+
+def summarize_polygon(pixels, values, percentiles=()):
+    """
+    Returns the statistics of one polygon from all its valid values, with NaN for
+    polygons without valid pixels
+    """
+    values = values.astype(np.float64, copy=False)
+    stats = {'pixels': pixels, 'valid_pixels': values.size,
+             'coverage': values.size / pixels if pixels else np.nan}
+    if values.size:
+        stats.update({'mean': values.mean(), 'median': np.median(values), 'sum': values.sum(), 'std': values.std(),
+                      'min': values.min(), 'max': values.max()})
+        stats.update({f"p{p:g}": value for p, value in zip(percentiles, np.percentile(values, percentiles))})
+    else:
+        stats.update({column: np.nan for column in STAT_COLUMNS[3:]})
+        stats.update({f"p{p:g}": np.nan for p in percentiles})
+    return stats
+
+def extract_polygon_stats(raster_file, polygons, chunk_size=2048, percentiles=()):
+    """
+    Computes statistics of a raster for thousands of small polygons (fire perimeters,
+    harvest patches) in one pass. Polygons are grouped by the chunks they touch
+    (`group_polygons_by_window`), every chunk is read once and serves all its polygons,
+    and a polygon's values are kept only until its last chunk has been read, so
+    memory depends on the polygons in progress rather than on their number. Medians
+    and percentiles are exact. Overlapping polygons each get all their pixels
+
+    Args:
+        raster_file (str): Path to the input raster file
+        polygons (geopandas.GeoDataFrame): The polygons, in any CRS
+        chunk_size (int): Approximate edge length of a chunk in pixels
+        percentiles (list of float): Extra percentiles (0-100) added as `p<percentile>` columns
+
+    Returns:
+        stats (pandas.DataFrame): One row per polygon in input order: `pixels` (inside
+        the polygon), `valid_pixels`, `coverage` (valid fraction), `mean`, `median`, `sum`,
+        `std`, `min`, `max` and the percentiles
+    """
+    with rasterio.open(raster_file) as src:
+        bidx = zonal_stats.select_band(raster_file, src.count)
+        no_data_value = src.nodata
+        geometries = polygons.geometry.to_crs(src.crs).values if polygons.crs else polygons.geometry.values
+        geometries = np.asarray(geometries, dtype=object)
+        shapely.prepare(geometries)
+        groups, windows_left = group_polygons_by_window(src, geometries, chunk_size, bidx)
+        print(f"{len(geometries)} polygons touch {len(groups)} chunks of {raster_file}", flush=True)
+
+        pixels = np.zeros(len(geometries), dtype=np.int64)
+        pending = {}
+        rows = [None] * len(geometries)
+        for window, indices in groups:
+            with block('polygon_chunk', polygons=len(indices), **window_fields(window)) as record:
+                data = src.read(bidx, window=window)
+                record['pixels'] = data.size
+                valid = zonal_stats.is_valid(data, no_data_value)
+                transform = src.window_transform(window)
+                for i in indices:
+                    count, values = polygon_pixels(geometries[i], data, valid, transform)
+                    pixels[i] += count
+                    if values.size:
+                        pending.setdefault(i, []).append(values)
+                    windows_left[i] -= 1
+                    if windows_left[i] == 0:
+                        parts = pending.pop(i, [])
+                        values = np.concatenate(parts) if parts else np.empty(0)
+                        rows[i] = summarize_polygon(pixels[i], values, percentiles)
+    # Polygons outside the raster
+    for i, row in enumerate(rows):
+        if row is None:
+            rows[i] = summarize_polygon(0, np.empty(0), percentiles)
+    return pd.DataFrame(rows)
+
+def get_output_file(raster_file, polygon_file, output_dir="disturbance_stats"):
+    """
+    Returns the result file of a raster and polygon set,
+    `<polygons>_<folder>_<raster>.parquet`
+    """
+    folder_name = zonal_stats.get_dataset_name(raster_file)
+    raster_name = os.path.splitext(os.path.basename(raster_file))[0]
+    polygon_name = os.path.splitext(os.path.basename(polygon_file))[0]
+    return os.path.join(output_dir, f"{polygon_name}_{folder_name}_{raster_name}.parquet")
+
+def process_raster(raster_file, polygon_files, output_dir="disturbance_stats", chunk_size=2048, percentiles=()):
+    """
+    Extracts the polygon statistics of one raster for every polygon set and writes
+    them to Parquet: the polygons' attributes, `dataset`, `polygon` (row of the
+    polygon in its shapefile) and the statistics of `extract_polygon_stats`
+
+    Returns:
+        output_files (list of str): The result files written
+    """
+    output_files = []
+    for polygon_file in polygon_files:
+        polygons = gpd.read_file(polygon_file)
+        with stage('polygon_stats', raster=raster_file, zones=os.path.basename(polygon_file)):
+            stats = extract_polygon_stats(raster_file, polygons, chunk_size, percentiles)
+        table = pd.DataFrame(polygons.drop(columns=polygons.geometry.name))
+        table.insert(0, 'dataset', zonal_stats.get_dataset_name(raster_file))
+        table.insert(1, 'polygon', np.arange(len(polygons)))
+        table = pd.concat([table, stats], axis=1)
+        output_file = get_output_file(raster_file, polygon_file, output_dir)
+        tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        table.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, output_file)
+        print(f"Polygon statistics saved to: {output_file}")
+        output_files.append(output_file)
+    return output_files
+
+def extract_disturbance_stats(raster_files, polygon_files, output_dir="disturbance_stats", workers=1, chunk_size=2048,
+                              percentiles=()):
+    """
+    Extracts polygon statistics of several rasters, `workers` rasters at a time
+
+    Args:
+        raster_files (list of str): Paths to the input raster files
+        polygon_files (list of str): Polygon shapefiles, e.g. fire perimeters and harvest patches
+        output_dir (str): Directory of the result files
+        workers (int): Number of rasters processed at the same time
+        chunk_size (int): Approximate edge length of a chunk in pixels
+        percentiles (list of float): Extra percentiles (0-100)
+
+    Returns:
+        output_files (list of str): The result files written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = []
+    if workers <= 1:
+        for raster_file in raster_files:
+            output_files += process_raster(raster_file, polygon_files, output_dir, chunk_size, percentiles)
+        return output_files
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_raster, raster_file, polygon_files, output_dir, chunk_size, percentiles):
+                   raster_file for raster_file in raster_files}
+        for future in as_completed(futures):
+            try:
+                output_files += future.result()
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                traceback.print_exc()
+    return output_files
+
+if __name__ == "__main__":
+    # Parse arguments
+    directory = "/projects/arctic/share/ABoVE_Biomass"
+    parser = argparse.ArgumentParser(description="Fire and Harvest Polygon Statistics Script")
+    parser.add_argument('--infile', type=str, nargs='+', required=True, help="Masked EPSG:4326 raster file(s)")
+    parser.add_argument('--polygons', type=str, nargs='+', default=[f"{directory}/OtherSpatialDatasets/fire_selected.shp", f"{directory}/OtherSpatialDatasets/VectorizedHarvest.shp"], help="Polygon shapefile(s)")
+    parser.add_argument('--output-dir', type=str, default="disturbance_stats", help="Directory of the Parquet results")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Number of rasters processed at the same time")
+    parser.add_argument('--chunk-size', type=int, default=2048, help="Approximate edge length in pixels of the chunks read")
+    parser.add_argument('--percentiles', type=float, nargs='*', default=[], help="Extra percentile columns, e.g. 10 90")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    # Run script
+    extract_disturbance_stats(args.infile, args.polygons, args.output_dir, args.workers, args.chunk_size,
+                              args.percentiles)
@@ -0,0 +1,440 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+import traceback
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.dtypes import in_dtype_range
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+import shapely
+from shapely.geometry import MultiPoint, box
+from raster_output import OutputFormat
+from run_metrics import tree_rss
+from zone_labels import iter_read_windows
+
+create_common_mask = importlib.import_module('01_create_common_mask')
+combined_mask = importlib.import_module('02_combined_mask')
+apply_common_mask = importlib.import_module('03_apply_common_mask')
+zonal_stats = importlib.import_module('04_zonal_stats')
+
+CRS = 'ESRI:102001'
+
+# Synthetic stand-ins for the inputs of `get_mask_file_paths`: path under the tree,
+# pixel size as a multiple of the 30 m grid, extent as fractions of the 30 m grid
+# (left, top, right, bottom), and the seed of its NA pattern. The extents only
+# partly overlap, like the real products
+SYNTHETIC_RASTERS = {
+    'Duncanson': ("Duncanson2025/Duncanson2025_102001.tif", 1, (0.0, 0.0, 1.0, 1.0), 1),
+    'Guindon': ("Guindon2023/Guindon2023_102001.tif", 3, (-0.05, 0.05, 1.0, 1.05), 2),
+    'Soto': ("Soto-Navarro2020/Soto2020_102001.tif", 10, (-0.1, -0.1, 1.1, 1.1), 3),
+    'SpawnGibbs': ("SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif", 10, (-0.1, -0.05, 1.05, 1.1), 4),
+    'Wang': ("Wang2020/Wang102001.tif", 1, (0.05, 0.0, 1.05, 0.95), 5),
+}
+
+ZONE_SHAPEFILES = {
+    'EPA2': "OtherSpatialDatasets/EPA_ecoregion_lvl2_102001.shp",
+    'Canada': "OtherSpatialDatasets/CanadaAlaska_Boundaries_102001.shp",
+}
+
+def parse_nodata(value):
+    """
+    Returns the nodata convention of a command line value: "nan" (float NaN, as
+    in the Soto and Guindon products), "none" (no nodata, NaN pixels) or a number
+    """
+    if value.lower() == 'none':
+        return None
+    return float(value)
+
+def nodata_label(nodata):
+    if nodata is None:
+        return 'none'
+    return 'nan' if np.isnan(nodata) else f"{nodata:g}"
+
+def make_synthetic_raster(path, width, height, transform, dtype='float32', nodata=np.nan, count=1, seed=0,
+                          na_fraction=0.01, block_size=256):
+    """
+    Writes a synthetic GeoTIFF in ESRI:102001 strip by strip, so any size can be made
+    in bounded memory. Values are random biomass-like numbers (1-400). NA pixels
+    (nodata, or NaN when `nodata` is NaN or None) cover everything outside a
+    seed-dependent elliptical "land" footprint plus `na_fraction` of scattered
+    pixels, so the common NA mask has fully masked, fully valid and mixed tiles
+
+    Args:
+        path (str): Output path
+        width (int): Width in pixels
+        height (int): Height in pixels
+        transform (Affine): Geotransform of the raster
+        dtype (str): Data type, e.g. "float32", "float64" or "int16"
+        nodata (float or None): NoData value, NaN or None for NaN pixels
+        count (int): Number of bands, every band has the same NA pixels
+        seed (int): Seed of the values and the NA pattern
+        na_fraction (float): Fraction of scattered NA pixels inside the footprint
+        block_size (int): Tile size of the GeoTIFF
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fill = np.nan if nodata is None else nodata
+    profile = {
+        'driver': 'GTiff',
+        'dtype': dtype,
+        'count': count,
+        'width': width,
+        'height': height,
+        'crs': CRS,
+        'transform': transform,
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': block_size,
+        'blockysize': block_size,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER'}
+    # Footprint centre and radii in map units, shifted per seed
+    footprint = np.random.default_rng(seed)
+    left, top = transform.c, transform.f
+    right, bottom = left + width * transform.a, top + height * transform.e
+    centre_x = left + (right - left) * footprint.uniform(0.4, 0.6)
+    centre_y = bottom + (top - bottom) * footprint.uniform(0.4, 0.6)
+    radius_x = (right - left) * footprint.uniform(0.4, 0.55)
+    radius_y = (top - bottom) * footprint.uniform(0.4, 0.55)
+    is_integer = np.issubdtype(np.dtype(dtype), np.integer)
+    with rasterio.open(path, 'w', **profile) as dst:
+        x = left + (np.arange(width) + 0.5) * transform.a
+        for row_off in range(0, height, block_size):
+            rows = min(block_size, height - row_off)
+            rng = np.random.default_rng([seed, row_off])
+            y = top + (row_off + np.arange(rows)[:, None] + 0.5) * transform.e
+            na = ((x - centre_x) / radius_x)**2 + ((y - centre_y) / radius_y)**2 > 1
+            na |= rng.random((rows, width)) < na_fraction
+            data = rng.uniform(1, 400, (count, rows, width))
+            data = np.round(data) if is_integer else data
+            data = data.astype(dtype)
+            data[:, na] = fill
+            dst.write(data, window=Window(0, row_off, width, rows))
+
+def make_synthetic_zones(path, bounds, n_zones, zone_type, seed=0):
+    """
+    Writes a synthetic zone shapefile modelled on the EPA level 2 ecoregions (many
+    irregular zones with `NA_L2CODE`/`NA_L2NAME`/`NA_L2KEY`) or the Canada/Alaska
+    boundaries (few large zones with a `postal` code). Zones are the Voronoi cells of
+    random points, cut to a box 10% larger than `bounds`, so edge zones are only
+    partly covered by the rasters, as along the coast and the study area border
+
+    Args:
+        path (str): Output shapefile
+        bounds (tuple): `(left, bottom, right, top)` of the 30 m grid
+        n_zones (int): Number of zones
+        zone_type (str): "EPA2" or "Canada"
+        seed (int): Seed of the zone layout
+    """
+    left, bottom, right, top = bounds
+    pad_x, pad_y = 0.1 * (right - left), 0.1 * (top - bottom)
+    extent = box(left - pad_x, bottom - pad_y, right + pad_x, top + pad_y)
+    rng = np.random.default_rng(seed)
+    points = MultiPoint(np.column_stack([rng.uniform(extent.bounds[0], extent.bounds[2], n_zones),
+                                         rng.uniform(extent.bounds[1], extent.bounds[3], n_zones)]))
+    cells = [cell.intersection(extent) for cell in shapely.voronoi_polygons(points, extend_to=extent).geoms]
+    if zone_type == 'EPA2':
+        codes = [f"{i // 5 + 1}.{i % 5 + 1}" for i in range(len(cells))]
+        names = [f"SYNTHETIC ECOREGION {i + 1}" for i in range(len(cells))]
+        columns = {'NA_L2CODE': codes, 'NA_L2NAME': names,
+                   'NA_L2KEY': [f"{code}  {name}" for code, name in zip(codes, names)]}
+    else:
+        columns = {'postal': [f"{chr(65 + i // 26 % 26)}{chr(65 + i % 26)}" for i in range(len(cells))]}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    gpd.GeoDataFrame(columns, geometry=cells, crs=CRS).to_file(path)
+
+def make_synthetic_tree(directory, size, dtype='float32', nodata=np.nan, count=1, epa_zones=50, canada_zones=14,
+                        seed=0):
+    """
+    Writes synthetic inputs in the layout of the ABoVE Biomass directory, so the
+    scripts run on them unchanged: the rasters of `SYNTHETIC_RASTERS` and the two zone
+    shapefiles. An existing tree is reused
+
+    Args:
+        directory (str): Root of the synthetic tree
+        size (int): Edge length in pixels of the 30 m grid
+        dtype (str): Data type of the rasters
+        nodata (float or None): NoData convention of the rasters
+        count (int): Number of bands of the Duncanson stand-in (the others have one)
+        epa_zones (int): Number of EPA2 zones
+        canada_zones (int): Number of Canada zones
+        seed (int): Seed of the data and zones
+    """
+    extent = 30 * size
+    for name, (path, scale, (x0, y0, x1, y1), offset) in SYNTHETIC_RASTERS.items():
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            continue
+        resolution = 30 * scale
+        width = int((x1 - x0) * extent / resolution)
+        height = int((y1 - y0) * extent / resolution)
+        transform = from_origin(x0 * extent, (1 - y0) * extent, resolution, resolution)
+        make_synthetic_raster(path, width, height, transform, dtype, nodata, count if name == 'Duncanson' else 1,
+                              seed + offset)
+    for zone_type, path in ZONE_SHAPEFILES.items():
+        path = os.path.join(directory, path)
+        if not os.path.exists(path):
+            n_zones = epa_zones if zone_type == 'EPA2' else canada_zones
+            make_synthetic_zones(path, (0, 0, extent, extent), n_zones, zone_type, seed)
+
+def raster_pixels(path):
+    """
+    Returns the number of pixels of one band of a raster
+    """
+    with rasterio.open(path) as src:
+        return src.width * src.height
+
+def compare_rasters(path, reference_path):
+    """
+    Compares a raster with its reference block by block (NaN equals NaN)
+
+    Returns:
+        check (str): "ok", or how the raster differs
+    """
+    with rasterio.open(path) as src, rasterio.open(reference_path) as ref:
+        if (src.width, src.height, src.count) != (ref.width, ref.height, ref.count):
+            return f"shape {src.count}x{src.height}x{src.width} != {ref.count}x{ref.height}x{ref.width}"
+        differ = 0
+        for window in iter_read_windows(src):
+            data, expected = src.read(window=window), ref.read(window=window)
+            same = (data == expected)
+            if np.issubdtype(data.dtype, np.floating):
+                same |= np.isnan(data) & np.isnan(expected)
+            differ += int((~same).sum())
+    return "ok" if differ == 0 else f"{differ} pixels differ"
+
+def read_result_rows(path):
+    """
+    Returns the rows of a zonal statistics text file as `{zone: [values]}`, with
+    None for missing values
+    """
+    rows = {}
+    with open(path) as f:
+        next(f)
+        for line in f:
+            zone, *values = [value.strip() for value in line.split(', ')]
+            rows[zone] = [None if value == 'None' else float(value) for value in values]
+    return rows
+
+def compare_results(path, reference_path, quantile_error=0.005, rtol=1e-5):
+    """
+    Compares zonal statistics with their reference. Mean, sum, std and coverage must
+    agree to `rtol`, the median (sketch or exact) to twice the sketch's error bound
+
+    Returns:
+        check (str): "ok", or how the results differ
+    """
+    rows, expected = read_result_rows(path), read_result_rows(reference_path)
+    if rows.keys() != expected.keys():
+        return "zones differ"
+    differ, worst = 0, 0.0
+    for zone, values in rows.items():
+        for i, (value, reference) in enumerate(zip(values, expected[zone])):
+            if (value is None) != (reference is None):
+                differ += 1
+                worst = np.inf
+                continue
+            if value is None:
+                continue
+            error = abs(value - reference) / max(abs(reference), 1e-12)
+            worst = max(worst, error)
+            if error > (2 * quantile_error if i == 1 else rtol):
+                differ += 1
+    return "ok" if differ == 0 else f"{differ} values differ (max rel. error {worst:.2g})"
+
+def check_output(path, reference_path, update_reference=False):
+    """
+    Compares an output with its reference, or saves it as the reference when there
+    is none yet (or `update_reference` is set)
+    """
+    if update_reference or not os.path.exists(reference_path):
+        os.makedirs(os.path.dirname(reference_path), exist_ok=True)
+        shutil.copyfile(path, reference_path)
+        return "saved as reference"
+    if path.endswith('.txt'):
+        return compare_results(path, reference_path)
+    return compare_rasters(path, reference_path)
+
+def _run_in_child(connection, function, args, kwargs):
+    try:
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        connection.send((time.perf_counter() - start, None))
+    except Exception:
+        connection.send((None, traceback.format_exc()))
+    connection.close()
+
+def run_case(function, *args, **kwargs):
+    """
+    Runs a function in a fresh process and measures its wall time and the peak
+    resident memory of its process tree (worker processes included), so one case's
+    memory does not carry over to the next
+
+    Returns:
+        tuple: A tuple containg:
+            - seconds (float or None): Wall time, None when the function failed
+            - peak_rss (int): Peak memory in bytes
+            - error (str or None): Traceback of a failure
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_in_child, args=(sender, function, args, kwargs))
+    process.start()
+    sender.close()
+    peak = 0
+    while process.is_alive():
+        peak = max(peak, tree_rss(process.pid))
+        process.join(0.05)
+    seconds, error = receiver.recv() if receiver.poll() else (None, f"Exit code {process.exitcode}")
+    return seconds, peak, error
+
+def git_commit():
+    """
+    Returns the commit of the scripts, to tell benchmark results of versions apart
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_cases(directory, output_dir, workers_list, tile_size):
+    """
+    Yields the benchmark cases of one synthetic tree in dependency order. Every case
+    is `(name, workers, function, args, kwargs, output_path, input_path)`, where
+    throughput is counted in pixels of `input_path` (or of the output when None)
+    """
+    other = os.path.join(directory, "OtherSpatialDatasets")
+    dataset = os.path.join(directory, SYNTHETIC_RASTERS['Duncanson'][0])
+    masked = os.path.join(output_dir, "Duncanson2025_102001_masked_Combined.tif")
+    combined = os.path.join(other, "Combined_Mask.tif")
+    for mask_type in ('Canada', 'ABoVE'):
+        output_path = os.path.join(other, f"CommonNA_{mask_type}_Mask.tif")
+        # The full grid mode is the reference the tiled mode is compared with
+        yield (f"create_na_mask {mask_type} (full grid)", 1, create_common_mask.create_na_mask, (mask_type, directory), {},
+               output_path, None)
+        for workers in workers_list:
+            yield (f"create_na_mask_windowed {mask_type}", workers, create_common_mask.create_na_mask_windowed,
+                   (mask_type, directory, tile_size, workers), {}, output_path, None)
+    yield ("combine_masks", 1, combined_mask.combine_masks,
+           (os.path.join(other, "CommonNA_ABoVE_Mask.tif"), os.path.join(other, "CommonNA_Canada_Mask.tif"), combined),
+           {}, combined, None)
+    for workers in workers_list:
+        yield ("apply_na_mask", workers, apply_common_mask.apply_na_mask, (dataset, combined, 'Combined', workers),
+               {'output_format': OutputFormat(), 'output_path': masked}, masked, dataset)
+    for zone_type, shapefile in ZONE_SHAPEFILES.items():
+        shapefile = os.path.join(directory, shapefile)
+        # Each engine has its own output and reference, the engines are compared in tests/
+        output_file = os.path.join(output_dir, f"zonal_stats_labels_{zone_type}.txt")
+        yield (f"zonal_stats labels {zone_type}", 1, zonal_stats.calculate_zonal_stats_parallel,
+               (masked, shapefile, output_file, zone_type, 0.25), {'mask_path': combined}, output_file, masked)
+        output_file = os.path.join(output_dir, f"zonal_stats_polygon_{zone_type}.txt")
+        for workers in workers_list:
+            yield (f"zonal_stats polygon {zone_type}", workers, zonal_stats.calculate_zonal_stats_parallel,
+                   (masked, shapefile, output_file, zone_type, 0.25), {'engine': 'polygon', 'workers': workers},
+                   output_file, masked)
+
+def run_benchmarks(directory, sizes=(2048,), dtypes=('float32',), nodatas=(np.nan,), band_counts=(1,),
+                   workers_list=(1, 4), tile_size=1024, reference_dir=None, update_reference=False, results_path=None,
+                   epa_zones=50, canada_zones=14):
+    """
+    Builds a synthetic tree for every size, data type, nodata convention and band
+    count, then times mask creation, mask combination, mask application and zonal
+    statistics on it for every number of workers. Each case reports its throughput
+    (input pixels per second), the peak memory of its process tree and whether its
+    output matches the reference in `reference_dir`. Outputs without a reference
+    (the first run) become the reference, so running once on the current code and
+    again after a change checks the change against the current outputs
+
+    Args:
+        directory (str): Directory of the synthetic trees and outputs
+        sizes (list of int): Edge lengths in pixels of the 30 m grid
+        dtypes (list of str): Data types of the rasters
+        nodatas (list of float or None): NoData conventions, e.g. NaN, 0.0 and -9999
+        band_counts (list of int): Band counts of the multi-band dataset
+        workers_list (list of int): Numbers of workers of the parallel steps
+        tile_size (int): Tile size of `create_na_mask_windowed`
+        reference_dir (str or None): Reference outputs, `<directory>/reference` when None
+        update_reference (bool): Replace the references with this run's outputs
+        results_path (str or None): JSON lines the results are appended to,
+                                    `<directory>/benchmark_results.jsonl` when None
+        epa_zones (int): Number of synthetic EPA2 zones
+        canada_zones (int): Number of synthetic Canada zones
+
+    Returns:
+        results (list of dict): One record per case
+    """
+    reference_dir = reference_dir or os.path.join(directory, "reference")
+    results_path = results_path or os.path.join(directory, "benchmark_results.jsonl")
+    commit = git_commit()
+    results = []
+    for size in sizes:
+        for dtype in dtypes:
+            for nodata in nodatas:
+                if nodata is not None and not np.isnan(nodata) and not in_dtype_range(nodata, dtype):
+                    print(f"Skipping nodata {nodata_label(nodata)} for {dtype}, it is out of range")
+                    continue
+                if (nodata is None or np.isnan(nodata)) and not np.issubdtype(np.dtype(dtype), np.floating):
+                    print(f"Skipping nodata {nodata_label(nodata)} for {dtype}, it has no NaN")
+                    continue
+                for count in band_counts:
+                    tree = f"{size}px_{dtype}_nodata-{nodata_label(nodata)}_{count}band"
+                    tree_dir = os.path.join(directory, tree)
+                    output_dir = os.path.join(tree_dir, "outputs")
+                    os.makedirs(output_dir, exist_ok=True)
+                    print(f"Synthetic data: {tree}", flush=True)
+                    make_synthetic_tree(tree_dir, size, dtype, nodata, count,
+                                        epa_zones, canada_zones)
+                    for name, workers, function, args, kwargs, output_path, input_path in benchmark_cases(
+                            tree_dir, output_dir, workers_list, tile_size):
+                        seconds, peak, error = run_case(function, *args, **kwargs)
+                        record = {'case': name, 'data': tree, 'workers': workers, 'seconds': seconds,
+                                  'peak_rss': peak, 'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                        if error is None:
+                            pixels = raster_pixels(input_path or output_path)
+                            reference_path = os.path.join(reference_dir, tree, os.path.basename(output_path))
+                            record.update(pixels=pixels, pixels_per_second=pixels / seconds,
+                                          check=check_output(output_path, reference_path, update_reference))
+                        else:
+                            print(error)
+                            record['check'] = "failed"
+                        results.append(record)
+                        with open(results_path, 'a') as f:
+                            f.write(json.dumps(record) + '\n')
+
+    print(f"{'Case':<40}{'Data':<36}{'Workers':>8}{'Time (s)':>10}{'MPixel/s':>10}{'Peak (GB)':>11}  Check")
+    for r in results:
+        if r['seconds'] is None:
+            print(f"{r['case']:<40}{r['data']:<36}{r['workers']:>8}{'-':>10}{'-':>10}{r['peak_rss'] / 1024**3:>11.2f}  {r['check']}")
+            continue
+        print(f"{r['case']:<40}{r['data']:<36}{r['workers']:>8}{r['seconds']:>10.2f}"
+              f"{r['pixels_per_second'] / 1e6:>10.1f}{r['peak_rss'] / 1024**3:>11.2f}  {r['check']}")
+    print(f"Results appended to: {results_path}")
+    return results
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Synthetic Data Benchmark Script")
+    parser.add_argument('--directory', type=str, default="benchmark", help="Directory of the synthetic data, outputs and results")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2048], help="Edge lengths in pixels of the synthetic 30 m grid")
+    parser.add_argument('--dtype', type=str, nargs='+', default=['float32'], help="Data types of the synthetic rasters")
+    parser.add_argument('--nodata', type=parse_nodata, nargs='+', default=[np.nan], help="NoData conventions: nan, none (NaN pixels without nodata) or a value like 0 or -9999")
+    parser.add_argument('--bands', type=int, nargs='+', default=[1], help="Band counts of the multi-band dataset")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, int(os.environ.get('SLURM_CPUS_PER_TASK', 4))], help="Numbers of workers of the parallel steps")
+    parser.add_argument('--tile-size', type=int, default=1024, help="Tile edge length of the windowed NA mask")
+    parser.add_argument('--epa-zones', type=int, default=50, help="Number of synthetic EPA2 zones")
+    parser.add_argument('--canada-zones', type=int, default=14, help="Number of synthetic Canada zones")
+    parser.add_argument('--reference', type=str, default=None, help="Directory of the reference outputs, default <directory>/reference")
+    parser.add_argument('--update-reference', action='store_true', help="Save this run's outputs as the new references")
+    parser.add_argument('--results', type=str, default=None, help="JSON lines file the results are appended to, default <directory>/benchmark_results.jsonl")
+    args = parser.parse_args()
+
+    # Run script
+    run_benchmarks(args.directory, args.sizes, args.dtype, args.nodata, args.bands, args.workers, args.tile_size,
+                   args.reference, args.update_reference, args.results, args.epa_zones, args.canada_zones)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+
+def file_fingerprint(path):
+    """
+    Returns the size and modification time of a file, which change whenever the
+    file is rewritten. Used to tell whether a checkpoint still matches its inputs
+    """
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def checkpoint_key(**items):
+    """
+    Returns a hex digest identifying a run from JSON-serializable items, e.g. the
+    fingerprints of its inputs and its parameters
+    """
+    return hashlib.sha256(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+class BlockCheckpoint:
+    """
+    Progress of a scan that works through a fixed list of windows in order, kept in a
+    sidecar file so a run stopped by the SLURM walltime resumes from the last saved
+    window instead of from the start. The file holds the run's key, the number of
+    windows done and any state needed to continue (e.g. a `ZonalAccumulator`), and
+    is replaced atomically, so it always describes a consistent point of the scan
+
+    Args:
+        path (str): Path of the checkpoint file
+        key (str): Identifies the run, see `checkpoint_key`. A checkpoint written with
+                   another key (changed inputs or parameters) is ignored
+        interval (float): Seconds between saves, 0 saves after every window
+    """
+
+    def __init__(self, path, key, interval=600):
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.last_save = time.monotonic()
+
+    def load(self):
+        """
+        Returns `(completed, state)` from the checkpoint, `(0, None)` when there is
+        none or it belongs to another run
+        """
+        if not os.path.exists(self.path):
+            return 0, None
+        with open(self.path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint['key'] != self.key:
+            print(f"Checkpoint {self.path} is from another run, starting over")
+            return 0, None
+        print(f"Resuming from checkpoint {self.path} after {checkpoint['completed']} windows")
+        return checkpoint['completed'], checkpoint['state']
+
+    def due(self):
+        """
+        Returns whether `interval` seconds have passed since the last save
+        """
+        return time.monotonic() - self.last_save >= self.interval
+
+    def save(self, completed, state=None):
+        """
+        Records that the first `completed` windows are done
+        """
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': self.key, 'completed': completed, 'state': state}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        """
+        Removes the checkpoint once the scan has finished
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
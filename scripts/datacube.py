@@ -0,0 +1,183 @@
+import json
+import math
+import os
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from mask_tools import MaskIndexBuilder
+from tiling import iter_tiles
+
+# Datasets in the datacube, in bit order of the NA bit layer. `band` is the band
+# holding the estimate, None for the last band
+DATACUBE_VARIABLES = [
+    {'name': 'Duncanson2025', 'source': 'Duncanson2025/Duncanson2025_102001.tif', 'band': 1},
+    {'name': 'Guindon2023', 'source': 'Guindon2023/Guindon2023_102001.tif', 'band': None},
+    {'name': 'Matasci2018', 'source': 'Matasci2018/matasci_102001_bigtiff.tif', 'band': None},
+    {'name': 'Soto-Navarro2020', 'source': 'Soto-Navarro2020/Soto2020_102001.tif', 'band': None},
+    {'name': 'SpawnGibbs2020', 'source': 'SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif', 'band': None},
+    {'name': 'Wang2020', 'source': 'Wang2020/Wang102001.tif', 'band': None},
+    {'name': 'Xu2021', 'source': 'Xu2021/Xu2021_102001.tif', 'band': 1},
+]
+
+# Datasets whose NA pixels make up each common NA mask, see `get_mask_file_paths`
+# in `01_create_common_mask.py`
+MASK_VARIABLES = {
+    'Canada': ['Duncanson2025', 'Guindon2023', 'Soto-Navarro2020', 'SpawnGibbs2020'],
+    'ABoVE': ['Duncanson2025', 'Soto-Navarro2020', 'SpawnGibbs2020', 'Wang2020'],
+}
+
+MANIFEST_NAME = 'datacube.json'
+NA_MASK_NAME = 'na_mask.tif'
+
+def calculate_datacube_grid(file_paths, resolution=30, extent='union'):
+    """
+    Calculates the shared grid of the datacube. Its origin is snapped to a multiple
+    of the resolution so rebuilding with other datasets keeps pixels aligned
+
+    Args:
+        file_paths (list of str): A list of file paths to the input raster files
+        resolution (float): Pixel size of the grid in map units (default 30 m)
+        extent (str): "union" covers every dataset, "overlap" only the area they share
+
+    Returns:
+        tuple: A tuple containg:
+            - transform (Affine): The affine transformation of the grid
+            - width (int): The width of the grid in pixels
+            - height (int): The height of the grid in pixels
+    """
+    bounds = []
+    for file_path in file_paths:
+        with rasterio.open(file_path) as src:
+            bounds.append(src.bounds)
+    pick_outer = extent == 'union'
+    left = (min if pick_outer else max)(b.left for b in bounds)
+    bottom = (min if pick_outer else max)(b.bottom for b in bounds)
+    right = (max if pick_outer else min)(b.right for b in bounds)
+    top = (max if pick_outer else min)(b.top for b in bounds)
+    if right <= left or top <= bottom:
+        raise ValueError("The datasets do not overlap")
+
+    left = math.floor(left / resolution) * resolution
+    top = math.ceil(top / resolution) * resolution
+    width = math.ceil((right - left) / resolution)
+    height = math.ceil((top - bottom) / resolution)
+    return Affine(resolution, 0, left, 0, -resolution, top), width, height
+
+class Datacube:
+    """
+    Reads a datacube built by `00_build_datacube.py`: one tiled, compressed float32
+    GeoTIFF per dataset on a shared ESRI:102001 grid (NaN is no data) and an uint8
+    NA bit layer where bit `i` is set when dataset `i` has no data at the pixel.
+    All files share the grid and chunk layout, so a chunk window reads the same
+    pixels from every dataset without any warping
+
+    Args:
+        cube_dir (str): Directory of the datacube
+    """
+
+    def __init__(self, cube_dir):
+        self.cube_dir = cube_dir
+        with open(os.path.join(cube_dir, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        grid = self.manifest['grid']
+        self.crs = CRS.from_wkt(grid['crs'])
+        self.transform = Affine(*grid['transform'])
+        self.width = grid['width']
+        self.height = grid['height']
+        self.chunk_size = grid['chunk_size']
+        self.variables = [variable['name'] for variable in self.manifest['variables']]
+        self._sources = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for src in self._sources.values():
+            src.close()
+        self._sources = {}
+
+    def _open(self, file_name):
+        if file_name not in self._sources:
+            self._sources[file_name] = rasterio.open(os.path.join(self.cube_dir, file_name))
+        return self._sources[file_name]
+
+    def bit(self, name):
+        """
+        Returns the bit of a dataset in the NA bit layer
+        """
+        return self.variables.index(name)
+
+    def chunks(self):
+        """
+        Yields the chunk windows of the datacube, each one tile of every file
+        """
+        return iter_tiles(self.width, self.height, self.chunk_size)
+
+    def read(self, name, window=None):
+        """
+        Returns the float32 values of a dataset in a window (NaN is no data)
+        """
+        variable = self.manifest['variables'][self.bit(name)]
+        return self._open(variable['file']).read(1, window=window)
+
+    def read_bits(self, window=None):
+        """
+        Returns the NA bit layer in a window
+        """
+        return self._open(self.manifest['na_mask']).read(1, window=window)
+
+    def na_mask(self, names, window=None):
+        """
+        Returns True where any of the named datasets has no data in the cube, see
+        `export_na_mask` for how this differs from `01_create_common_mask.py`
+
+        Args:
+            names (list of str): Datasets to combine, e.g. `MASK_VARIABLES['Canada']`
+            window (Window or None): Window to read, the whole grid when None
+        """
+        bits = sum(1 << self.bit(name) for name in names)
+        return (self.read_bits(window) & bits) != 0
+
+def export_na_mask(cube_dir, names, output_path):
+    """
+    Writes a common NA mask (1 = no data) with its tile index from the datacube's
+    bit layer, chunk by chunk and without resampling any dataset. A pixel is masked
+    where any of the named datasets is NaN in the cube. This approximates
+    `create_na_mask` in `01_create_common_mask.py` but is not the same mask: 01 marks
+    a dataset as no data where all of its bands are nodata or NaN, on the grid of
+    the datasets' overlap, while the cube only holds the band with the estimate,
+    bilinearly resampled onto its snapped union (or overlap) grid. Use 01 where the
+    masks must match the masked datasets exactly
+
+    Args:
+        cube_dir (str): Directory of the datacube
+        names (list of str): Datasets whose NA pixels are masked
+        output_path (str): Path of the output mask GeoTIFF
+    """
+    with Datacube(cube_dir) as cube:
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'uint8',
+            'count': 1,
+            'height': cube.height,
+            'width': cube.width,
+            'crs': cube.crs,
+            'transform': cube.transform,
+            'nodata': None,
+            'tiled': True,
+            'blockxsize': min(cube.chunk_size, 512),
+            'blockysize': min(cube.chunk_size, 512),
+            'compress': 'lzw',
+            'BIGTIFF': 'IF_SAFER'}
+        index = MaskIndexBuilder(cube.height, cube.width)
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for window in cube.chunks():
+                mask = cube.na_mask(names, window).astype(np.uint8)
+                dst.write(mask, 1, window=window)
+                index.update(window, mask)
+    print(f"NA mask saved to: {output_path}")
+    index.save(output_path)
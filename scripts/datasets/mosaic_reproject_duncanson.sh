@@ -7,29 +7,10 @@
 #SBATCH --mem=512G                                  # Memory per node
 
 # Load necessary modules
-module load gdal/3.7.2
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+conda activate ABoVE2024  
 
-directory="/projects/arctic/share/ABoVE_Biomass"
-
-# Mosaic - Need a directory of all tiles
-gdalbuildvrt "$directory/Duncanson2025/mosaic.vrt" \
-    "$directory/Duncanson2025/duncanson_tiles/*.tif"
-gdal_translate -of GTiff -co COMPRESS=LZW -co BIGTIFF=YES -co TILED=YES \
-    "$directory/Duncanson2025/mosaic.vrt" \
-    "$directory/Duncanson2025/Duncanson2025_ABoVE_merged.tif"
-
-# Reproject
-gdalwarp -t_srs EPSG:4326 -co COMPRESS=LZW -co BIGTIFF=YES -co TILED=YES \
-    "$directory/Duncanson2025/Duncanson2025_ABoVE_merged.tif" \
-    "$directory/Duncanson2025/Duncanson2025_epsg4326.tif"
-gdal_translate -of VRT -projwin -170 85 -50 40 \
-    "$directory/Duncanson2025/Duncanson2025_epsg4326.tif" \
-    "$directory/Duncanson2025/subset_esri.vrt"
-gdalwarp -t_srs "ESRI:102001" -dstnodata -9999 -co COMPRESS=LZW \
-    -co BIGTIFF=YES -co TILED=YES "$directory/Duncanson2025/subset_esri.vrt" \
-    "$directory/Duncanson2025/Duncanson2025_102001.tif"
-
-# Make into a bigtiff for better memory usage
-gdal_translate -of GTiff -co BIGTIFF=YES -co COMPRESS=LZW -co TILED=YES \
-    "$directory/Duncanson2025/Duncanson2025_102001.tif" \
-    "$directory/Duncanson2025/Duncanson2025_102001.tif"
\ No newline at end of file
+# Mosaic the tiles, cut them to -170..-50 E, 40..85 N in EPSG:4326 and warp to
+# ESRI:102001 in one pass, only the final BigTIFF is written
+python3 warp_pipeline.py duncanson --workers "$SLURM_CPUS_PER_TASK" --warp-memory 8192 "$@"
@@ -7,15 +7,9 @@
 #SBATCH --mem=512G                          # Memory per node
 
 # Load necessary modules
-module load gdal/3.7.2
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+conda activate ABoVE2024  
 
-directory="/projects/arctic/share/ABoVE_Biomass"
-
-# Reproject
-gdalwarp -t_srs ESRI:102001 -co COMPRESS=LZW -co BIGTIFF=YES -co TILED=YES \
-    "$directory/Matasci2018/matasci_4326.tif" \
-    "$directory/Matasci2018/matasci_102001.tif"
-
-# Make into a bigtif for better memory
-gdal_translate -of GTiff -co BIGTIFF=YES "$directory/Matasci2018/matasci_102001.tif" \
- "$directory/Matasci2018/matasci_102001_bigtiff.tif"
\ No newline at end of file
+# Reproject to ESRI:102001, written straight to a tiled BigTIFF
+python3 warp_pipeline.py matasci --workers "$SLURM_CPUS_PER_TASK" --warp-memory 8192 "$@"
@@ -0,0 +1,254 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from xml.sax.saxutils import escape
+import rasterio
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import from_bounds
+
+# Helpers shared with the scripts one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from job_memory import gdal_cache_bytes, plan_concurrency
+
+# GDAL names of the data types a mosaic VRT can hold
+GDAL_TYPE_NAMES = {
+    'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16',
+    'uint32': 'UInt32', 'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64',
+}
+
+# Creation options of every output, the options the shell scripts passed to gdalwarp
+CREATION_OPTIONS = {'COMPRESS': 'LZW', 'TILED': 'YES', 'BIGTIFF': 'YES'}
+
+# Jobs of each pipeline, paths relative to the ABoVE Biomass directory. `inputs` is
+# a glob, several files are mosaicked first. `subset` is a (left, bottom, right,
+# top) box in `subset_crs` the data is cut to before warping to `dst_crs`
+PIPELINES = {
+    # mosaic_reproject_duncanson.sh: tiles -> EPSG:4326 -> -170..-50 E, 40..85 N -> ESRI:102001
+    'duncanson': [
+        {'name': 'Duncanson2025', 'inputs': 'Duncanson2025/duncanson_tiles/*.tif',
+         'subset': (-170, 40, -50, 85), 'subset_crs': 'EPSG:4326', 'dst_crs': 'ESRI:102001',
+         'dst_nodata': -9999, 'output': 'Duncanson2025/Duncanson2025_102001.tif'},
+    ],
+    # reproject_matasci.sh
+    'matasci': [
+        {'name': 'Matasci2018', 'inputs': 'Matasci2018/matasci_4326.tif', 'dst_crs': 'ESRI:102001',
+         'output': 'Matasci2018/matasci_102001_bigtiff.tif'},
+    ],
+    # reproject_datasets_epsg4326.sh
+    'epsg4326': [
+        {'name': 'Duncanson2025', 'inputs': 'Duncanson2025/Duncanson2025_BigTIFF_masked_Combined.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'Duncanson2025/Duncanson2025_BigTIFF_masked_Combined_4326.tif'},
+        {'name': 'Guindon2023', 'inputs': 'Guindon2023/Guindon2023_102001_masked_Canada.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'Guindon2023/Guindon2023_4326_masked_Canada.tif'},
+        {'name': 'Matasci2018', 'inputs': 'Matasci2018/matasci_102001_bigtiff_masked_Canada.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'Matasci2018/matasci_4326_bigtiff_masked_Canada.tif'},
+        {'name': 'Soto-Navarro2020', 'inputs': 'Soto-Navarro2020/Soto2020_102001_masked_Combined.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'Soto-Navarro2020/Soto2020_4326_masked_Combined.tif'},
+        {'name': 'SpawnGibbs2020', 'inputs': 'SpawnGibbs2020/SpawnGibbs2020_mask_102001_masked_Combined.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'SpawnGibbs2020/SpawnGibbs2020_mask_4326_masked_Combined.tif'},
+        {'name': 'Wang2020', 'inputs': 'Wang2020/Wang102001_masked_ABoVE.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'Wang2020/Wang4326_masked_ABoVE.tif'},
+        {'name': 'Xu2021', 'inputs': 'Xu2021/Xu2021_102001_masked_Combined.tif',
+         'dst_crs': 'EPSG:4326', 'output': 'Xu2021/Xu2021_4326_masked_Combined.tif'},
+    ],
+}
+
+def log_step(name, step, start, output_path=None):
+    """
+    Prints the wall time of a pipeline step and the bytes it wrote
+
+    Returns:
+        record (tuple): `(name, step, seconds, bytes_written)`
+    """
+    seconds = time.perf_counter() - start
+    written = os.path.getsize(output_path) if output_path else 0
+    print(f"{name}: {step} took {seconds:.1f} s, {written / 1024**2:.1f} MB written")
+    return name, step, seconds, written
+
+def build_mosaic_vrt(tile_paths):
+    """
+    Builds the XML of a VRT mosaicking tiles that share a CRS, resolution, band
+    count and data type, what `gdalbuildvrt` wrote to `mosaic.vrt`. Nodata pixels
+    of a tile do not cover the tiles before it
+
+    Args:
+        tile_paths (list of str): The tiles, later tiles are drawn on top
+
+    Returns:
+        xml (str): The VRT, which rasterio opens like a file path
+    """
+    tiles = []
+    for path in tile_paths:
+        with rasterio.open(path) as src:
+            tiles.append((os.path.abspath(path), src.bounds, src.width, src.height, src.crs, src.res,
+                          src.count, src.dtypes[0], src.nodata, src.block_shapes[0]))
+    crs, res, count, dtype = tiles[0][4:8]
+    for path, _, _, _, tile_crs, tile_res, tile_count, tile_dtype, _, _ in tiles:
+        if (tile_crs, tile_res, tile_count, tile_dtype) != (crs, res, count, dtype):
+            raise ValueError(f"{path} does not share the CRS, resolution, bands and data type of the mosaic")
+
+    left = min(tile[1].left for tile in tiles)
+    top = max(tile[1].top for tile in tiles)
+    width = round((max(tile[1].right for tile in tiles) - left) / res[0])
+    height = round((top - min(tile[1].bottom for tile in tiles)) / res[1])
+    nodata = tiles[0][8]
+
+    lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+             f'  <SRS>{escape(crs.to_wkt())}</SRS>',
+             f'  <GeoTransform>{left!r}, {res[0]!r}, 0, {top!r}, 0, {-res[1]!r}</GeoTransform>']
+    for band in range(1, count + 1):
+        lines.append(f'  <VRTRasterBand dataType="{GDAL_TYPE_NAMES[dtype]}" band="{band}">')
+        if nodata is not None:
+            lines.append(f'    <NoDataValue>{nodata!r}</NoDataValue>')
+        for path, bounds, tile_width, tile_height, _, _, _, _, tile_nodata, block_shape in tiles:
+            x_off = round((bounds.left - left) / res[0])
+            y_off = round((top - bounds.top) / res[1])
+            source = 'ComplexSource' if tile_nodata is not None else 'SimpleSource'
+            lines += [f'    <{source}>',
+                      f'      <SourceFilename relativeToVRT="0">{escape(path)}</SourceFilename>',
+                      f'      <SourceBand>{band}</SourceBand>',
+                      f'      <SourceProperties RasterXSize="{tile_width}" RasterYSize="{tile_height}" '
+                      f'DataType="{GDAL_TYPE_NAMES[dtype]}" BlockXSize="{block_shape[1]}" BlockYSize="{block_shape[0]}" />',
+                      f'      <SrcRect xOff="0" yOff="0" xSize="{tile_width}" ySize="{tile_height}" />',
+                      f'      <DstRect xOff="{x_off}" yOff="{y_off}" xSize="{tile_width}" ySize="{tile_height}" />']
+            if tile_nodata is not None:
+                lines.append(f'      <NODATA>{tile_nodata!r}</NODATA>')
+            lines.append(f'    </{source}>')
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+    return '\n'.join(lines)
+
+def warp_vrt(src, crs, bounds=None, nodata=None, warp_memory=512, warp_threads=1):
+    """
+    Returns an in-memory warped VRT of a dataset in another CRS on the grid gdalwarp
+    would pick, optionally cut to a box in that CRS on the same grid (what
+    `gdal_translate -projwin` did to a warped file). Nothing is computed until the
+    VRT is read
+
+    Args:
+        src (DatasetReader): The dataset, which may itself be a VRT
+        crs (str): The target CRS
+        bounds (tuple or None): `(left, bottom, right, top)` in `crs` to keep, all when None
+        nodata (float or None): Nodata value of the output, the source's when None
+        warp_memory (int): GDAL warp memory in MB
+        warp_threads (int): Threads warping each chunk
+
+    Returns:
+        vrt (WarpedVRT): The warped dataset
+    """
+    crs = CRS.from_user_input(crs)
+    transform, width, height = calculate_default_transform(src.crs, crs, src.width, src.height, *src.bounds)
+    if bounds is not None:
+        window = from_bounds(*bounds, transform=transform).round_offsets().round_lengths()
+        transform = rasterio.windows.transform(window, transform)
+        width, height = int(window.width), int(window.height)
+    options = {'crs': crs, 'transform': transform, 'width': width, 'height': height,
+               'resampling': Resampling.nearest, 'warp_mem_limit': warp_memory,
+               'warp_extras': {'NUM_THREADS': warp_threads}}
+    if nodata is not None:
+        options['nodata'] = nodata
+    return WarpedVRT(src, **options)
+
+def run_warp_job(job, directory, warp_memory=512, warp_threads=1):
+    """
+    Runs one job of a pipeline in a single pass: mosaic, subset and reprojection are
+    chained as in-memory VRTs and only the final GeoTIFF is written, read once by
+    GDAL's copy and warped chunk by chunk. The VRTs only read data during the copy,
+    so the job is logged as one step
+
+    Args:
+        job (dict): An entry of `PIPELINES`
+        directory (str): Root directory of the ABoVE Biomass datasets
+        warp_memory (int): GDAL warp memory in MB
+        warp_threads (int): Threads warping and compressing the output
+
+    Returns:
+        records (list of tuple): The `log_step` record of the job
+    """
+    name = job['name']
+    output_path = os.path.join(directory, job['output'])
+    steps = []
+    with ExitStack() as stack:
+        start = time.perf_counter()
+        input_paths = sorted(glob.glob(os.path.join(directory, job['inputs'])))
+        if not input_paths:
+            raise FileNotFoundError(f"No input matches {job['inputs']}")
+        if len(input_paths) > 1:
+            src = stack.enter_context(rasterio.open(build_mosaic_vrt(input_paths)))
+            steps.append(f"mosaic of {len(input_paths)} tiles")
+        else:
+            src = stack.enter_context(rasterio.open(input_paths[0]))
+
+        if job.get('subset'):
+            src = stack.enter_context(warp_vrt(src, job['subset_crs'], job['subset'],
+                                               warp_memory=warp_memory, warp_threads=warp_threads))
+            steps.append(f"subset to {job['subset']} in {job['subset_crs']}")
+
+        vrt = stack.enter_context(warp_vrt(src, job['dst_crs'], nodata=job.get('dst_nodata'),
+                                           warp_memory=warp_memory, warp_threads=warp_threads))
+        # NUM_THREADS also compresses the output's tiles in parallel
+        rasterio.shutil.copy(vrt, output_path, driver='GTiff', NUM_THREADS=warp_threads, **CREATION_OPTIONS)
+        steps.append(f"warp to {job['dst_crs']} ({vrt.width} x {vrt.height})")
+        record = log_step(name, ", ".join(steps), start, output_path)
+    print(f"Warped dataset saved to: {output_path}")
+    return [record]
+
+def run_warp_jobs(jobs, directory, workers=1, memory_budget=None, warp_memory=512):
+    """
+    Runs several jobs at once. Jobs run in separate processes, largest input first,
+    and share the `workers` threads between them. No more jobs run at once than
+    their warp memory and GDAL block cache fit in `memory_budget`
+
+    Args:
+        jobs (list of dict): Entries of `PIPELINES`
+        directory (str): Root directory of the ABoVE Biomass datasets
+        workers (int): Total number of threads across all jobs
+        memory_budget (int or None): Memory limit in bytes, None for no limit
+        warp_memory (int): GDAL warp memory of each job in MB
+    """
+    def input_size(job):
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(directory, job['inputs'])))
+
+    jobs = sorted(jobs, key=input_size, reverse=True)
+    # Every job holds its warp memory and a GDAL block cache, whatever its thread count
+    concurrent, threads = plan_concurrency(jobs, workers, memory_budget,
+                                           lambda job, threads: warp_memory * 1024**2 + gdal_cache_bytes())
+    print(f"Warping {len(jobs)} datasets, {concurrent} at a time with {threads} threads "
+          f"and {warp_memory} MB of warp memory each")
+
+    records = []
+    if concurrent == 1:
+        for job in jobs:
+            records += run_warp_job(job, directory, warp_memory, threads)
+    else:
+        with ProcessPoolExecutor(max_workers=concurrent) as executor:
+            futures = [executor.submit(run_warp_job, job, directory, warp_memory, threads) for job in jobs]
+            for future in as_completed(futures):
+                records += future.result()
+
+    print(f"{'Dataset':<20} {'Steps':<100} {'Time (s)':>10} {'Written (MB)':>14}")
+    for name, step, seconds, written in records:
+        print(f"{name:<20} {step:<100} {seconds:>10.1f} {written / 1024**2:>14.1f}")
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Single Pass Mosaic and Reprojection Script")
+    parser.add_argument('pipeline', type=str, nargs='+', choices=sorted(PIPELINES), help="Pipelines to run, their jobs run concurrently")
+    parser.add_argument('--directory', type=str, default="/projects/arctic/share/ABoVE_Biomass", help="Root directory of the ABoVE Biomass datasets")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Total number of threads")
+    parser.add_argument('--memory-budget', type=float, default=None, help="Memory limit in GB for datasets warped at once")
+    parser.add_argument('--warp-memory', type=int, default=2048, help="GDAL warp memory per dataset in MB")
+    args = parser.parse_args()
+
+    # Run script
+    jobs = [job for pipeline in args.pipeline for job in PIPELINES[pipeline]]
+    memory_budget = int(args.memory_budget * 1024**3) if args.memory_budget else None
+    run_warp_jobs(jobs, args.directory, args.workers, memory_budget, args.warp_memory)
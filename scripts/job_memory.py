@@ -0,0 +1,37 @@
+import os
+
+def gdal_cache_bytes(default_mb=512):
+    """
+    Returns the size of GDAL's block cache in bytes: `GDAL_CACHEMAX` in MB, or
+    `default_mb` when it is unset or given as a percentage
+    """
+    cache_mb = os.environ.get('GDAL_CACHEMAX', str(default_mb))
+    return (int(cache_mb) if cache_mb.isdigit() else default_mb) * 1024**2
+
+def plan_concurrency(jobs, workers, memory_budget=None, estimate=None):
+    """
+    Splits `workers` threads between jobs run at once in separate processes: one job
+    per thread at most, and no more jobs at once than the largest ones fit in
+    `memory_budget`
+
+    Args:
+        jobs (list): The jobs, largest first
+        workers (int): Total number of threads across all jobs
+        memory_budget (int or None): Memory limit in bytes, None for no limit
+        estimate (callable or None): `estimate(job, threads)` returns the peak memory
+                                     in bytes of a job run with `threads` threads
+
+    Returns:
+        tuple: A tuple containg:
+            - concurrent (int): Number of jobs run at once
+            - threads (int): Number of threads of each job
+    """
+    concurrent = max(1, min(len(jobs), workers))
+    if memory_budget is not None:
+        # Drop jobs running at once until the largest ones fit in the budget
+        while concurrent > 1:
+            threads = max(1, workers // concurrent)
+            if sum(estimate(job, threads) for job in jobs[:concurrent]) <= memory_budget:
+                break
+            concurrent -= 1
+    return concurrent, max(1, workers // concurrent)
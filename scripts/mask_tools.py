@@ -0,0 +1,283 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.warp import reproject, Resampling
+from rasterio.windows import Window
+
+# Tile states recorded in a mask's tile index
+TILE_VALID, TILE_MASKED, TILE_MIXED = 0, 1, 2
+
+def mask_index_path(mask_path):
+    """
+    Returns the path of the tile index sidecar of a mask, `<mask>_tiles.npz`
+    """
+    return os.path.splitext(mask_path)[0] + '_tiles.npz'
+
+class MaskIndexBuilder:
+    """
+    Builds the tile index of a mask while it is written. The mask is split into
+    square tiles and every tile is recorded as fully valid (no pixel masked), fully
+    masked or mixed. Windows can be added in any order and need not line up with
+    the tiles, since only the number of masked pixels per tile is kept
+
+    Args:
+        height (int): Height of the mask in pixels
+        width (int): Width of the mask in pixels
+        tile_size (int): Edge length of an index tile in pixels
+    """
+
+    def __init__(self, height, width, tile_size=256):
+        self.height = height
+        self.width = width
+        self.tile_size = tile_size
+        shape = (-(-height // tile_size), -(-width // tile_size))
+        self.masked = np.zeros(shape, dtype=np.int64)
+        self.total = np.zeros(shape, dtype=np.int64)
+
+    def update(self, window, mask_block):
+        """
+        Adds a written window of the mask (non-zero pixels are masked)
+
+        Args:
+            window (Window): Where the block sits in the mask
+            mask_block (numpy.ndarray): The mask values of the window
+        """
+        row_tiles = (int(window.row_off) + np.arange(mask_block.shape[0])) // self.tile_size
+        col_tiles = (int(window.col_off) + np.arange(mask_block.shape[1])) // self.tile_size
+        row_starts = np.flatnonzero(np.diff(row_tiles, prepend=-1))
+        col_starts = np.flatnonzero(np.diff(col_tiles, prepend=-1))
+        masked = np.add.reduceat(np.add.reduceat(mask_block.astype(bool).astype(np.int64), row_starts, axis=0),
+                                 col_starts, axis=1)
+        rows = np.diff(np.append(row_starts, mask_block.shape[0]))
+        cols = np.diff(np.append(col_starts, mask_block.shape[1]))
+        tiles = np.ix_(row_tiles[row_starts], col_tiles[col_starts])
+        self.masked[tiles] += masked
+        self.total[tiles] += np.outer(rows, cols)
+
+    def save(self, mask_path):
+        """
+        Writes the tile index next to the mask. Call it after the mask is closed, the
+        mask's size and modification time are stored to detect stale indexes
+        """
+        status = np.full(self.masked.shape, TILE_MIXED, dtype=np.uint8)
+        status[self.masked == 0] = TILE_VALID
+        status[self.masked == self.total] = TILE_MASKED
+        stat = os.stat(mask_path)
+        np.savez_compressed(mask_index_path(mask_path), status=status, tile_size=self.tile_size,
+                            height=self.height, width=self.width,
+                            mask_size=stat.st_size, mask_mtime=stat.st_mtime_ns)
+        counts = np.bincount(status.ravel(), minlength=3)
+        print(f"Tile index saved to: {mask_index_path(mask_path)} "
+              f"({counts[TILE_VALID]} valid, {counts[TILE_MASKED]} masked, {counts[TILE_MIXED]} mixed tiles)")
+
+class MaskIndex:
+    """
+    The tile index of a mask, see `MaskIndexBuilder`
+
+    Args:
+        status (numpy.ndarray): State of every tile
+        tile_size (int): Edge length of a tile in pixels
+    """
+
+    def __init__(self, status, tile_size):
+        self.status = status
+        self.tile_size = tile_size
+
+    def window_status(self, row_lo, row_hi, col_lo, col_hi):
+        """
+        Returns the state of the mask pixels in rows `row_lo..row_hi` and columns
+        `col_lo..col_hi` (inclusive): TILE_VALID, TILE_MASKED or TILE_MIXED
+        """
+        t = self.tile_size
+        tiles = self.status[row_lo // t:row_hi // t + 1, col_lo // t:col_hi // t + 1]
+        if (tiles == TILE_VALID).all():
+            return TILE_VALID
+        if (tiles == TILE_MASKED).all():
+            return TILE_MASKED
+        return TILE_MIXED
+
+def load_mask_index(mask_path):
+    """
+    Loads the tile index of a mask
+
+    Args:
+        mask_path (str): Path to the mask
+
+    Returns:
+        index (MaskIndex or None): The index, or None when there is none or it is
+        older than the mask
+    """
+    path = mask_index_path(mask_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as index:
+        stat = os.stat(mask_path)
+        if int(index['mask_size']) != stat.st_size or int(index['mask_mtime']) != stat.st_mtime_ns:
+            print(f"Tile index {path} is stale, ignoring it")
+            return None
+        return MaskIndex(index['status'], int(index['tile_size']))
+
+def combine_status(first, second):
+    """
+    Returns the state of a window made of two parts with the given states
+    """
+    return first if first == second else TILE_MIXED
+
+class Grid:
+    """
+    A raster grid without a file, e.g. the coarse grid of a decimated read, that
+    `MaskAligner` aligns a mask to the same way as an open dataset
+
+    Args:
+        crs (CRS): The coordinate reference system of the grid
+        transform (Affine): The affine transformation of the grid
+        width (int): The width of the grid in pixels
+        height (int): The height of the grid in pixels
+    """
+
+    def __init__(self, crs, transform, width, height):
+        self.crs = crs
+        self.transform = transform
+        self.width = width
+        self.height = height
+
+    def window_transform(self, window):
+        """
+        Returns the affine transformation of a window of the grid
+        """
+        return rasterio.windows.transform(window, self.transform)
+
+def is_index_aligned(mask_src, src):
+    """
+    Checks whether nearest-neighbour resampling of a mask onto a dataset is a pure
+    index computation: both share a CRS and neither grid is rotated, so a dataset
+    column always maps to the same mask column and a row to the same mask row
+
+    Args:
+        mask_src (DatasetReader): The open mask
+        src (DatasetReader): The open dataset
+
+    Returns:
+        aligned (bool): True when `build_mask_lookup` can replace `reproject`
+    """
+    if mask_src.crs is None or src.crs is None or mask_src.crs != src.crs:
+        return False
+    return all(t.b == 0 and t.d == 0 for t in (mask_src.transform, src.transform))
+
+def build_mask_lookup(mask_src, src):
+    """
+    Computes, for every dataset row and column, the mask row and column whose pixel
+    contains the dataset pixel's centre (what GDAL's nearest resampling picks).
+    Pixels outside the mask get -1
+
+    Args:
+        mask_src (DatasetReader): The open mask
+        src (DatasetReader): The open dataset
+
+    Returns:
+        tuple: A tuple containg:
+            - row_lookup (numpy.ndarray): Mask row of every dataset row
+            - col_lookup (numpy.ndarray): Mask column of every dataset column
+    """
+    dataset, mask = src.transform, mask_src.transform
+    x = dataset.c + (np.arange(src.width) + 0.5) * dataset.a
+    y = dataset.f + (np.arange(src.height) + 0.5) * dataset.e
+    col_lookup = np.floor((x - mask.c) / mask.a).astype(np.int64)
+    row_lookup = np.floor((y - mask.f) / mask.e).astype(np.int64)
+    col_lookup[(col_lookup < 0) | (col_lookup >= mask_src.width)] = -1
+    row_lookup[(row_lookup < 0) | (row_lookup >= mask_src.height)] = -1
+    return row_lookup, col_lookup
+
+class MaskAligner:
+    """
+    Reads a mask aligned to windows of a dataset. When the mask and dataset are
+    index aligned (see `is_index_aligned`) the mask pixels are gathered with the
+    row/column lookups computed once per dataset, otherwise every window is warped
+    with `reproject` as before. Both give the mask's nodata value (or 0) outside
+    the mask, the same as `reproject`
+
+    Args:
+        mask_src (DatasetReader): The open mask
+        src (DatasetReader or Grid): The open dataset
+        lookups (tuple or None): `build_mask_lookup` result to share between
+                                 aligners of the same dataset, computed when None
+        index (MaskIndex or None): Tile index of the mask, used by `window_status`
+    """
+
+    def __init__(self, mask_src, src, lookups=None, index=None):
+        self.mask_src = mask_src
+        self.src = src
+        self.fill = mask_src.nodata if mask_src.nodata is not None else 0
+        if lookups is None and is_index_aligned(mask_src, src):
+            lookups = build_mask_lookup(mask_src, src)
+        self.lookups = lookups
+        self.index = index
+
+    def window_status(self, window):
+        """
+        Returns whether a window of the dataset is fully valid (TILE_VALID), fully
+        masked (TILE_MASKED) or mixed (TILE_MIXED) from the mask's tile index,
+        without reading the mask. Without an index or lookups it is always mixed
+        """
+        if self.lookups is None or self.index is None:
+            return TILE_MIXED
+        row_lookup, col_lookup = self.lookups
+        rows = row_lookup[int(window.row_off):int(window.row_off + window.height)]
+        cols = col_lookup[int(window.col_off):int(window.col_off + window.width)]
+        row_valid, col_valid = rows >= 0, cols >= 0
+        fill_status = TILE_MASKED if self.fill else TILE_VALID
+        if not row_valid.any() or not col_valid.any():
+            return fill_status
+        rows, cols = rows[row_valid], cols[col_valid]
+        status = self.index.window_status(rows.min(), rows.max(), cols.min(), cols.max())
+        if not row_valid.all() or not col_valid.all():
+            status = combine_status(status, fill_status)
+        return status
+
+    def read(self, window):
+        """
+        Returns the uint8 mask for a window of the dataset
+        """
+        if self.lookups is None:
+            return self._reproject(window)
+        row_lookup, col_lookup = self.lookups
+        rows = row_lookup[int(window.row_off):int(window.row_off + window.height)]
+        cols = col_lookup[int(window.col_off):int(window.col_off + window.width)]
+        mask_aligned = np.full((window.height, window.width), self.fill, dtype=np.uint8)
+        row_valid, col_valid = rows >= 0, cols >= 0
+        if not row_valid.any() or not col_valid.any():
+            return mask_aligned
+        rows, cols = rows[row_valid], cols[col_valid]
+        row_lo, col_lo = rows.min(), cols.min()
+        row_span, col_span = rows.max() - row_lo + 1, cols.max() - col_lo + 1
+
+        if row_span <= 4 * len(rows):
+            # Dataset at or finer than the mask resolution: one read covers the window
+            block = self.mask_src.read(1, window=Window(col_lo, row_lo, col_span, row_span))
+            mask_aligned[np.ix_(row_valid, col_valid)] = block[np.ix_(rows - row_lo, cols - col_lo)]
+        else:
+            # Dataset much coarser than the mask: read only the mask rows that are used
+            gathered = np.empty((len(rows), len(cols)), dtype=np.uint8)
+            for mask_row in np.unique(rows):
+                line = self.mask_src.read(1, window=Window(col_lo, mask_row, col_span, 1))[0]
+                gathered[rows == mask_row] = line[cols - col_lo]
+            mask_aligned[np.ix_(row_valid, col_valid)] = gathered
+        return mask_aligned
+
+    def _reproject(self, window):
+        # Create a np array to fill in with masked values
+        mask_aligned = np.empty((window.height, window.width), dtype=np.uint8)
+
+        # Reproject the mask to align with the current window
+        reproject(
+            source=rasterio.band(self.mask_src, 1),
+            destination=mask_aligned,
+            src_transform=self.mask_src.transform,
+            src_crs=self.mask_src.crs,
+            dst_transform=self.src.window_transform(window),
+            dst_crs=self.src.crs,
+            dst_width=window.width,
+            dst_height=window.height,
+            resampling=Resampling.nearest
+        )
+        return mask_aligned
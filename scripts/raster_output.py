@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+OUTPUT_FORMATS = ['source', 'tiled', 'cog']
+
+def overview_factors(width, height, block_size):
+    """
+    Returns the overview decimation factors (2, 4, 8, ...) needed until the smallest
+    overview fits in a single block
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+class OutputFormat:
+    """
+    Layout of the rasters written by `02_combined_mask.py` and `03_apply_common_mask.py`
+
+    - "source": the profile of the input as before (block size, compression and
+      predictor are whatever the input used, no overviews)
+    - "tiled": square `block_size` tiles, `compress` with a predictor chosen from
+      the data type, BigTIFF when the file could pass 4 GB, and internal overviews
+      built on the open output once the data is written
+    - "cog": the "tiled" output rewritten by GDAL's COG driver, which moves the
+      metadata and overviews to the front of the file (Cloud Optimized GeoTIFF
+      layout). This costs an extra copy of the file
+
+    Args:
+        format (str): One of `OUTPUT_FORMATS`
+        block_size (int): Tile edge length in pixels (a multiple of 16)
+        compress (str): Compression, e.g. "zstd" or "deflate"
+        resampling (str): Overview resampling, e.g. "average" for data, "nearest" for masks
+    """
+
+    def __init__(self, format='source', block_size=512, compress='zstd', resampling='average'):
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {format}")
+        self.format = format
+        self.block_size = block_size
+        self.compress = compress
+        self.resampling = Resampling[resampling]
+
+    def __str__(self):
+        if self.format == 'source':
+            return 'source'
+        return f"{self.format} {self.compress} {self.block_size}px"
+
+    @classmethod
+    def from_args(cls, args, resampling='average'):
+        """
+        Builds the format from the arguments added by `add_output_format_arguments`,
+        with `resampling` for the overviews unless `--overview-resampling` is given
+        """
+        return cls(args.output_format, args.block_size, args.compress, args.overview_resampling or resampling)
+
+    def predictor(self, dtype):
+        """
+        Returns the TIFF predictor for a data type: 3 (floating point) or 2 (horizontal)
+        """
+        return 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+
+    def profile(self, profile):
+        """
+        Returns the output profile for a profile built as before
+        """
+        if self.format == 'source':
+            return profile
+        profile = dict(profile)
+        for key in ('blockxsize', 'blockysize', 'compress', 'predictor', 'interleave', 'BIGTIFF'):
+            profile.pop(key, None)
+        profile.update({
+            'driver': 'GTiff',
+            'tiled': True,
+            'blockxsize': self.block_size,
+            'blockysize': self.block_size,
+            'compress': self.compress,
+            'predictor': self.predictor(profile['dtype']),
+            'BIGTIFF': 'IF_SAFER'})
+        return profile
+
+    def write_path(self, output_path):
+        """
+        Returns where the output is written before `finalize`
+        """
+        if self.format == 'cog':
+            return os.path.splitext(output_path)[0] + '.tiled.tif'
+        return output_path
+
+    def discard(self, output_path):
+        """
+        Removes the temporary output of a failed write, if the format has one
+        """
+        write_path = self.write_path(output_path)
+        if write_path != output_path and os.path.exists(write_path):
+            os.remove(write_path)
+
+    def finish(self, dst):
+        """
+        Builds the internal overviews of an output that is still open for writing
+        """
+        if self.format == 'source':
+            return
+        factors = overview_factors(dst.width, dst.height, self.block_size)
+        if not factors:
+            return
+        with rasterio.Env(GDAL_TIFF_OVR_BLOCKSIZE=self.block_size,
+                          PREDICTOR_OVERVIEW=self.predictor(dst.dtypes[0])):
+            dst.build_overviews(factors, self.resampling)
+        dst.update_tags(ns='rio_overview', resampling=self.resampling.name)
+
+    def finalize(self, output_path):
+        """
+        Rewrites the closed "tiled" output in COG layout for the "cog" format,
+        reusing its overviews
+        """
+        if self.format != 'cog':
+            return
+        write_path = self.write_path(output_path)
+        rasterio.shutil.copy(write_path, output_path, driver='COG', BLOCKSIZE=self.block_size,
+                             COMPRESS=self.compress.upper(), PREDICTOR='YES', BIGTIFF='IF_SAFER',
+                             OVERVIEWS='FORCE_USE_EXISTING')
+        os.remove(write_path)
+
+def add_external_overviews(raster_path, max_factor, resampling='nearest', block_size=512):
+    """
+    Builds overviews of a raster with factors 2, 4, ... up to `max_factor` into a
+    `<raster>.ovr` sidecar. The raster itself is not modified, so its size and
+    modification time (and the checkpoints keyed on them) stay the same
+
+    Args:
+        raster_path (str): Path to the raster
+        max_factor (int): Largest decimation factor, a power of 2
+        resampling (str): Overview resampling
+        block_size (int): Tile edge length of the overviews in pixels
+    """
+    factors = [2 ** i for i in range(1, max_factor.bit_length())]
+    with rasterio.Env(TIFF_USE_OVR=True, GDAL_TIFF_OVR_BLOCKSIZE=block_size):
+        with rasterio.open(raster_path, 'r+') as dst:
+            dst.build_overviews(factors, Resampling[resampling])
+    print(f"Overviews {factors} ({resampling}) saved to: {raster_path}.ovr")
+
+def add_output_format_arguments(parser):
+    """
+    Adds the `--output-format`, `--block-size` and `--compress` options to a script
+    """
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, default='source', help="Keep the input's layout (source), write tiled GeoTIFFs with overviews (tiled) or Cloud Optimized GeoTIFFs (cog)")
+    parser.add_argument('--block-size', type=int, default=512, help="Tile size in pixels for tiled and cog output")
+    parser.add_argument('--compress', type=str, default='zstd', help="Compression for tiled and cog output (zstd, deflate, lzw)")
+    parser.add_argument('--overview-resampling', type=str, default=None, help="Overview resampling, average for data and nearest for masks by default (nearest data overviews also serve zonal stats previews)")
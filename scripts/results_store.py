@@ -0,0 +1,274 @@
+import argparse
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columns identifying one set of results, the partition columns first
+PARTITION_COLUMNS = [("zone_set", pa.string()), ("dataset", pa.string())]
+KEY_COLUMNS = PARTITION_COLUMNS + [("mask_type", pa.string()), ("coverage_ratio", pa.float64()),
+                                   ("band", pa.int16()), ("preview_level", pa.int16())]
+STAT_COLUMNS = ["mean", "median", "sum", "std", "coverage"]
+PARTITIONING = ds.partitioning(pa.schema(PARTITION_COLUMNS), flavor='hive')
+
+def percentile_columns(columns):
+    """
+    Returns the `p<percentile>` columns among `columns`
+    """
+    return [column for column in columns if re.fullmatch(r"p\d+(\.\d+)?", column)]
+
+def get_txt_name(zone_set, dataset, mask_type, coverage_ratio, preview_level=0):
+    """
+    Returns the legacy result file name, `zonal_stats_{type}_{folder}_{mask}_{percent}.txt`,
+    with a `_preview{level}` suffix for preview results
+    """
+    suffix = f"_preview{preview_level}" if preview_level > 0 else ""
+    return f"zonal_stats_{zone_set}_{dataset}_{mask_type}_{int(coverage_ratio * 100)}{suffix}.txt"
+
+# Legacy result file names, see `get_txt_name`
+TXT_NAME = re.compile(r"zonal_stats_(?P<zone_set>[^_]+)_(?P<dataset>.+)_(?P<mask_type>[^_]+)_(?P<percent>\d+)"
+                      r"(?:_preview(?P<preview_level>\d+))?\.txt")
+
+def parse_txt_name(txt_file):
+    """
+    Returns the keys of a legacy result file from its name, see `get_txt_name`, or
+    None when it is not one (e.g. a `_preview{level}_error.txt` file)
+    """
+    match = TXT_NAME.fullmatch(os.path.basename(txt_file))
+    if match is None:
+        return None
+    return {'zone_set': match['zone_set'], 'dataset': match['dataset'], 'mask_type': match['mask_type'],
+            'coverage_ratio': int(match['percent']) / 100, 'preview_level': int(match['preview_level'] or 0)}
+
+def read_txt(txt_file):
+    """
+    Reads a legacy result file written by `write_txt`
+
+    Returns:
+        tuple: A tuple containg:
+            - results (list of tuple): `(zone_name, mean, median, sum, std, coverage, *percentiles)` tuples
+            - percentiles (list of float): Percentiles of the extra columns
+    """
+    with open(txt_file) as f:
+        columns = [column.strip() for column in f.readline().split(',')]
+        rows = [[value.strip() for value in line.split(',')] for line in f if line.strip()]
+    percentiles = [float(column[1:]) for column in columns[6:]]
+    results = [tuple([row[0]] + [None if value == 'None' else float(value) for value in row[1:]]) for row in rows]
+    return results, percentiles
+
+def write_txt(results, output_file, percentiles=()):
+    """
+    Writes zonal statistics results to the legacy comma separated text format
+
+    Args:
+        results (list of tuple): `(zone_name, mean, median, sum, std, coverage, *percentiles)` tuples
+        output_file (str): Path to the output file
+        percentiles (list of float): Percentiles of the extra columns, e.g. `[10, 90]` adds `P10, P90`
+    """
+    print(f"Writing results to file: {output_file}")
+    columns = ["Zone", "Mean", "Median", "Sum", "Std", "Coverage"] + [f"P{p:g}" for p in percentiles]
+    with open(output_file, 'w') as f:
+        f.write(", ".join(columns) + " \n")
+        for result in results:
+            f.write(", ".join(str(value) for value in result) + " \n")
+
+def results_table(results, percentiles=(), **keys):
+    """
+    Returns zonal statistics results as a typed table, with nulls for zones without
+    results and the result set's keys repeated on every row
+
+    Args:
+        results (list of tuple): `(zone_name, mean, median, sum, std, coverage, *percentiles)` tuples
+        percentiles (list of float): Percentiles of the extra columns, stored as `p<percentile>`
+        **keys: `dataset`, `zone_set`, `mask_type`, `coverage_ratio`, `band` and `preview_level`
+
+    Returns:
+        table (pyarrow.Table): One row per zone
+    """
+    columns = {name: pa.array([keys[name]] * len(results), type=type) for name, type in KEY_COLUMNS}
+    values = list(zip(*results)) if results else [()] * (6 + len(percentiles))
+    columns['zone'] = pa.array([str(zone) for zone in values[0]], type=pa.string())
+    names = STAT_COLUMNS + [f"p{p:g}" for p in percentiles]
+    for name, column in zip(names, values[1:]):
+        columns[name] = pa.array([None if value is None else float(value) for value in column], type=pa.float64())
+    return pa.table(columns)
+
+def append_results(store, tables, written_at=None):
+    """
+    Adds result tables of one dataset and zone set to the store as a new file in its
+    `zone_set=<type>/dataset=<folder>` partition. The file is written under a hidden
+    name and renamed into place, so concurrent jobs can append without locking and
+    readers never see a partial file. Every file gets a `written_at` time, and a
+    result set written again replaces the earlier one when read back
+
+    Args:
+        store (str): Directory of the results store
+        tables (list of pyarrow.Table): Tables from `results_table` sharing their partition
+        written_at (datetime or None): When the results were computed, now when None
+
+    Returns:
+        output_file (str): The file written
+    """
+    table = pa.concat_tables(tables, promote_options='default')
+    partition = {}
+    for name, _ in PARTITION_COLUMNS:
+        values = table.column(name).unique().to_pylist()
+        if len(values) != 1:
+            raise ValueError(f"Results span several values of {name}: {values}")
+        partition[name] = values[0]
+    table = table.drop_columns([name for name, _ in PARTITION_COLUMNS])
+    written_at = pa.array([written_at or datetime.now(timezone.utc)] * len(table), type=pa.timestamp('us', tz='UTC'))
+    table = table.append_column('written_at', written_at)
+
+    directory = os.path.join(store, *(f"{name}={value}" for name, value in partition.items()))
+    os.makedirs(directory, exist_ok=True)
+    name = f"{uuid.uuid4().hex}.parquet"
+    tmp_file = os.path.join(directory, f".{name}.tmp")
+    pq.write_table(table, tmp_file)
+    output_file = os.path.join(directory, name)
+    os.replace(tmp_file, output_file)
+    print(f"Results added to store: {output_file}")
+    return output_file
+
+def open_results(store):
+    """
+    Returns the results store as a pyarrow dataset. The schema is unified over all
+    files, so percentile columns missing from some files read as nulls
+    """
+    factory = ds.FileSystemDatasetFactory(pa.fs.LocalFileSystem(), pa.fs.FileSelector(os.path.abspath(store),
+                                                                                       recursive=True),
+                                          ds.ParquetFileFormat(), ds.FileSystemFactoryOptions(partitioning=PARTITIONING))
+    return factory.finish(factory.inspect(fragments=None))
+
+def results_filter(**filters):
+    """
+    Returns a dataset filter expression from `column=value` or `column=[values]`
+    arguments, None without filters
+    """
+    expression = None
+    for name, value in filters.items():
+        if value is None:
+            continue
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        condition = ds.field(name).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def read_results(store, columns=None, latest=True, **filters):
+    """
+    Reads zonal statistics from the results store in one scan. Filters on the
+    partition columns (`zone_set`, `dataset`) skip whole directories and the others
+    are checked against the row group statistics before any data is read
+
+    Args:
+        store (str): Directory of the results store
+        columns (list of str or None): Columns to read, all when None. The key columns
+                                       and `written_at` are always read
+        latest (bool): Keep only the most recently written version of every result set
+        **filters: `column=value` or `column=[values]`, e.g. `zone_set='EPA2', coverage_ratio=0.5`
+
+    Returns:
+        results (pandas.DataFrame): One row per zone and result set
+    """
+    keys = [name for name, _ in KEY_COLUMNS]
+    if columns is not None:
+        columns = keys + [column for column in columns if column not in keys] + ['written_at']
+    table = open_results(store).to_table(columns=columns, filter=results_filter(**filters))
+    results = table.to_pandas()
+    results = results[keys + [column for column in results.columns if column not in keys]]
+    if latest and len(results):
+        newest = results.groupby(keys, dropna=False, sort=False)['written_at'].transform('max')
+        results = results[results['written_at'] == newest].reset_index(drop=True)
+    return results
+
+def export_txt(store, output_dir, **filters):
+    """
+    Writes the latest version of every result set in the store to the legacy text
+    files, named by `get_txt_name`
+
+    Args:
+        store (str): Directory of the results store
+        output_dir (str): Directory of the text files
+        **filters: Result sets to export, see `read_results`
+
+    Returns:
+        output_files (list of str): The files written
+    """
+    results = read_results(store, **filters)
+    keys = [name for name, _ in KEY_COLUMNS]
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = []
+    for key, rows in results.groupby(keys, dropna=False, sort=False):
+        key = dict(zip(keys, key))
+        # Percentile columns missing from the result set's file read back all null
+        percentiles = [column for column in percentile_columns(rows.columns) if rows[column].notna().any()]
+        rows = rows[['zone'] + STAT_COLUMNS + percentiles].astype(object)
+        rows = rows.where(rows.notna(), None)
+        output_file = os.path.join(output_dir, get_txt_name(key['zone_set'], key['dataset'], key['mask_type'],
+                                                            key['coverage_ratio'], key['preview_level']))
+        write_txt(list(rows.itertuples(index=False, name=None)), output_file,
+                  [float(column[1:]) for column in percentiles])
+        output_files.append(output_file)
+    return output_files
+
+def import_txt(store, txt_files, band=None):
+    """
+    Adds legacy result files to the store, with their keys parsed from the file
+    names and the files' modification times as `written_at`, so results computed
+    since then still win when the store is read. Result sets already in the store are
+    skipped, so importing the same files again adds nothing
+
+    Args:
+        store (str): Directory of the results store
+        txt_files (list of str): Legacy result files, other files are skipped
+        band (int or None): Band the results were read from, unknown (null) when None
+
+    Returns:
+        output_files (list of str): The store files written
+    """
+    keys = [name for name, _ in KEY_COLUMNS]
+    existing = set()
+    if os.path.isdir(store):
+        stored = read_results(store, columns=[], latest=False)[keys].drop_duplicates()
+        existing = {tuple(key) for key in stored.astype(object).where(stored.notna(), None).itertuples(index=False)}
+    output_files = []
+    for txt_file in sorted(txt_files):
+        key = parse_txt_name(txt_file)
+        if key is None:
+            print(f"Not a zonal statistics result file, skipping: {txt_file}")
+            continue
+        key['band'] = band
+        if tuple(key[name] for name in keys) in existing:
+            print(f"Already in the store, skipping: {txt_file}")
+            continue
+        results, percentiles = read_txt(txt_file)
+        written_at = datetime.fromtimestamp(os.path.getmtime(txt_file), timezone.utc)
+        output_files.append(append_results(store, [results_table(results, percentiles, **key)], written_at))
+    return output_files
+
+if __name__ == "__main__":
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Export the zonal statistics results store to text files, or import text files into it")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="Write the latest results to text files")
+    export_parser.add_argument('store', type=str, help="Directory of the results store")
+    export_parser.add_argument('--output-dir', type=str, default="zonal_stats", help="Directory of the text files")
+    export_parser.add_argument('--dataset', type=str, nargs='+', default=None, help="Datasets to export, all by default")
+    export_parser.add_argument('--zone-set', type=str, nargs='+', default=None, help="Zone sets to export, all by default")
+    export_parser.add_argument('--coverage-ratio', type=float, nargs='+', default=None, help="Coverage ratios to export, all by default")
+    import_parser = commands.add_parser('import', help="Add legacy zonal_stats_*.txt files to the store")
+    import_parser.add_argument('store', type=str, help="Directory of the results store")
+    import_parser.add_argument('txt_files', type=str, nargs='+', help="Legacy result files")
+    import_parser.add_argument('--band', type=int, default=None, help="Band the results were read from, unknown by default")
+    args = parser.parse_args()
+
+    # Run script
+    if args.command == 'export':
+        export_txt(args.store, args.output_dir, dataset=args.dataset, zone_set=args.zone_set,
+                   coverage_ratio=args.coverage_ratio)
+    else:
+        import_txt(args.store, args.txt_files, args.band)
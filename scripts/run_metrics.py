@@ -0,0 +1,421 @@
+import argparse
+import atexit
+import ctypes
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from multiprocessing.util import Finalize
+
+# Settings are passed to worker processes through the environment, so every
+# process of a run appends to the same metrics file
+METRICS_ENV = 'ABOVE_METRICS'
+PROFILE_ENV = 'ABOVE_PROFILE'
+
+_state = {'pid': None, 'file': None, 'gdal': None, 'sampler': None, 'profiler': None}
+_lock = threading.Lock()
+
+def _after_fork():
+    # Another thread may have held the lock while the process forked
+    global _lock
+    _lock = threading.Lock()
+    _state['sampler'] = None
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def metrics_enabled():
+    """
+    Returns whether metrics are being recorded in this process
+    """
+    return bool(os.environ.get(METRICS_ENV))
+
+def _open_metrics():
+    # Reopen after a fork so every process appends through its own handle
+    if _state['pid'] != os.getpid():
+        _state['pid'] = os.getpid()
+        _state['file'] = open(os.environ[METRICS_ENV], 'a', buffering=1)
+        if os.environ.get(PROFILE_ENV):
+            _state['profiler'] = SamplingProfiler(f"{os.environ[PROFILE_ENV]}.{os.getpid()}")
+            _state['profiler'].start()
+    return _state['file']
+
+def emit(event, **fields):
+    """
+    Appends one JSON line `{"event": ..., "pid": ..., "time": ..., **fields}` to the
+    metrics file. Does nothing when metrics are disabled
+    """
+    if not metrics_enabled():
+        return
+    line = json.dumps(dict(event=event, pid=os.getpid(), time=round(time.time(), 3), **fields), default=str)
+    with _lock:
+        _open_metrics().write(line + '\n')
+
+def thread_io():
+    """
+    Returns the I/O counters of the calling thread from `/proc`: `rchar`/`wchar`
+    (bytes passed to read/write calls, whether or not they reached the disk) and
+    `read_bytes`/`write_bytes` (bytes fetched from or sent to storage). Zeros where
+    `/proc` is not available. `rchar` counts the read of the counters itself, its
+    length is returned as `own`
+    """
+    try:
+        with open(f"/proc/self/task/{threading.get_native_id()}/io") as f:
+            text = f.read()
+        counters = dict(line.split(': ') for line in text.splitlines())
+        io = {key: int(counters[key]) for key in ('rchar', 'wchar', 'read_bytes', 'write_bytes')}
+        io['rchar'] += len(text)
+        io['own'] = len(text)
+        return io
+    except OSError:
+        return {'rchar': 0, 'wchar': 0, 'read_bytes': 0, 'write_bytes': 0, 'own': 0}
+
+def process_io():
+    """
+    Returns the I/O counters of the whole process, see `thread_io`
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return {key: int(counters[key]) for key in ('rchar', 'wchar', 'read_bytes', 'write_bytes')}
+    except OSError:
+        return {'rchar': 0, 'wchar': 0, 'read_bytes': 0, 'write_bytes': 0}
+
+def gdal_cache():
+    """
+    Returns `(used, max)` bytes of GDAL's block cache, read from the GDAL library
+    rasterio has loaded, or `(None, None)` when it cannot be found
+    """
+    if _state['gdal'] is None:
+        _state['gdal'] = False
+        try:
+            with open('/proc/self/maps') as f:
+                paths = [line.split()[-1] for line in f if 'libgdal' in line]
+            if paths:
+                lib = ctypes.CDLL(paths[0])
+                lib.GDALGetCacheUsed64.restype = ctypes.c_int64
+                lib.GDALGetCacheMax64.restype = ctypes.c_int64
+                _state['gdal'] = lib
+        except OSError:
+            pass
+    if not _state['gdal']:
+        return None, None
+    return _state['gdal'].GDALGetCacheUsed64(), _state['gdal'].GDALGetCacheMax64()
+
+def peak_rss():
+    """
+    Returns the peak resident memory in bytes of this process and of its largest
+    finished child process
+    """
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    child_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return self_peak, child_peak
+
+def tree_rss(pid=None):
+    """
+    Returns the resident memory in bytes of a process and all its descendants, what
+    counts against the SLURM `--mem` request
+    """
+    pid = pid or os.getpid()
+    page = os.sysconf('SC_PAGE_SIZE')
+    total, pending = 0, [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * page
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{tid}/children") as f:
+                    pending += [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+    return total
+
+class MemorySampler(threading.Thread):
+    """
+    Samples `tree_rss` in the background and keeps the peak of every open stage, as
+    `ru_maxrss` only knows single processes and not a pool running side by side
+
+    Args:
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, interval=0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peaks = {}
+
+    def run(self):
+        while True:
+            rss = tree_rss()
+            for key in list(self.peaks):
+                self.peaks[key] = max(self.peaks.get(key, 0), rss)
+            time.sleep(self.interval)
+
+class SamplingProfiler(threading.Thread):
+    """
+    A statistical profiler: every `interval` seconds it records the Python stack of
+    every thread of the process. Stacks are written in the collapsed format read by
+    flamegraph.pl and speedscope (`frame;frame;frame count`), every 10 s and at exit
+
+    Args:
+        output_path (str): Path of the collapsed stacks
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, output_path, interval=0.01):
+        super().__init__(daemon=True)
+        self.output_path = output_path
+        self.interval = interval
+        self.stacks = Counter()
+        atexit.register(self.save)
+        Finalize(None, self.save, exitpriority=10)  # Pool workers skip atexit
+
+    def run(self):
+        last_save = time.monotonic()
+        while True:
+            # Leave out the profiler and the memory sampler themselves
+            skip = {threading.get_ident(), getattr(_state['sampler'], 'ident', None)}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skip:
+                    continue
+                stack = [f"{os.path.basename(f.f_code.co_filename)}:{f.f_code.co_name}"
+                         for f, _ in traceback.walk_stack(frame)]
+                self.stacks[';'.join(reversed(stack))] += 1
+            if time.monotonic() - last_save > 10:
+                self.save()
+                last_save = time.monotonic()
+            time.sleep(self.interval)
+
+    def save(self):
+        with open(self.output_path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class stage:
+    """
+    Context manager recording a stage of a script (e.g. masking one dataset): wall
+    and CPU time (including finished child processes), bytes read and written by
+    the process, GDAL cache use, peak RSS of the process and of its process tree.
+    Extra fields can be added to `fields` inside the block. Failures are recorded
+    with `"error"` and re-raised
+
+    Args:
+        name (str): Name of the stage
+        **fields: Extra fields of the record, e.g. the dataset
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        if not metrics_enabled():
+            return self.fields
+        _open_metrics()
+        if _state['sampler'] is None:
+            _state['sampler'] = MemorySampler()
+            _state['sampler'].start()
+        _state['sampler'].peaks[id(self)] = tree_rss()
+        self.io = process_io()
+        self.cpu = os.times()
+        self.start = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc, tb):
+        if not metrics_enabled():
+            return False
+        seconds = time.perf_counter() - self.start
+        cpu = os.times()
+        io = process_io()
+        cache_used, cache_max = gdal_cache()
+        self_peak, child_peak = peak_rss()
+        tree_peak = max(_state['sampler'].peaks.pop(id(self), 0), tree_rss())
+        if exc is not None:
+            self.fields['error'] = repr(exc)
+        emit('stage', name=self.name, seconds=round(seconds, 3),
+             cpu_seconds=max(0, round(sum(cpu[:4]) - sum(self.cpu[:4]), 3)),
+             bytes_read=io['rchar'] - self.io['rchar'], bytes_written=io['wchar'] - self.io['wchar'],
+             disk_read=io['read_bytes'] - self.io['read_bytes'], disk_written=io['write_bytes'] - self.io['write_bytes'],
+             gdal_cache_used=cache_used, gdal_cache_max=cache_max, peak_rss=self_peak, child_peak_rss=child_peak,
+             tree_peak_rss=tree_peak, **self.fields)
+        return False
+
+class _NoBlock:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_BLOCK = _NoBlock()
+
+class _Block:
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __enter__(self):
+        self.io = thread_io()
+        self.start = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        io = thread_io()
+        read = io['rchar'] - io['own'] - self.io['rchar']
+        cache_hit = self.fields.pop('cache_hit', None)
+        if cache_hit is None and self.fields.get('pixels'):
+            cache_hit = read == 0
+        emit(self.event, seconds=round(seconds, 6), bytes_read=read, bytes_written=io['wchar'] - self.io['wchar'],
+             cache_hit=cache_hit, **self.fields)
+        return False
+
+def block(event, **fields):
+    """
+    Context manager recording one block, tile or zone: wall time, bytes read and
+    written by the calling thread and, when `pixels` is set, whether the block was
+    served from GDAL's block cache (GDAL counts no hits, so a block that made no
+    read call at all is taken as a hit). Fields added to the yielded dict are recorded too (e.g. `pixels`
+    or split timings). Costs nothing when metrics are disabled
+
+    Args:
+        event (str): Name of the record, e.g. "mask_block"
+        **fields: Extra fields, e.g. the window
+    """
+    if not metrics_enabled():
+        return _NO_BLOCK
+    return _Block(event, fields)
+
+def window_fields(window):
+    """
+    Returns a window as record fields
+    """
+    return {'col_off': int(window.col_off), 'row_off': int(window.row_off),
+            'width': int(window.width), 'height': int(window.height)}
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize_metrics(metrics_path, top=5):
+    """
+    Prints a report of a metrics file: every stage with its time, CPU use, I/O and
+    memory, per event the count, time distribution, bytes and cache hit rate, the
+    slowest records of each event (e.g. the zone a run is stuck on) and the
+    numbers to size `--mem` and `--cpus-per-task` with
+
+    Args:
+        metrics_path (str): The JSON lines written during the run
+        top (int): Number of slowest records listed per event
+    """
+    records = []
+    with open(metrics_path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # A line cut off by a killed process
+    stages = [r for r in records if r['event'] == 'stage']
+    events = defaultdict(list)
+    for r in records:
+        if r['event'] != 'stage':
+            events[r['event']].append(r)
+
+    gb = 1024**3
+    print(f"Metrics report for {metrics_path}")
+    print(f"{'Stage':<48}{'Wall (s)':>10}{'CPU (s)':>10}{'CPU/wall':>10}{'Read (GB)':>11}{'Written (GB)':>14}{'Peak RSS (GB)':>15}")
+    for r in stages:
+        label = ' '.join([r['name']] + [os.path.basename(str(v)) for k, v in r.items()
+                                        if k in ('step', 'dataset', 'raster', 'type', 'zones', 'output')])
+        cpu_ratio = r['cpu_seconds'] / r['seconds'] if r['seconds'] else 0
+        print(f"{label[:47]:<48}{r['seconds']:>10.1f}{r['cpu_seconds']:>10.1f}{cpu_ratio:>10.2f}"
+              f"{r['bytes_read'] / gb:>11.2f}{r['bytes_written'] / gb:>14.2f}{r['tree_peak_rss'] / gb:>15.2f}"
+              + ("  FAILED" if 'error' in r else ""))
+
+    if events:
+        print(f"\n{'Event':<20}{'Count':>10}{'Total (s)':>12}{'Mean (ms)':>12}{'p95 (ms)':>12}{'Max (ms)':>12}"
+              f"{'Read (GB)':>11}{'Cache hits':>12}")
+    for event, rs in events.items():
+        seconds = [r['seconds'] for r in rs]
+        hits = [r['cache_hit'] for r in rs if r.get('cache_hit') is not None]
+        hit_rate = f"{sum(hits) / len(hits):.0%}" if hits else "-"
+        print(f"{event:<20}{len(rs):>10}{sum(seconds):>12.1f}{1000 * sum(seconds) / len(rs):>12.1f}"
+              f"{1000 * percentile(seconds, 0.95):>12.1f}{1000 * max(seconds):>12.1f}"
+              f"{sum(r.get('bytes_read', 0) for r in rs) / gb:>11.2f}{hit_rate:>12}")
+    for event, rs in events.items():
+        if 'zone' in rs[0]:
+            # Per-zone totals show a zone that keeps one worker busy
+            zones = defaultdict(float)
+            for r in rs:
+                zones[r['zone']] += r['seconds']
+            slowest = sorted(zones.items(), key=lambda item: -item[1])[:top]
+            print(f"\nSlowest zones ({event}): " + ", ".join(f"{zone} {seconds:.1f} s" for zone, seconds in slowest))
+        else:
+            slowest = sorted(rs, key=lambda r: -r['seconds'])[:top]
+            print(f"\nSlowest {event} windows: " + ", ".join(
+                f"{r['seconds']:.2f} s at ({r.get('col_off')}, {r.get('row_off')})" for r in slowest))
+
+    if stages:
+        peak = max(r['tree_peak_rss'] for r in stages)
+        wall = sum(r['seconds'] for r in stages if r.get('top_level'))
+        cpu = sum(r['cpu_seconds'] for r in stages if r.get('top_level'))
+        print(f"\nPeak memory of the process tree: {peak / gb:.1f} GB (add headroom for --mem)")
+        if wall:
+            print(f"Average busy cores: {cpu / wall:.1f} (CPU time / wall time, compare with --cpus-per-task)")
+
+def add_metrics_arguments(parser):
+    """
+    Adds the `--metrics` and `--profile` options to a script
+    """
+    parser.add_argument('--metrics', type=str, default=os.environ.get(METRICS_ENV), help="Append stage, block and zone metrics as JSON lines to this file and print a report at the end")
+    parser.add_argument('--profile', type=str, default=os.environ.get(PROFILE_ENV), help="Sample Python stacks of every process into <path>.<pid> (collapsed stacks for flamegraph.pl/speedscope)")
+
+def setup_metrics(args):
+    """
+    Turns on metrics for this process and the worker processes it starts, from the
+    `add_metrics_arguments` options. The report is printed when the script exits,
+    with the error of the run stage taken from an uncaught exception
+    """
+    if args.profile:
+        os.environ[PROFILE_ENV] = os.path.abspath(args.profile)
+        if not args.metrics:
+            args.metrics = f"{args.profile}.metrics.jsonl"
+    if not args.metrics:
+        return
+    os.environ[METRICS_ENV] = os.path.abspath(args.metrics)
+    _open_metrics()
+    main_pid = os.getpid()
+    run = stage('run', top_level=True, command=' '.join(sys.argv))
+    run.__enter__()
+
+    # `sys.exc_info()` is always empty in an atexit handler, so keep the uncaught
+    # exception from the excepthook, which runs before the handlers
+    exc_info = [None, None, None]
+    excepthook = sys.excepthook
+
+    def record_exception(*exc):
+        exc_info[:] = exc
+        excepthook(*exc)
+    sys.excepthook = record_exception
+
+    def finish():
+        if os.getpid() != main_pid:
+            return
+        run.__exit__(*exc_info)
+        _state['file'].flush()
+        summarize_metrics(os.environ[METRICS_ENV])
+    atexit.register(finish)
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Run Metrics Report Script")
+    parser.add_argument('metrics', type=str, help="JSON lines written with --metrics")
+    parser.add_argument('--top', type=int, default=5, help="Number of slowest records listed per event")
+    args = parser.parse_args()
+
+    # Run script
+    summarize_metrics(args.metrics, args.top)
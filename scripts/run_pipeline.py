@@ -0,0 +1,357 @@
+import argparse
+import fnmatch
+import hashlib
+import importlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from raster_output import OutputFormat, add_output_format_arguments
+from run_metrics import add_metrics_arguments, setup_metrics, stage
+
+create_common_mask = importlib.import_module('01_create_common_mask')
+combined_mask = importlib.import_module('02_combined_mask')
+apply_common_mask = importlib.import_module('03_apply_common_mask')
+zonal_stats = importlib.import_module('04_zonal_stats')
+
+MANIFEST_NAME = 'pipeline_manifest.json'
+
+# Datasets masked with each mask, as in `03_apply_common_mask.py`. Paths are
+# relative to the ABoVE Biomass directory
+MASKED_DATASETS = {
+    'ABoVE': ['Wang2020/Wang102001.tif'],
+    'Canada': ['Guindon2023/Guindon2023_102001.tif', 'Matasci2018/matasci_102001_bigtiff.tif'],
+    'Combined': ['Soto-Navarro2020/Soto2020_102001.tif', 'SpawnGibbs2020/SpawnGibbs2020_mask_102001.tif',
+                 'Duncanson2025/Duncanson2025_102001.tif', 'Xu2021/Xu2021_102001.tif'],
+}
+
+# Zone sets of the zonal statistics, relative to the ABoVE Biomass directory
+ZONE_SETS = {
+    'EPA2': 'OtherSpatialDatasets/EPA_ecoregion_lvl2_102001.shp',
+    'Canada': 'OtherSpatialDatasets/CanadaAlaska_Boundaries_102001.shp',
+}
+
+def get_mask_path(directory, name):
+    """
+    Returns the path of a mask made by steps 01 and 02
+    """
+    if name == 'Combined':
+        return f"{directory}/OtherSpatialDatasets/Combined_Mask.tif"
+    return f"{directory}/OtherSpatialDatasets/CommonNA_{name}_Mask.tif"
+
+def shapefile_paths(shapefile):
+    """
+    Returns the files of a shapefile whose contents define the zones
+    """
+    stem = os.path.splitext(shapefile)[0]
+    return [f"{stem}.shp", f"{stem}.dbf", f"{stem}.prj"]
+
+def create_mask_step(type, directory, tile_size, workers):
+    """
+    01: the common NA mask of a region
+    """
+    create_common_mask.create_na_mask_windowed(type, directory, tile_size, workers)
+
+def combine_masks_step(directory, output_format):
+    """
+    02: the combined mask of the ABoVE and Canada masks
+    """
+    combined_mask.combine_masks(get_mask_path(directory, 'ABoVE'), get_mask_path(directory, 'Canada'),
+                                get_mask_path(directory, 'Combined'), output_format)
+
+def apply_mask_step(dataset_path, mask_path, name, workers, output_format, checkpoint_interval):
+    """
+    03: one masked dataset, resuming from its block checkpoint
+    """
+    if apply_common_mask.apply_na_mask(dataset_path, mask_path, name, workers, output_format,
+                                       checkpoint_interval=checkpoint_interval) is None:
+        raise RuntimeError(f"Masking {dataset_path} failed")
+
+def zonal_stats_step(raster_file, zone_sets, coverage_ratios, mask_path, output_dir, cache_dir, checkpoint_interval):
+    """
+    04: the zonal statistics of one masked dataset for every zone set and coverage
+    ratio, resuming from the scan checkpoints in `<output_dir>/checkpoints`. Results
+    go to the store in `<output_dir>/results` and to the text files tracked as outputs
+    """
+    zonal_stats.process_raster_batch(raster_file, zone_sets, coverage_ratios, mask_path, output_dir=output_dir,
+                                     cache_dir=cache_dir, checkpoint_dir=os.path.join(output_dir, 'checkpoints'),
+                                     checkpoint_interval=checkpoint_interval,
+                                     results_store=os.path.join(output_dir, 'results'))
+
+def build_pipeline(directory, output_dir, coverage_ratios=(0.45,), workers=1, tile_size=4096, output_format=None,
+                   checkpoint_interval=600, mask_format=None):
+    """
+    Builds the steps of 01 -> 02 -> 03 -> 04 as a DAG. A step depends only on the
+    steps that make its inputs: datasets under the Canada or ABoVE mask are masked as
+    soon as that mask exists, without waiting for the combined mask
+
+    Args:
+        directory (str): Root directory of the ABoVE Biomass datasets
+        output_dir (str): Directory of the zonal statistics results
+        coverage_ratios (list of float): Coverage ratios of the zonal statistics
+        workers (int): Threads or processes given to every step
+        tile_size (int): Tile size of the common NA masks, see `create_na_mask_windowed`
+        output_format (OutputFormat or None): Layout of the masked datasets
+        checkpoint_interval (float): Seconds between block checkpoints of 03 and 04
+        mask_format (OutputFormat or None): Layout of the combined mask, with nearest
+                                            overviews by default
+
+    Returns:
+        steps (list of dict): Every step with its name, the steps it depends on, the
+        call that runs it, its input and output files and the parameters its outputs
+        depend on
+    """
+    output_format = output_format or OutputFormat()
+    mask_format = mask_format or OutputFormat(resampling='nearest')
+    output_dir = os.path.abspath(output_dir)
+    cache_dir = f"{directory}/OtherSpatialDatasets/zone_label_cache"
+    zone_sets = {file_type: f"{directory}/{shapefile}" for file_type, shapefile in ZONE_SETS.items()}
+    steps = []
+
+    for type in ('Canada', 'ABoVE'):
+        mask_path = get_mask_path(directory, type)
+        steps.append({
+            'name': f"01 {type} mask", 'deps': [],
+            'call': (create_mask_step, (type, directory, tile_size, workers)),
+            'inputs': create_common_mask.get_mask_file_paths(type, directory),
+            'outputs': [mask_path],
+            'params': {'tile_size': tile_size}})
+
+    steps.append({
+        'name': "02 Combined mask", 'deps': ["01 Canada mask", "01 ABoVE mask"],
+        'call': (combine_masks_step, (directory, mask_format)),
+        'inputs': [get_mask_path(directory, 'ABoVE'), get_mask_path(directory, 'Canada')],
+        'outputs': [get_mask_path(directory, 'Combined')],
+        'params': {'output_format': str(mask_format), 'resampling': mask_format.resampling.name}})
+
+    for name, datasets in MASKED_DATASETS.items():
+        mask_path = get_mask_path(directory, name)
+        mask_step = "02 Combined mask" if name == 'Combined' else f"01 {name} mask"
+        for dataset in datasets:
+            dataset_path = f"{directory}/{dataset}"
+            masked_path = apply_common_mask.get_output_path(dataset_path, name)
+            dataset_name = dataset.split('/')[0]
+            steps.append({
+                'name': f"03 {dataset_name} {name}", 'deps': [mask_step],
+                'call': (apply_mask_step, (dataset_path, mask_path, name, workers, output_format, checkpoint_interval)),
+                'inputs': [dataset_path, mask_path],
+                'outputs': [masked_path],
+                'params': {'output_format': str(output_format), 'resampling': output_format.resampling.name}})
+            steps.append({
+                'name': f"04 {dataset_name} {name}", 'deps': [f"03 {dataset_name} {name}"],
+                'call': (zonal_stats_step, (masked_path, zone_sets, list(coverage_ratios), mask_path, output_dir,
+                                            cache_dir, checkpoint_interval)),
+                'inputs': [masked_path, mask_path] + [p for shapefile in zone_sets.values() for p in shapefile_paths(shapefile)],
+                'outputs': [zonal_stats.get_output_file(masked_path, file_type, coverage_ratio, output_dir=output_dir)
+                            for file_type in zone_sets for coverage_ratio in coverage_ratios],
+                'params': {'coverage_ratios': list(coverage_ratios)}})
+    return steps
+
+def hash_file(path):
+    """
+    Returns the size, modification time and SHA-256 digest of a file's contents
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 << 20), b''):
+            sha.update(chunk)
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
+
+def file_digest(path, files):
+    """
+    Returns the SHA-256 digest of a file's contents. Digests are cached in `files`
+    (the manifest's file table) by size and modification time, so a file is only
+    read again after it has been rewritten
+
+    Returns:
+        digest (str or None): The digest, None when the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    cached = files.get(path)
+    if cached is None or cached['size'] != stat.st_size or cached['mtime'] != stat.st_mtime_ns:
+        cached = files[path] = hash_file(path)
+    return cached['sha256']
+
+def load_manifest(manifest_path):
+    """
+    Reads the manifest, an empty one when the pipeline has not run yet
+    """
+    if not os.path.exists(manifest_path):
+        return {'files': {}, 'steps': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    """
+    Writes the manifest atomically, so an interrupted run never leaves half of it
+    """
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def out_of_date(step, manifest, force=()):
+    """
+    Returns why a step has to run, or None when the manifest shows it ran with the
+    same input contents and parameters and its outputs are unchanged since
+
+    Args:
+        step (dict): A step from `build_pipeline`
+        manifest (dict): The pipeline manifest
+        force (list of str): Name patterns of steps that always run, e.g. "03 *"
+    """
+    if any(fnmatch.fnmatch(step['name'], pattern) for pattern in force):
+        return "forced"
+    entry = manifest['steps'].get(step['name'])
+    if entry is None:
+        return "no previous run"
+    if entry['params'] != step['params']:
+        return "parameters changed"
+    for path in step['outputs']:
+        if entry['outputs'].get(path) is None or file_digest(path, manifest['files']) != entry['outputs'][path]:
+            return f"{path} is missing or changed"
+    for path in step['inputs']:
+        if file_digest(path, manifest['files']) != entry['inputs'].get(path):
+            return f"{path} changed"
+    return None
+
+def run_step(name, call, inputs, outputs, files):
+    """
+    Runs a step in a worker process and hashes its inputs (before it runs) and its
+    outputs there, so large files are hashed in parallel and never hold up the
+    scheduler
+
+    Args:
+        name (str): Name of the step
+        call (tuple): The function of the step and its arguments
+        inputs (list of str): Input files of the step
+        outputs (list of str): Output files of the step
+        files (dict): Manifest records of the inputs, reused for unchanged files
+
+    Returns:
+        tuple: A tuple containg:
+            - digests (dict): SHA-256 digest of every input, None for a missing one
+            - records (dict): `hash_file` record of every input and output
+    """
+    digests = {path: file_digest(path, files) for path in inputs}
+    function, args = call
+    with stage('pipeline_step', step=name):
+        function(*args)
+    records = {path: files[path] for path in inputs if path in files}
+    records.update((path, hash_file(path)) for path in outputs)
+    return digests, records
+
+def run_pipeline(steps, manifest_path, jobs=1, force=(), dry_run=False):
+    """
+    Runs the steps of a DAG, up to `jobs` at a time, each as soon as the steps it
+    depends on are done. A step whose input contents, parameters and outputs match
+    its manifest entry is skipped. The manifest is written after every step, so a run
+    stopped by the walltime picks up at the first unfinished step, and 03 and 04
+    continue from their block checkpoints. A failed step blocks its dependents while
+    independent branches go on
+
+    Args:
+        steps (list of dict): Steps from `build_pipeline`
+        manifest_path (str): Path of the JSON manifest of input and output digests
+        jobs (int): Number of steps run at the same time
+        force (list of str): Name patterns of steps to run even when up to date
+        dry_run (bool): Only print which steps would run
+
+    Returns:
+        state (dict): Final state of every step: "done", "skipped", "failed" or "blocked"
+    """
+    manifest = load_manifest(manifest_path)
+    state = {}
+    pending = list(steps)
+    running = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for step in list(pending):
+                deps = [state.get(dep) for dep in step['deps']]
+                if any(dep in ('failed', 'blocked') for dep in deps):
+                    pending.remove(step)
+                    state[step['name']] = 'blocked'
+                    print(f"{step['name']}: blocked by a failed step")
+                    continue
+                if not all(dep in ('done', 'skipped') for dep in deps):
+                    continue
+                pending.remove(step)
+                if dry_run and any(dep == 'done' for dep in deps):
+                    reason = "after " + ", ".join(dep for dep in step['deps'] if state[dep] == 'done')
+                else:
+                    reason = out_of_date(step, manifest, force)
+                if reason is None:
+                    state[step['name']] = 'skipped'
+                    print(f"{step['name']}: up to date")
+                elif dry_run:
+                    state[step['name']] = 'done'
+                    print(f"{step['name']}: would run ({reason})")
+                else:
+                    print(f"{step['name']}: running ({reason})", flush=True)
+                    files = {path: manifest['files'][path] for path in step['inputs'] if path in manifest['files']}
+                    future = executor.submit(run_step, step['name'], step['call'], step['inputs'], step['outputs'],
+                                             files)
+                    running[future] = (step, time.perf_counter())
+
+            if not running:
+                if pending:
+                    # Only steps whose dependencies never ran are left, e.g. a typo in `deps`
+                    raise ValueError(f"Unknown dependencies: {[step['name'] for step in pending]}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, start = running.pop(future)
+                try:
+                    inputs, records = future.result()
+                except Exception:
+                    state[step['name']] = 'failed'
+                    print(f"{step['name']}: failed")
+                    traceback.print_exc()
+                    continue
+                manifest['files'].update(records)
+                manifest['steps'][step['name']] = {
+                    'inputs': inputs,
+                    'outputs': {path: record['sha256'] for path, record in records.items()},
+                    'params': step['params'],
+                    'seconds': round(time.perf_counter() - start, 1)}
+                save_manifest(manifest, manifest_path)
+                state[step['name']] = 'done'
+                print(f"{step['name']}: done in {manifest['steps'][step['name']]['seconds']:.0f} s", flush=True)
+
+    if not dry_run:
+        save_manifest(manifest, manifest_path)
+    counts = {status: list(state.values()).count(status) for status in ('done', 'skipped', 'failed', 'blocked')}
+    print("Pipeline: " + ", ".join(f"{count} {status}" for status, count in counts.items()))
+    return state
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Resumable Common NA Mask and Zonal Statistics Pipeline")
+    parser.add_argument('--directory', type=str, default="/projects/arctic/share/ABoVE_Biomass", help="Root directory of the ABoVE Biomass datasets")
+    parser.add_argument('--manifest', type=str, default=None, help=f"Manifest of the pipeline, default <directory>/{MANIFEST_NAME}")
+    parser.add_argument('--output-dir', type=str, default="zonal_stats", help="Directory of the zonal statistics results")
+    parser.add_argument('--coverage_ratio', type=float, nargs='+', default=[0.45], help="Coverage ratio(s) of the zonal statistics (number 0-1)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)), help="Total number of threads")
+    parser.add_argument('--jobs', type=int, default=4, help="Number of independent steps run at the same time, sharing --workers")
+    parser.add_argument('--tile-size', type=int, default=4096, help="Tile edge length of the common NA masks in pixels")
+    parser.add_argument('--checkpoint-interval', type=float, default=600, help="Seconds between block checkpoints of masking and zonal statistics")
+    parser.add_argument('--force', type=str, nargs='*', default=[], help="Name patterns of steps to rerun even when up to date, e.g. '03 *'")
+    parser.add_argument('--dry-run', action='store_true', help="Only print which steps would run")
+    add_output_format_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    # Run script
+    steps = build_pipeline(args.directory, args.output_dir, args.coverage_ratio, max(1, args.workers // args.jobs),
+                           args.tile_size, OutputFormat.from_args(args), args.checkpoint_interval,
+                           OutputFormat.from_args(args, resampling='nearest'))
+    manifest_path = args.manifest or os.path.join(args.directory, MANIFEST_NAME)
+    state = run_pipeline(steps, manifest_path, args.jobs, args.force, args.dry_run)
+    if 'failed' in state.values():
+        raise SystemExit(1)
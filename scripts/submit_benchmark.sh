@@ -0,0 +1,16 @@
+#!/bin/bash
+#SBATCH --job-name=above_benchmark              # Job name
+#SBATCH --output=above_benchmark_%j.out         # Standard output and error log
+#SBATCH --ntasks=1                              # Number of tasks
+#SBATCH --cpus-per-task=16                      # Number of CPU cores per task
+#SBATCH --time=04:00:00                         # Walltime
+#SBATCH --mem=128G                              # Memory per node
+
+# Load necessary modules
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+conda activate ABoVE2024  
+
+# Run the Python script, any arguments are passed on (e.g. --sizes 4096 16384 --nodata nan 0 -9999).
+# The first run saves the reference outputs, later runs are checked against them
+python3 benchmark.py --workers 1 4 "$SLURM_CPUS_PER_TASK" "$@"
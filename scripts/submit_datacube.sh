@@ -0,0 +1,15 @@
+#!/bin/bash
+#SBATCH --job-name=build_datacube               # Job name
+#SBATCH --output=build_datacube_%j.out          # Standard output and error log
+#SBATCH --ntasks=1                              # Number of tasks
+#SBATCH --cpus-per-task=32                      # Number of CPU cores per task
+#SBATCH --time=24:00:00                         # Walltime
+#SBATCH --mem=256G                              # Memory per node
+
+# Load necessary modules
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+conda activate ABoVE2024  
+
+# Run the Python script, any arguments are passed on (e.g. --export-masks)
+python3 00_build_datacube.py --workers "$SLURM_CPUS_PER_TASK" "$@"
@@ -0,0 +1,22 @@
+#!/bin/bash
+#SBATCH --job-name=disturbance_stats_job      # Job name
+#SBATCH --output=disturbance_stats_%j.out     # Standard output and error log (%j will be replaced by the job ID)
+#SBATCH --ntasks=1                            # Number of tasks
+#SBATCH --cpus-per-task=8                     # Number of CPU cores per task
+#SBATCH --time=12:00:00                       # Walltime
+#SBATCH --mem=128G                            # Memory per node
+
+# Load necessary modules
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+module load gdal/3.7.2
+conda activate ABoVE2024  
+
+# Check for command-line arguments
+if [ "$#" -lt 1 ]; then
+    echo "Usage: sbatch submit_disturbance_stats.sh <input_raster_file> [more raster files] [extra 05_disturbance_stats.py options]"
+    exit 1
+fi
+
+# Run the Python script with the provided arguments
+python3 05_disturbance_stats.py --infile "$@"
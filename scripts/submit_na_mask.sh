@@ -21,4 +21,4 @@ fi
 type=$1
 
 # Run the Python script with the provided arguments
-python3 01_create_common_mask.py --type "$type"
\ No newline at end of file
+python3 01_create_common_mask.py --type "$type" --workers "$SLURM_CPUS_PER_TASK"
\ No newline at end of file
@@ -0,0 +1,16 @@
+#!/bin/bash
+#SBATCH --job-name=above_pipeline               # Job name
+#SBATCH --output=above_pipeline_%j.out          # Standard output and error log
+#SBATCH --ntasks=1                              # Number of tasks
+#SBATCH --cpus-per-task=32                      # Number of CPU cores per task
+#SBATCH --time=24:00:00                         # Walltime
+#SBATCH --mem=512G                              # Memory per node
+
+# Load necessary modules
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+conda activate ABoVE2024  
+
+# Run the Python script, any arguments are passed on (e.g. --coverage_ratio 0.25 0.45).
+# Resubmit after a timeout: finished steps are skipped and interrupted ones resume
+python3 run_pipeline.py --workers "$SLURM_CPUS_PER_TASK" "$@"
@@ -13,8 +13,8 @@ module load gdal/3.7.2
 conda activate ABoVE2024  
 
 # Check for command-line arguments
-if [ "$#" -ne 3 ]; then
-    echo "Usage: sbatch submit_zonal_stats.sh <input_raster_file> <script_type> <coverage_ratio>"
+if [ "$#" -lt 3 ]; then
+    echo "Usage: sbatch submit_zonal_stats.sh <input_raster_file> <script_type> <coverage_ratio> [extra 04_zonal_stats.py options]"
     exit 1
 fi
 
@@ -24,4 +24,4 @@ script_type=$2
 coverage_ratio=$3
 
 # Run the Python script with the provided arguments
-python3 04_zonal_stats.py --infile "$infile" --script_type "$script_type" --coverage_ratio $coverage_ratio
+python3 04_zonal_stats.py --infile "$infile" --script_type "$script_type" --coverage_ratio $coverage_ratio "${@:4}"
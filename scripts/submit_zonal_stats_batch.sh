@@ -0,0 +1,31 @@
+#!/bin/bash
+#SBATCH --job-name=zonal_stats_batch    # Job name
+#SBATCH --output=zonal_stats_batch_%A_%a.out # Standard output and error log (%A job ID, %a array index)
+#SBATCH --ntasks=1                      # Number of tasks
+#SBATCH --cpus-per-task=16              # Number of CPU cores per task (rasters processed at once)
+#SBATCH --time=24:00:00                 # Walltime
+#SBATCH --mem=512G                      # Memory per node
+#SBATCH --array=0-0                     # One array task per node, e.g. --array=0-3 splits the rasters over 4 nodes
+
+# Load necessary modules
+source /packages/anaconda3/2024.02/etc/profile.d/conda/sh
+module load anaconda3/2024.02 
+module load gdal/3.7.2
+conda activate ABoVE2024  
+
+# Check for command-line arguments
+if [ "$#" -lt 1 ]; then
+    echo "Usage: sbatch [--array=0-<nodes-1>] submit_zonal_stats_batch.sh <input_raster_file>... [04_zonal_stats.py options]"
+    exit 1
+fi
+
+# Rasters first, then any options (defaults: both zone sets, coverage ratio 0.45)
+infiles=()
+while [ "$#" -gt 0 ] && [[ "$1" != --* ]]; do
+    infiles+=("$1")
+    shift
+done
+
+# Node index and count come from the array task's position (SLURM_ARRAY_TASK_ID - SLURM_ARRAY_TASK_MIN) and SLURM_ARRAY_TASK_COUNT
+python3 04_zonal_stats.py --infile "${infiles[@]}" --script_type EPA2 Canada --coverage_ratio 0.45 \
+    --workers "$SLURM_CPUS_PER_TASK" "$@"
@@ -0,0 +1,50 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from rasterio.windows import Window
+
+def iter_tiles(width, height, tile_size):
+    """
+    Yields the windows that split a grid into square tiles, row by row
+
+    Args:
+        width (int): The width of the grid in pixels
+        height (int): The height of the grid in pixels
+        tile_size (int): The edge length of a tile in pixels
+
+    Yields:
+        window (Window): A tile of the grid, clipped at the right and bottom edges
+    """
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield Window(col_off, row_off,
+                         min(tile_size, width - col_off),
+                         min(tile_size, height - row_off))
+
+def imap_bounded(function, tasks, workers=1):
+    """
+    Yields `function(*task)` for every task, computed by a pool of `workers` worker
+    processes in the order they finish (in order without a pool). At most
+    `2 * workers` tasks are in flight, so finished results do not pile up in memory
+    waiting for the caller to write them
+
+    Args:
+        function (callable): Picklable function run on every task
+        tasks (iterable of tuple): Arguments of every call
+        workers (int): Number of worker processes, 1 runs the tasks in this process
+
+    Yields:
+        result: The return value of every call
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for task in tasks:
+            pending.add(executor.submit(function, *task))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
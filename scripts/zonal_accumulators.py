@@ -0,0 +1,293 @@
+import numpy as np
+
+def float32_sort_keys(values):
+    """
+    Maps float32 values onto uint32 keys that sort in the same order as the values,
+    so order statistics can be found with integer histograms of the key bits
+    """
+    bits = values.astype(np.float32).view(np.uint32)
+    return np.where(bits & np.uint32(0x80000000), ~bits, bits | np.uint32(0x80000000))
+
+def float32_from_sort_keys(keys):
+    """
+    Inverse of `float32_sort_keys`
+    """
+    keys = np.asarray(keys, dtype=np.uint32)
+    bits = np.where(keys & np.uint32(0x80000000), keys & np.uint32(0x7FFFFFFF), ~keys)
+    return bits.view(np.float32)
+
+def quantile_ranks(count, quantiles):
+    """
+    Returns the ranks that `np.percentile` (linear method) interpolates between
+
+    Args:
+        count (numpy.ndarray): Number of values per zone
+        quantiles (list of float): Quantiles in [0, 1]
+
+    Returns:
+        tuple: A tuple containg:
+            - lower (numpy.ndarray): Lower 0-based rank, shape (zones, quantiles)
+            - upper (numpy.ndarray): Upper 0-based rank, shape (zones, quantiles)
+            - fraction (numpy.ndarray): Weight of the upper rank, shape (zones, quantiles)
+    """
+    position = np.outer(np.maximum(count - 1, 0), quantiles)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return lower, upper, position - lower
+
+class ZonalAccumulator:
+    """
+    Streaming per-zone statistics that are updated chunk by chunk and can be merged
+    across processes. Count, sum, sum of squares, min and max are exact. Quantiles
+    come from a log-bucket sketch: every value is counted in a bucket
+    `(min_value * gamma**(i-1), min_value * gamma**i]` with `gamma = (1+a)/(1-a)`,
+    so any quantile is reported within a relative error `a` of a value of the
+    correct rank. Values with a magnitude below `min_value` share one zero bucket
+    (absolute error below `min_value`) and values above `max_value` fall into the
+    last bucket and are counted in `overflow`
+
+    Memory is `zones * buckets`, independent of how many pixels a zone has
+
+    Args:
+        n_labels (int): Number of zone labels including the unused label 0
+        relative_error (float): Relative error bound `a` of the quantile sketch
+        min_value (float): Smallest magnitude resolved by the sketch
+        max_value (float): Largest magnitude resolved by the sketch
+    """
+
+    def __init__(self, n_labels, relative_error=0.005, min_value=1e-3, max_value=1e6):
+        self.n_labels = n_labels
+        self.relative_error = relative_error
+        self.min_value = min_value
+        self.max_value = max_value
+        self.log_gamma = np.log((1 + relative_error) / (1 - relative_error))
+        self.n_buckets = int(np.ceil(np.log(max_value / min_value) / self.log_gamma)) + 1
+
+        self.count = np.zeros(n_labels, dtype=np.int64)
+        self.total = np.zeros(n_labels, dtype=np.float64)
+        self.total_sq = np.zeros(n_labels, dtype=np.float64)
+        self.minimum = np.full(n_labels, np.inf)
+        self.maximum = np.full(n_labels, -np.inf)
+        self.positive = np.zeros((n_labels, self.n_buckets), dtype=np.int64)
+        self.negative = np.zeros((n_labels, self.n_buckets), dtype=np.int64)
+        self.zero = np.zeros(n_labels, dtype=np.int64)
+        self.overflow = np.zeros(n_labels, dtype=np.int64)
+
+    def update(self, labels, values):
+        """
+        Adds a chunk of valid pixels to the accumulator
+
+        Args:
+            labels (numpy.ndarray): Zone label of every pixel
+            values (numpy.ndarray): Raster value of every pixel
+        """
+        if labels.size == 0:
+            return
+        labels = labels.astype(np.int64)
+        values = values.astype(np.float64)
+        n = self.n_labels
+        self.count += np.bincount(labels, minlength=n)
+        self.total += np.bincount(labels, weights=values, minlength=n)
+        self.total_sq += np.bincount(labels, weights=values * values, minlength=n)
+        np.minimum.at(self.minimum, labels, values)
+        np.maximum.at(self.maximum, labels, values)
+
+        magnitude = np.abs(values)
+        is_zero = magnitude < self.min_value
+        self.zero += np.bincount(labels[is_zero], minlength=n)
+        self.overflow += np.bincount(labels[magnitude > self.max_value], minlength=n)
+        with np.errstate(divide='ignore'):
+            bucket = np.ceil(np.log(magnitude / self.min_value) / self.log_gamma)
+        bucket = np.clip(np.nan_to_num(bucket, nan=0.0, neginf=0.0), 0, self.n_buckets - 1).astype(np.int64)
+        for store, side in ((self.positive, values > 0), (self.negative, values < 0)):
+            side &= ~is_zero
+            store += np.bincount(labels[side] * self.n_buckets + bucket[side],
+                                 minlength=n * self.n_buckets).reshape(n, self.n_buckets)
+
+    def merge(self, other):
+        """
+        Adds the state of another accumulator with the same settings to this one
+
+        Args:
+            other (ZonalAccumulator): Accumulator built over other pixels of the same zones
+        """
+        if (other.n_labels, other.n_buckets, other.min_value) != (self.n_labels, self.n_buckets, self.min_value):
+            raise ValueError("Cannot merge accumulators with different zones or sketch settings")
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        np.minimum(self.minimum, other.minimum, out=self.minimum)
+        np.maximum(self.maximum, other.maximum, out=self.maximum)
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zero += other.zero
+        self.overflow += other.overflow
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Stacks accumulators with the same sketch settings into one whose labels are
+        the labels of `parts[0]` followed by those of `parts[1]` and so on, e.g. to
+        index single-zone accumulators by zone label
+
+        Args:
+            parts (list of ZonalAccumulator): Accumulators to stack
+
+        Returns:
+            accumulator (ZonalAccumulator): The stacked accumulator
+        """
+        first = parts[0]
+        accumulator = cls(sum(part.n_labels for part in parts), first.relative_error, first.min_value, first.max_value)
+        for name in ('count', 'total', 'total_sq', 'minimum', 'maximum', 'positive', 'negative', 'zero', 'overflow'):
+            setattr(accumulator, name, np.concatenate([getattr(part, name) for part in parts]))
+        return accumulator
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.total / self.count
+
+    def std(self):
+        """
+        Population standard deviation per zone (the same as `np.nanstd`)
+        """
+        mean = self.mean()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(np.maximum(self.total_sq / self.count - mean * mean, 0.0))
+
+    def _rank_values(self, label, ranks):
+        # Buckets in ascending value order: negatives (largest magnitude first), zero, positives
+        gamma = np.exp(self.log_gamma)
+        edges = self.min_value * np.exp(self.log_gamma * np.arange(self.n_buckets))
+        centres = edges * 2 / (1 + gamma)
+        centres = np.concatenate([-centres[::-1], [0.0], centres])
+        counts = np.concatenate([self.negative[label, ::-1], [self.zero[label]], self.positive[label]])
+        cumulative = np.cumsum(counts)
+        values = centres[np.searchsorted(cumulative, ranks, side='right')]
+        # The exact min and max bound every rank
+        return np.clip(values, self.minimum[label], self.maximum[label])
+
+    def quantiles(self, quantiles):
+        """
+        Estimates quantiles per zone, interpolating between ranks like `np.percentile`
+
+        Args:
+            quantiles (list of float): Quantiles in [0, 1]
+
+        Returns:
+            estimates (numpy.ndarray): Shape (zones, quantiles), NaN for empty zones
+        """
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        lower, upper, fraction = quantile_ranks(self.count, quantiles)
+        estimates = np.full((self.n_labels, len(quantiles)), np.nan)
+        for label in np.flatnonzero(self.count):
+            low = self._rank_values(label, lower[label])
+            high = self._rank_values(label, upper[label])
+            estimates[label] = low + (high - low) * fraction[label]
+        return estimates
+
+    def error_report(self):
+        """
+        Describes the error bound of the quantiles, for logging alongside results
+        """
+        report = (f"Quantiles from log-bucket sketch: relative error <= {self.relative_error:.3%} "
+                  f"for |values| >= {self.min_value:g}, absolute error < {self.min_value:g} below")
+        if self.overflow.any():
+            report += (f"; {int(self.overflow.sum())} values above {self.max_value:g} are outside the bound")
+        return report
+
+class ExactQuantiles:
+    """
+    Exact per-zone quantiles found with a two-scan radix select on the float32 bits
+    of the values. The first scan histograms the high 16 bits of every value per
+    zone, the second histograms the low 16 bits of only the values that share the
+    high bits of a wanted rank. Both histograms are mergeable across processes and
+    memory is `zones * 65536` counts per scan, independent of zone size. Values are
+    exact to float32 precision
+
+    Args:
+        n_labels (int): Number of zone labels including the unused label 0
+    """
+    n_bins = 1 << 16
+
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+        self.high_hist = np.zeros((n_labels, self.n_bins), dtype=np.int64)
+        self.low_hist = None
+
+    def update(self, labels, values):
+        """
+        First scan: counts the high 16 bits of the keys per zone
+        """
+        if labels.size == 0:
+            return
+        high = (float32_sort_keys(values) >> 16).astype(np.int64)
+        # Histogram only the zones present in this chunk to keep the bincount small
+        zones, index = np.unique(labels, return_inverse=True)
+        self.high_hist[zones] += np.bincount(index * self.n_bins + high,
+                                             minlength=len(zones) * self.n_bins).reshape(len(zones), self.n_bins)
+
+    def prepare(self, quantiles):
+        """
+        Finds the high bits of every wanted rank once the first scan is complete
+
+        Args:
+            quantiles (list of float): Quantiles in [0, 1]
+        """
+        count = self.high_hist.sum(axis=1)
+        lower, upper, self.fraction = quantile_ranks(count, np.asarray(quantiles, dtype=np.float64))
+        self.count = count
+        self.ranks = np.concatenate([lower, upper], axis=1)
+        self.prefixes = np.zeros_like(self.ranks)
+        self.below = np.zeros_like(self.ranks)
+        cumulative = np.cumsum(self.high_hist, axis=1)
+        for z in np.flatnonzero(count):
+            self.prefixes[z] = np.searchsorted(cumulative[z], self.ranks[z], side='right')
+            self.below[z] = np.where(self.prefixes[z] > 0, cumulative[z, self.prefixes[z] - 1], 0)
+        self.high_hist = None
+        self.low_hist = None  # Allocated by the first `update_low` so a prepared instance pickles small
+
+    def update_low(self, labels, values):
+        """
+        Second scan: counts the low 16 bits of keys that share a wanted prefix
+        """
+        if labels.size == 0:
+            return
+        if self.low_hist is None:
+            self.low_hist = np.zeros((self.ranks.shape[1], self.n_labels, self.n_bins), dtype=np.int64)
+        keys = float32_sort_keys(values)
+        high = (keys >> 16).astype(np.int64)
+        low = (keys & np.uint32(0xFFFF)).astype(np.int64)
+        for k in range(self.ranks.shape[1]):
+            hit = high == self.prefixes[labels, k]
+            if not hit.any():
+                continue
+            zones, index = np.unique(labels[hit], return_inverse=True)
+            self.low_hist[k, zones] += np.bincount(index * self.n_bins + low[hit],
+                                                   minlength=len(zones) * self.n_bins).reshape(len(zones), self.n_bins)
+
+    def merge(self, other):
+        """
+        Adds the histograms of another instance that is at the same scan
+        """
+        if other.high_hist is not None:
+            self.high_hist += other.high_hist
+        if other.low_hist is not None:
+            if self.low_hist is None:
+                self.low_hist = other.low_hist.copy()
+            else:
+                self.low_hist += other.low_hist
+
+    def quantiles(self):
+        """
+        Returns the exact quantiles per zone, shape (zones, quantiles)
+        """
+        n_quantiles = self.fraction.shape[1]
+        estimates = np.full((self.n_labels, n_quantiles), np.nan)
+        for z in np.flatnonzero(self.count):
+            values = np.empty(self.ranks.shape[1])
+            for k in range(self.ranks.shape[1]):
+                low = np.searchsorted(np.cumsum(self.low_hist[k, z]), self.ranks[z, k] - self.below[z, k], side='right')
+                values[k] = float32_from_sort_keys((self.prefixes[z, k] << 16) | low)
+            low_values, high_values = values[:n_quantiles], values[n_quantiles:]
+            estimates[z] = low_values + (high_values - low_values) * self.fraction[z]
+        return estimates
@@ -0,0 +1,254 @@
+import glob
+import hashlib
+import os
+import tempfile
+import time
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.transform import array_bounds
+from rasterio.windows import Window
+from shapely import STRtree
+from shapely.geometry import box
+
+def get_zone_column(file_type):
+    """
+    Returns the shapefile column that holds the zone name
+
+    Args:
+        file_type (str): The type of geographic zone dataset
+                            - `Canada`: Uses the `postal` column for zone ID
+                            - `EPA2`: Uses the `NA_L2KEY` column for zone identification
+
+    Returns:
+        column (str): Name of the zone ID column
+    """
+    if file_type == 'Canada':
+        return 'postal'
+    elif file_type == 'EPA2':
+        return 'NA_L2KEY'
+    raise ValueError(f"Unknown zone file type: {file_type}")
+
+def iter_read_windows(src, target_size=2048, bidx=1, within=None):
+    """
+    Yields windows that cover a raster in chunks of roughly `target_size` pixels
+    per side, snapped to the raster's internal blocks so no block is read twice
+
+    Args:
+        src (DatasetReader): An open raster
+        target_size (int): Approximate edge length of a chunk in pixels
+        bidx (int): Band whose block layout is used
+        within (Window or None): Only yield the chunks that overlap this window,
+                                 clipped to it
+
+    Yields:
+        window (Window): A chunk of the raster, clipped at the right and bottom edges
+    """
+    block_height, block_width = src.block_shapes[bidx - 1]
+    step_y = max(1, target_size // block_height) * block_height
+    step_x = max(1, target_size // block_width) * block_width
+    row_start, row_stop, col_start, col_stop = 0, src.height, 0, src.width
+    if within is not None:
+        (row_start, row_stop), (col_start, col_stop) = within.toranges()
+        row_start, col_start = max(int(row_start), 0), max(int(col_start), 0)
+        row_stop, col_stop = min(int(row_stop), src.height), min(int(col_stop), src.width)
+    for row_off in range(row_start // step_y * step_y, row_stop, step_y):
+        for col_off in range(col_start // step_x * step_x, col_stop, step_x):
+            top, left = max(row_off, row_start), max(col_off, col_start)
+            yield Window(left, top,
+                         min(col_off + step_x, col_stop) - left,
+                         min(row_off + step_y, row_stop) - top)
+
+def label_dtype(n_zones):
+    """
+    Returns the smallest unsigned integer type that can hold `n_zones` labels plus 0
+    """
+    return 'uint16' if n_zones < np.iinfo(np.uint16).max else 'uint32'
+
+def rasterize_zones(tree, geometries, shape, transform, dtype='uint32'):
+    """
+    Burns the zones that touch one chunk of a grid into a label array, see
+    `build_zone_labels` for how labels are assigned
+
+    Args:
+        tree (STRtree): Spatial index of `geometries`
+        geometries (list of shapely.Geometry): Zone geometries in the grid's CRS
+        shape (tuple): `(height, width)` of the chunk
+        transform (Affine): Transform of the chunk
+        dtype (str): Data type of the labels
+
+    Returns:
+        labels (numpy.ndarray or None): 1-based zone labels, None when no zone
+        touches the chunk
+    """
+    height, width = shape
+    # Only burn zones that can touch this chunk
+    hits = tree.query(box(*array_bounds(height, width, transform)))
+    if len(hits) == 0:
+        return None
+    hits.sort()  # Keep the shapefile order so overlaps resolve the same everywhere
+    return rasterize(
+        ((geometries[i], int(i) + 1) for i in hits),
+        out_shape=shape,
+        transform=transform,
+        fill=0,
+        dtype=dtype)
+
+def build_zone_labels(geometries, raster_file, label_path, block_size=512):
+    """
+    Burns zones into an integer label raster on the grid of a dataset. Pixel values
+    are the 1-based position of the zone in `geometries` and 0 where no zone falls.
+    Pixels are assigned the same way as `rasterio.mask.mask` (pixel centre inside the
+    polygon). Where zones overlap the later zone wins
+
+    The label raster is written block by block and only the zones whose bounds
+    touch a block are burned into it, so memory stays bounded on continental grids
+
+    Args:
+        geometries (list of shapely.Geometry): Zone geometries in the dataset's CRS
+        raster_file (str): Path to the dataset whose grid the labels follow
+        label_path (str): Path of the output label GeoTIFF
+        block_size (int): Tile size of the label raster in pixels
+    """
+    dtype = label_dtype(len(geometries))
+    tree = STRtree(geometries)
+    with rasterio.open(raster_file) as src:
+        profile = {
+            'driver': 'GTiff',
+            'dtype': dtype,
+            'count': 1,
+            'height': src.height,
+            'width': src.width,
+            'crs': src.crs,
+            'transform': src.transform,
+            'nodata': 0,
+            'tiled': True,
+            'blockxsize': block_size,
+            'blockysize': block_size,
+            'compress': 'lzw',
+            'BIGTIFF': 'IF_SAFER'}
+        with rasterio.open(label_path, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                labels = rasterize_zones(tree, geometries, (window.height, window.width),
+                                         src.window_transform(window), dtype)
+                if labels is None:
+                    continue  # Blocks are already zero filled
+                dst.write(labels, 1, window=window)
+
+def shapefile_digest(shapefile):
+    """
+    Hashes the contents of a shapefile and its sidecar files (.dbf, .prj, ...)
+
+    Args:
+        shapefile (str): Path to the `.shp` file
+
+    Returns:
+        digest (str): Hex SHA-256 digest of all files that make up the shapefile
+    """
+    sha = hashlib.sha256()
+    stem = os.path.splitext(shapefile)[0]
+    for path in sorted(glob.glob(glob.escape(stem) + '.*')):
+        sha.update(os.path.basename(path)[len(os.path.basename(stem)):].encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def zone_label_key(shapefile, raster_file):
+    """
+    Builds the cache key of a zone label raster from the shapefile contents and
+    the CRS, transform and shape of the dataset's grid. Datasets that share a grid
+    share a key
+
+    Args:
+        shapefile (str): Path to the zone `.shp` file
+        raster_file (str): Path to the dataset whose grid the labels follow
+
+    Returns:
+        key (str): Hex digest identifying the label raster
+    """
+    with rasterio.open(raster_file) as src:
+        grid = f"{src.crs.to_wkt() if src.crs else ''}|{tuple(src.transform)[:6]}|{src.height}x{src.width}"
+    sha = hashlib.sha256()
+    sha.update(shapefile_digest(shapefile).encode())
+    sha.update(grid.encode())
+    return sha.hexdigest()[:32]
+
+def evict_zone_labels(cache_dir, max_bytes, keep=(), min_age=3600):
+    """
+    Removes the least recently used entries from a zone label cache until it fits
+    in `max_bytes`. An entry is a `<key>.tif` label raster, and its age is the last
+    time it was used. Entries used in the last `min_age` seconds are never evicted,
+    since another job may have just been handed them and not opened them yet, so the
+    cache can stay above the limit for a while
+
+    Args:
+        cache_dir (str): Directory of the cache
+        max_bytes (int): Size limit of the cache in bytes
+        keep (iterable of str): Keys that must not be evicted
+        min_age (float): Seconds since the last use before an entry may be evicted
+    """
+    entries = []
+    for tif in glob.glob(os.path.join(cache_dir, '*.tif')):
+        key = os.path.splitext(os.path.basename(tif))[0]
+        try:
+            entries.append((os.path.getmtime(tif), key, tif, os.path.getsize(tif)))
+        except FileNotFoundError:
+            continue  # Evicted by another job meanwhile
+    total = sum(entry[3] for entry in entries)
+    now = time.time()
+    for last_used, key, tif, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key in keep or now - last_used < min_age:
+            continue
+        try:
+            if now - os.path.getmtime(tif) < min_age:
+                continue  # Used by another job since the listing
+            os.remove(tif)
+        except FileNotFoundError:
+            continue
+        total -= size
+        print(f"Evicted zone labels {key} from cache")
+    if total > max_bytes:
+        print(f"Zone label cache is {total / 1024**3:.1f} GB, above its limit, but its remaining entries are in use")
+
+def get_zone_labels(geometries, shapefile, raster_file, cache_dir, max_bytes=100 * 1024**3):
+    """
+    Returns the zone label raster for a shapefile on the grid of a dataset, reusing a
+    cached one when the shapefile and grid have been rasterized before
+
+    Args:
+        geometries (list of shapely.Geometry): Zone geometries read from `shapefile`
+        shapefile (str): Path to the zone `.shp` file
+        raster_file (str): Path to the dataset whose grid the labels follow
+        cache_dir (str): Directory of the cache
+        max_bytes (int): Size limit of the cache in bytes
+
+    Returns:
+        label_path (str): Path to the cached label raster
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = zone_label_key(shapefile, raster_file)
+    label_path = os.path.join(cache_dir, f"{key}.tif")
+
+    try:
+        os.utime(label_path)  # Mark as recently used, which also protects it from eviction
+        print(f"Using cached zone labels: {label_path}")
+        return label_path
+    except FileNotFoundError:
+        pass
+
+    # Build under a temporary name so concurrent jobs never see a partial entry
+    fd, tmp_tif = tempfile.mkstemp(suffix='.tif', dir=cache_dir, prefix=f".{key}.")
+    os.close(fd)
+    try:
+        build_zone_labels(geometries, raster_file, tmp_tif)
+        os.replace(tmp_tif, label_path)
+    finally:
+        if os.path.exists(tmp_tif):
+            os.remove(tmp_tif)
+    print(f"Cached zone labels: {label_path}")
+
+    evict_zone_labels(cache_dir, max_bytes, keep=(key,))
+    return label_path
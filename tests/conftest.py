@@ -0,0 +1,31 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+sys.path.insert(0, SCRIPTS)
+
+
+def load_script(name):
+    """
+    Imports a numbered script such as `01_create_common_mask`
+    """
+    return importlib.import_module(name)
+
+
+@pytest.fixture(scope="session")
+def synthetic_tree(tmp_path_factory):
+    """
+    A small synthetic ABoVE Biomass tree (float32 rasters with NaN nodata) with both
+    common NA masks, see `benchmark.make_synthetic_tree`
+    """
+    benchmark = load_script("benchmark")
+    common_mask = load_script("01_create_common_mask")
+    directory = str(tmp_path_factory.mktemp("tree"))
+    benchmark.make_synthetic_tree(directory, 256, epa_zones=12, canada_zones=5)
+    os.makedirs(os.path.join(directory, "OtherSpatialDatasets"), exist_ok=True)
+    for mask_type in ("Canada", "ABoVE"):
+        common_mask.create_na_mask(mask_type, directory)
+    return directory
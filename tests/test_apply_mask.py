@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from conftest import load_script
+from raster_output import OutputFormat
+
+apply_mask = load_script("03_apply_common_mask")
+
+
+def masked_paths(directory):
+    dataset_path = os.path.join(directory, "Duncanson2025", "Duncanson2025_102001.tif")
+    mask_path = os.path.join(directory, "OtherSpatialDatasets", "CommonNA_Canada_Mask.tif")
+    return dataset_path, mask_path
+
+
+def read_output(path):
+    with rasterio.open(path) as src:
+        return src.read(), src.nodata
+
+
+@pytest.mark.parametrize("output_format,workers", [
+    (OutputFormat("source"), 4),
+    (OutputFormat("tiled", 64, "deflate"), 1),
+    (OutputFormat("tiled", 128, "zstd"), 3),
+    (OutputFormat("cog", 64, "zstd"), 2),
+])
+def test_output_matches_serial_source(synthetic_tree, tmp_path, output_format, workers):
+    dataset_path, mask_path = masked_paths(synthetic_tree)
+    expected = apply_mask.apply_na_mask(dataset_path, mask_path, "test", 1, output_path=str(tmp_path / "serial.tif"))
+    output = apply_mask.apply_na_mask(dataset_path, mask_path, "test", workers, output_format,
+                                      str(tmp_path / "output.tif"))
+    expected_data, expected_nodata = read_output(expected)
+    data, nodata = read_output(output)
+    np.testing.assert_array_equal(data, expected_data)
+    assert nodata == expected_nodata or (np.isnan(nodata) and np.isnan(expected_nodata))
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_failed_cog_leaves_no_temporary_output(synthetic_tree, tmp_path, monkeypatch, workers):
+    dataset_path, mask_path = masked_paths(synthetic_tree)
+    mask_block = apply_mask.mask_block
+
+    def failing_mask_block(src, aligner, window, nodata):
+        if window.row_off >= 128:
+            raise RuntimeError("injected failure")
+        return mask_block(src, aligner, window, nodata)
+
+    monkeypatch.setattr(apply_mask, "mask_block", failing_mask_block)
+    output_path = str(tmp_path / "output.tif")
+    assert apply_mask.apply_na_mask(dataset_path, mask_path, "test", workers, OutputFormat("cog", 64),
+                                    output_path) is None
+    assert os.listdir(tmp_path) == []
+
+    results = apply_mask.benchmark_output_formats(dataset_path, mask_path, workers, [OutputFormat("cog", 64)],
+                                                  str(tmp_path))
+    assert results == [(str(OutputFormat("cog", 64)), None, None)]
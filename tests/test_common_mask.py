@@ -0,0 +1,49 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds, from_origin
+
+from conftest import load_script
+
+common_mask = load_script("01_create_common_mask")
+
+
+def read_mask(directory, mask_type):
+    with rasterio.open(os.path.join(directory, "OtherSpatialDatasets", f"CommonNA_{mask_type}_Mask.tif")) as src:
+        return src.read(1)
+
+
+@pytest.mark.parametrize("mask_type", ["Canada", "ABoVE"])
+@pytest.mark.parametrize("tile_size,workers", [(37, 1), (100, 2), (4096, 1)])
+def test_windowed_mask_matches_full_grid(synthetic_tree, tmp_path, mask_type, tile_size, workers):
+    directory = str(tmp_path / "tree")
+    shutil.copytree(synthetic_tree, directory)
+    expected = read_mask(directory, mask_type)
+    common_mask.create_na_mask_windowed(mask_type, directory, tile_size, workers)
+    np.testing.assert_array_equal(read_mask(directory, mask_type), expected)
+
+
+@pytest.mark.parametrize("resolution", [7, 45])
+def test_nan_only_source_tiles_match_full_grid(tmp_path, resolution):
+    # Sources finer and coarser than the grid, without a nodata value, NaN holes only
+    rng = np.random.default_rng(resolution)
+    size = 3000 // resolution + 5
+    data = (rng.random((size, size)) * 100).astype("float32")
+    data[rng.random((size, size)) < 0.003] = np.nan
+    path = str(tmp_path / "source.tif")
+    with rasterio.open(path, "w", driver="GTiff", width=size, height=size, count=1, dtype="float32",
+                       crs="ESRI:102001", transform=from_origin(3, 3000, resolution, resolution)) as dst:
+        dst.write(data, 1)
+
+    width, height = 98, 97
+    transform = from_bounds(30, 60, 2970, 2970, width, height)
+    full, _, _ = common_mask.read_and_resample(path, transform, width, height)
+    expected = np.all(np.isnan(full), axis=0)
+    tiles = np.zeros_like(expected)
+    for window in common_mask.iter_tiles(width, height, 13):
+        _, tile_mask = common_mask.compute_na_tile([path], transform, window)
+        tiles[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width] = tile_mask
+    np.testing.assert_array_equal(tiles, expected)
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import rasterio
+
+import datacube
+from conftest import load_script
+
+build_cube = load_script("00_build_datacube")
+
+
+def test_chunk_reads_match_resampled_datasets(synthetic_tree, tmp_path, monkeypatch):
+    variables = [variable for variable in datacube.DATACUBE_VARIABLES
+                 if os.path.exists(os.path.join(synthetic_tree, variable["source"]))]
+    monkeypatch.setattr(build_cube, "DATACUBE_VARIABLES", variables)
+    cube_dir = str(tmp_path / "cube")
+    with rasterio.open(os.path.join(synthetic_tree, variables[0]["source"])) as src:
+        resolution = src.res[0] * 2
+    build_cube.build_datacube(synthetic_tree, cube_dir, resolution, chunk_size=64, workers=2)
+
+    names = datacube.MASK_VARIABLES["Canada"]
+    resolved = build_cube.get_datacube_variables(synthetic_tree)
+    with datacube.Datacube(cube_dir) as cube:
+        assert cube.variables == [variable["name"] for variable in variables]
+        chunks = list(cube.chunks())
+        assert len(chunks) > 1
+        for window in chunks[::3]:
+            _, values, bits = build_cube.resample_chunk(resolved, cube.crs, cube.transform, window)
+            for variable, value in zip(resolved, values):
+                np.testing.assert_array_equal(cube.read(variable["name"], window), value)
+            np.testing.assert_array_equal(cube.read_bits(window), bits)
+            expected = np.any([np.isnan(values[cube.bit(name)]) for name in names], axis=0)
+            np.testing.assert_array_equal(cube.na_mask(names, window), expected)
+        full_mask = cube.na_mask(names)
+
+    output_path = str(tmp_path / "na_mask.tif")
+    datacube.export_na_mask(cube_dir, names, output_path)
+    with rasterio.open(output_path) as src:
+        np.testing.assert_array_equal(src.read(1), full_mask.astype(np.uint8))
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from mask_tools import (TILE_MASKED, TILE_MIXED, TILE_VALID, MaskAligner, MaskIndexBuilder, build_mask_lookup, load_mask_index)
+from tiling import iter_tiles
+
+
+def write_raster(path, data, transform, nodata=None):
+    with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                       dtype=data.dtype, crs="ESRI:102001", transform=transform, nodata=nodata) as dst:
+        dst.write(data, 1)
+
+
+@pytest.fixture(scope="module", params=[None, 1])
+def mask_path(request, tmp_path_factory):
+    # Blocky mask with fully valid, fully masked and mixed index tiles
+    rng = np.random.default_rng(0)
+    mask = np.kron(rng.random((25, 25)) < 0.4, np.ones((8, 8))).astype(np.uint8)
+    mask[32:128, 32:128] = 0
+    mask[96:192, 128:192] = 1
+    path = str(tmp_path_factory.mktemp("mask") / "mask.tif")
+    write_raster(path, mask, from_origin(0, 6000, 30, 30), request.param)
+    index = MaskIndexBuilder(*mask.shape, tile_size=32)
+    index.update(rasterio.windows.Window(0, 0, mask.shape[1], mask.shape[0]), mask)
+    index.save(path)
+    return path
+
+
+# Finer, equal and coarser datasets (the coarsest reads mask rows one by one), all
+# reaching past the mask so the fill value is used
+@pytest.mark.parametrize("resolution,origin", [(10, (-103, 6097)), (30, (-217, 6131)), (90, (-455, 6455)),
+                                               (270, (-1087, 6887))])
+def test_lookup_matches_reproject(mask_path, tmp_path, resolution, origin):
+    size = 7600 // resolution
+    dataset_path = str(tmp_path / "dataset.tif")
+    write_raster(dataset_path, np.zeros((size, size), dtype=np.float32), from_origin(*origin, resolution, resolution))
+
+    with rasterio.open(mask_path) as mask_src, rasterio.open(dataset_path) as src:
+        aligner = MaskAligner(mask_src, src, index=load_mask_index(mask_path))
+        assert aligner.lookups is not None
+        rows, cols = build_mask_lookup(mask_src, src)
+        assert (rows == -1).any() and (cols == -1).any()
+        statuses = set()
+        for window in iter_tiles(src.width, src.height, max(4, 1000 // resolution)):
+            mask = aligner.read(window)
+            np.testing.assert_array_equal(mask, aligner._reproject(window))
+            status = aligner.window_status(window)
+            statuses.add(status)
+            if status == TILE_VALID:
+                assert not mask.any()
+            elif status == TILE_MASKED:
+                assert mask.all()
+        assert statuses == {TILE_VALID, TILE_MASKED, TILE_MIXED}
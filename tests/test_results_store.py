@@ -0,0 +1,42 @@
+import os
+
+import results_store
+
+RESULTS = [("MB", 15.5, 7.5, 1220.0, 18.0, 0.82, 1.0, 40.0), ("SK", None, None, None, None, None, None, None)]
+KEYS = {"zone_set": "Canada", "dataset": "Duncanson2025", "mask_type": "Combined", "coverage_ratio": 0.45,
+        "band": 1, "preview_level": 0}
+
+
+def results_table(results, **keys):
+    return results_store.results_table(results, [10, 90], **{**KEYS, **keys})
+
+
+def test_store_round_trip(tmp_path):
+    store = str(tmp_path / "results")
+    results_store.append_results(store, [results_table(RESULTS)])
+    results_store.append_results(store, [results_table(RESULTS, coverage_ratio=0.6)])
+
+    results = results_store.read_results(store, coverage_ratio=0.45)
+    assert list(results.columns[:6]) == [name for name, _ in results_store.KEY_COLUMNS]
+    assert results["zone"].tolist() == ["MB", "SK"]
+    assert results.loc[0, ["mean", "sum", "p10", "p90"]].tolist() == [15.5, 1220.0, 1.0, 40.0]
+    assert results.loc[1, ["mean", "p90"]].isna().all()
+
+    # Writing a result set again replaces it when read back
+    updated = [("MB", 16.0, 8.0, 1300.0, 19.0, 0.9, 2.0, 41.0)]
+    results_store.append_results(store, [results_table(updated)])
+    assert results_store.read_results(store, coverage_ratio=0.45)["mean"].tolist() == [16.0]
+    assert len(results_store.read_results(store, latest=False, coverage_ratio=0.45)) == 3
+
+    # Text export and import give back the same results
+    (output_file,) = results_store.export_txt(store, str(tmp_path / "txt"), coverage_ratio=0.6)
+    assert os.path.basename(output_file) == "zonal_stats_Canada_Duncanson2025_Combined_60.txt"
+    assert results_store.read_txt(output_file) == (RESULTS, [10.0, 90.0])
+
+    imported = str(tmp_path / "imported")
+    assert len(results_store.import_txt(imported, [output_file])) == 1
+    assert results_store.import_txt(imported, [output_file]) == []
+    results = results_store.read_results(imported)
+    assert results.loc[0, ["zone_set", "dataset", "mask_type", "coverage_ratio", "preview_level"]].tolist() == \
+        ["Canada", "Duncanson2025", "Combined", 0.6, 0]
+    assert results["band"].isna().all()
@@ -0,0 +1,79 @@
+import copy
+
+import numpy as np
+import pytest
+
+from zonal_accumulators import ExactQuantiles, ZonalAccumulator
+
+QUANTILES = [0.1, 0.5, 0.9]
+
+
+def zone_values(seed, n_labels=6, size=20000):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(1, n_labels, size)
+    values = (rng.lognormal(3, 1.5, size) * rng.choice([-1, 1], size, p=[0.1, 0.9])).astype(np.float32)
+    values[rng.random(size) < 0.01] = 0
+    return labels, values
+
+
+def expected_quantiles(labels, values, n_labels):
+    expected = np.full((n_labels, len(QUANTILES)), np.nan)
+    for label in np.unique(labels):
+        expected[label] = np.percentile(values[labels == label], np.multiply(QUANTILES, 100))
+    return expected
+
+
+def test_merged_chunks_match_one_pass():
+    labels, values = zone_values(0)
+    whole = ZonalAccumulator(6)
+    whole.update(labels, values)
+    merged = ZonalAccumulator(6)
+    for chunk in np.array_split(np.arange(labels.size), 7):
+        part = ZonalAccumulator(6)
+        part.update(labels[chunk], values[chunk])
+        merged.merge(part)
+
+    np.testing.assert_array_equal(merged.count, whole.count)
+    np.testing.assert_allclose(merged.total, whole.total, rtol=1e-12)
+    np.testing.assert_allclose(merged.std(), whole.std(), rtol=1e-9)
+    for name in ("minimum", "maximum", "positive", "negative", "zero", "overflow"):
+        np.testing.assert_array_equal(getattr(merged, name), getattr(whole, name))
+    np.testing.assert_array_equal(merged.quantiles(QUANTILES), whole.quantiles(QUANTILES))
+    with pytest.raises(ValueError):
+        merged.merge(ZonalAccumulator(6, relative_error=0.01))
+
+
+@pytest.mark.parametrize("relative_error", [0.005, 0.02])
+def test_sketch_quantiles_within_error_bound(relative_error):
+    labels, values = zone_values(1)
+    accumulator = ZonalAccumulator(6, relative_error=relative_error)
+    accumulator.update(labels, values)
+    estimates = accumulator.quantiles(QUANTILES)
+
+    expected = expected_quantiles(labels, values, 6)
+    assert np.isnan(estimates[0]).all()
+    # Ranks are interpolated like np.percentile, so the bound applies to the larger
+    # magnitude of the two ranks, plus the absolute error of the zero bucket
+    for label in range(1, 6):
+        ordered = np.sort(values[labels == label].astype(np.float64))
+        position = (len(ordered) - 1) * np.array(QUANTILES)
+        bound = np.maximum(np.abs(ordered[np.floor(position).astype(int)]),
+                           np.abs(ordered[np.ceil(position).astype(int)]))
+        assert np.all(np.abs(estimates[label] - expected[label]) <= relative_error * bound + accumulator.min_value)
+
+
+def test_exact_quantiles_merge_across_chunks():
+    labels, values = zone_values(2)
+    chunks = np.array_split(np.arange(labels.size), 5)
+    exact = ExactQuantiles(6)
+    for chunk in chunks:
+        part = ExactQuantiles(6)
+        part.update(labels[chunk], values[chunk])
+        exact.merge(part)
+    exact.prepare(QUANTILES)
+    # Copies are made before any second scan is merged, like the polygon engine does
+    parts = [copy.copy(exact) for _ in chunks]
+    for part, chunk in zip(parts, chunks):
+        part.update_low(labels[chunk], values[chunk])
+        exact.merge(part)
+    np.testing.assert_allclose(exact.quantiles(), expected_quantiles(labels, values, 6), rtol=1e-6)
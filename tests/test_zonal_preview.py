@@ -0,0 +1,31 @@
+import os
+import shutil
+
+import geopandas as gpd
+import pytest
+
+from conftest import load_script
+
+zonal_stats = load_script("04_zonal_stats")
+
+
+def test_preview_builds_overviews_without_touching_the_raster(synthetic_tree, tmp_path):
+    raster_file = str(tmp_path / "Duncanson2025_102001.tif")
+    shutil.copy(os.path.join(synthetic_tree, "Duncanson2025", "Duncanson2025_102001.tif"), raster_file)
+    shapefile = os.path.join(synthetic_tree, "OtherSpatialDatasets", "EPA_ecoregion_lvl2_102001.shp")
+    geometries = list(gpd.read_file(shapefile).geometry)
+
+    with pytest.raises(ValueError, match="no overviews"):
+        zonal_stats.accumulate_zones_preview(raster_file, geometries, 2)
+
+    stat = os.stat(raster_file)
+    accumulator, _, pixel_scale = zonal_stats.accumulate_zones_preview(raster_file, geometries, 2, build_overviews=True)
+    assert os.path.exists(raster_file + ".ovr")
+    assert (os.stat(raster_file).st_size, os.stat(raster_file).st_mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+    assert pixel_scale == 16
+    assert accumulator.count[1:].sum() > 0
+
+    errors = zonal_stats.estimate_preview_error(raster_file, geometries, [str(i) for i in range(len(geometries))],
+                                                accumulator, 2, sample_size=2, window_size=64)
+    assert len(errors) == 6
+    assert all(error[3] > 0 for error in errors)
@@ -0,0 +1,62 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pytest
+
+from conftest import load_script
+from zone_labels import build_zone_labels
+
+zonal_stats = load_script("04_zonal_stats")
+
+
+def zone_set(directory, file_type):
+    shapefile = {"EPA2": "EPA_ecoregion_lvl2_102001.shp", "Canada": "CanadaAlaska_Boundaries_102001.shp"}[file_type]
+    shapes = gpd.read_file(os.path.join(directory, "OtherSpatialDatasets", shapefile))
+    return list(shapes.geometry), list(shapes[zonal_stats.get_zone_column(file_type)])
+
+
+def assert_same_results(results, expected):
+    assert [row[0] for row in results] == [row[0] for row in expected]
+    for row, expected_row in zip(results, expected):
+        if expected_row[1] is None:
+            assert row[1:] == expected_row[1:]
+        else:
+            np.testing.assert_allclose(row[1:], expected_row[1:], rtol=1e-9)
+
+
+@pytest.mark.parametrize("file_type", ["EPA2", "Canada"])
+def test_label_scan_matches_polygon_engine(synthetic_tree, tmp_path, file_type):
+    raster_file = os.path.join(synthetic_tree, "Duncanson2025", "Duncanson2025_102001.tif")
+    geometries, zone_names = zone_set(synthetic_tree, file_type)
+    label_path = str(tmp_path / "labels.tif")
+    build_zone_labels(geometries, raster_file, label_path, block_size=64)
+
+    expected = zonal_stats.calculate_zonal_stats_tiles(raster_file, geometries, zone_names, 0.1, [10, 90], workers=2,
+                                                       tile_size=64, quantile_method="exact")
+    results = zonal_stats.calculate_zonal_stats_labels(raster_file, geometries, zone_names, label_path, 0.1, [10, 90],
+                                                       quantile_method="exact")
+    assert any(row[1] is not None for row in expected)
+    assert_same_results(results, expected)
+
+
+@pytest.mark.parametrize("dataset,mask_type", [("Duncanson2025/Duncanson2025_102001.tif", "Canada"),
+                                               ("Wang2020/Wang102001.tif", "ABoVE")])
+def test_applied_mask_matches_masked_copy(synthetic_tree, tmp_path, dataset, mask_type):
+    apply_mask = load_script("03_apply_common_mask")
+    raster_file = os.path.join(synthetic_tree, dataset)
+    mask_path = os.path.join(synthetic_tree, "OtherSpatialDatasets", f"CommonNA_{mask_type}_Mask.tif")
+    masked_file = apply_mask.apply_na_mask(raster_file, mask_path, mask_type, 1,
+                                           output_path=str(tmp_path / os.path.basename(raster_file)))
+    geometries, zone_names = zone_set(synthetic_tree, "EPA2")
+    label_path = str(tmp_path / "labels.tif")
+    build_zone_labels(geometries, raster_file, label_path, block_size=64)
+
+    expected = zonal_stats.calculate_zonal_stats_labels(masked_file, geometries, zone_names, label_path, 0.1, [10, 90],
+                                                        quantile_method="exact", mask_path=mask_path)
+    results = zonal_stats.calculate_zonal_stats_labels(raster_file, geometries, zone_names, label_path, 0.1, [10, 90],
+                                                       quantile_method="exact", mask_path=mask_path, apply_mask=True)
+    unmasked = zonal_stats.calculate_zonal_stats_labels(raster_file, geometries, zone_names, label_path, 0.1, [10, 90],
+                                                        quantile_method="exact")
+    assert [row[5] for row in unmasked] != [row[5] for row in expected]
+    assert_same_results(results, expected)